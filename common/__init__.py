@@ -0,0 +1,3 @@
+# -*- coding: utf-8 -*-
+# 各任务脚本共用的数据处理工具
+# 任务脚本位于子目录, 使用前将仓库根目录加入 sys.path
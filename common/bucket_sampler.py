@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+# 按 seqlen 分桶的 batch sampler
+# collate_fn 按 batch 内最大 seqlen 截断, 长度相近的样本放入同一 batch 可减少 padding
+# 每个 epoch: 全局打乱 -> 每 bucket_size 条样本按 seqlen 排序 -> 组 batch (固定条数或 token 预算) -> 打乱 batch 顺序
+# seqlen 来自旁路索引 <record 文件>.seqlen.npy , 只在第一次使用时解码一遍记录
+
+import logging
+import os
+import typing
+
+import numpy as np
+from torch.utils.data import DataLoader, Sampler
+
+__all__ = [
+    'BucketBatchSampler',
+    'get_seqlen_index',
+    'load_bucket_sampler',
+]
+
+
+class BucketBatchSampler(Sampler):
+    '''
+        seqlens: 每条样本长度
+        batch_size: 每个 batch 最多样本数, max_tokens 为 None 时为固定条数
+        max_tokens: batch 内 最大长度 * 条数 不超过 max_tokens , 超长的单条样本单独成 batch
+        bucket_size: 每个桶的样本数, 桶内排序
+        num_processes, process_index: ddp 分片, 每个进程 batch 数相同
+        未调用 set_epoch 时每次迭代 epoch 自动加 1
+    '''
+
+    def __init__(self, seqlens: typing.Union[np.ndarray, typing.List[int]],
+                 batch_size: typing.Optional[int] = None,
+                 max_tokens: typing.Optional[int] = None,
+                 bucket_size: int = 1000,
+                 shuffle: bool = True,
+                 drop_last: bool = False,
+                 seed: int = 0,
+                 num_processes: int = 1,
+                 process_index: int = 0):
+        super(BucketBatchSampler, self).__init__()
+        assert batch_size is not None or max_tokens is not None
+        assert 0 <= process_index < num_processes
+        self.seqlens = np.asarray(seqlens, dtype=np.int64)
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.bucket_size = max(bucket_size, batch_size or 1)
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.num_processes = num_processes
+        self.process_index = process_index
+        self.epoch = 0
+        # (epoch, batches) , max_tokens 时每个 epoch 的 batch 数不同, __len__ 与 __iter__ 共用同一 epoch 的结果
+        self._epoch_batches = None
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def _split_bucket(self, indices: np.ndarray):
+        if self.max_tokens is None:
+            batches = [indices[i: i + self.batch_size] for i in range(0, len(indices), self.batch_size)]
+            if self.drop_last and len(batches[-1]) < self.batch_size:
+                batches.pop()
+            return batches
+
+        batches = []
+        start, max_len = 0, 0
+        for i, n in enumerate(self.seqlens[indices]):
+            max_len_new = max(max_len, n)
+            size = i - start + 1
+            if size > 1 and (max_len_new * size > self.max_tokens or
+                             (self.batch_size is not None and size > self.batch_size)):
+                batches.append(indices[start: i])
+                start, max_len_new = i, n
+            max_len = max_len_new
+        if start < len(indices):
+            batches.append(indices[start:])
+        return batches
+
+    def get_batches(self, epoch: int):
+        rng = np.random.default_rng([self.seed, epoch])
+        n = len(self.seqlens)
+        indices = rng.permutation(n) if self.shuffle else np.arange(n)
+        batches = []
+        for i in range(0, n, self.bucket_size):
+            bucket = indices[i: i + self.bucket_size]
+            bucket = bucket[np.argsort(self.seqlens[bucket], kind='stable')]
+            batches.extend(self._split_bucket(bucket))
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        # 各进程 batch 数一致, 多余的丢弃
+        num_batches = len(batches) // self.num_processes
+        return batches[self.process_index: num_batches * self.num_processes: self.num_processes]
+
+    def _get_epoch_batches(self, epoch: int):
+        if self._epoch_batches is None or self._epoch_batches[0] != epoch:
+            self._epoch_batches = (epoch, self.get_batches(epoch))
+        return self._epoch_batches[1]
+
+    def __iter__(self):
+        batches = self._get_epoch_batches(self.epoch)
+        self.epoch += 1
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        return len(self._get_epoch_batches(self.epoch))
+
+
+def _get_seqlen(d: typing.Dict):
+    if 'seqlen' in d:
+        return int(np.asarray(d['seqlen']).reshape(-1)[0])
+    if 'attention_mask' in d:
+        return int(np.sum(d['attention_mask']))
+    return len(d['input_ids'])
+
+
+def get_seqlen_index(dataset, index_file: typing.Optional[str] = None):
+    '''
+        index_file 存在且条数一致时直接读取, 否则解码全部记录并保存
+    '''
+    if index_file is not None and os.path.exists(index_file):
+        seqlens = np.load(index_file)
+        if len(seqlens) == len(dataset):
+            return seqlens
+        logging.info('seqlen index {} mismatch, rebuild...'.format(index_file))
+    seqlens = np.asarray([_get_seqlen(dataset[i]) for i in range(len(dataset))], dtype=np.int32)
+    if index_file is not None:
+        np.save(index_file, seqlens)
+    return seqlens
+
+
+def _get_index_file(record_file: str):
+    index_file = record_file + '.seqlen.npy'
+    # 记录文件重新生成后索引失效
+    if os.path.exists(index_file) and os.path.exists(record_file) and \
+            os.path.getmtime(index_file) < os.path.getmtime(record_file):
+        os.remove(index_file)
+    return index_file
+
+
+def load_bucket_sampler(data_helper, files: typing.List,
+                        batch_size: typing.Optional[int] = None,
+                        max_tokens: typing.Optional[int] = None,
+                        collate_fn=None,
+                        bucket_size: int = 1000,
+                        shuffle: bool = True,
+                        seed: int = 0,
+                        num_processes: int = 1,
+                        process_index: int = 0,
+                        with_load_memory: bool = False,
+                        **kwargs):
+    '''
+        与 DataHelper.load_distributed_random_sampler 用法相同, batch 由 BucketBatchSampler 生成
+        ddp 时 Trainer 需设置 use_distributed_sampler=False , 分片已由 sampler 完成
+    '''
+    dataset = data_helper.load_dataset(files, shuffle=False, with_load_memory=with_load_memory)
+    if dataset is None:
+        return None
+    if all(isinstance(f, str) for f in files):
+        # 每个文件一个旁路索引, 顺序与 load_dataset 拼接顺序一致
+        seqlens = np.concatenate([get_seqlen_index(data_helper.load_dataset([f], shuffle=False), _get_index_file(f))
+                                  for f in files])
+    else:
+        # memory 后端无文件路径
+        seqlens = get_seqlen_index(dataset)
+    assert len(seqlens) == len(dataset)
+    batch_sampler = BucketBatchSampler(seqlens, batch_size=batch_size, max_tokens=max_tokens,
+                                       bucket_size=bucket_size, shuffle=shuffle, seed=seed,
+                                       num_processes=num_processes, process_index=process_index)
+    return DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=collate_fn, **kwargs)
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+# 按字切分 (tokens = list(sentence)) 的 token -> id 查表
+# 由词表预先生成 unicode 码位 -> id 的 numpy 表, 整句 utf-32 编码后一次 take 得到 ids
+# 结果与 tokenizer.convert_tokens_to_ids(list(sentence)) 一致: 不在词表中的字为 unk_token_id , 含 added tokens
+
+import functools
+import typing
+
+import numpy as np
+
+__all__ = [
+    'CharIdTable',
+    'get_char_id_table',
+]
+
+_MAX_CODEPOINT = 0x110000
+
+
+class CharIdTable:
+    '''
+        tokenizer: 词表来自 tokenizer.get_vocab() , 只有单个字符的 token 写入表中
+        do_lower_case: 默认 tokenizer.do_lower_case , 整句先 lower() 再查表, 与 list(sentence.lower()) 一致
+    '''
+
+    def __init__(self, tokenizer, do_lower_case: typing.Optional[bool] = None):
+        if do_lower_case is None:
+            do_lower_case = getattr(tokenizer, 'do_lower_case', False)
+        self.do_lower_case = do_lower_case
+        self.unk_token_id = tokenizer.unk_token_id
+        vocab = tokenizer.get_vocab()
+        self.table = np.full(_MAX_CODEPOINT, self.unk_token_id, dtype=np.int32)
+        for token, i in vocab.items():
+            if len(token) == 1:
+                self.table[ord(token)] = i
+        # added tokens 优先, 与 convert_tokens_to_ids 一致
+        for token, i in getattr(tokenizer, 'added_tokens_encoder', {}).items():
+            if len(token) == 1:
+                self.table[ord(token)] = i
+
+    def _codepoints(self, sentence: str):
+        if self.do_lower_case:
+            sentence = sentence.lower()
+        # surrogatepass: 单独的代理码位查表为 unk
+        return np.frombuffer(sentence.encode('utf-32-le', 'surrogatepass'), dtype='<u4')
+
+    def encode(self, sentence: str, dtype=np.int64):
+        '''
+            返回 list(sentence) 每个字的 id , np.ndarray
+        '''
+        return self.table.take(self._codepoints(sentence)).astype(dtype, copy=False)
+
+    def encode_batch(self, sentences: typing.List[str], dtype=np.int64):
+        '''
+            多个句子拼接后一次查表, 再按长度切分
+        '''
+        if not sentences:
+            return []
+        if self.do_lower_case:
+            sentences = [s.lower() for s in sentences]
+        lengths = np.fromiter((len(s) for s in sentences), dtype=np.int64, count=len(sentences))
+        codepoints = np.frombuffer(''.join(sentences).encode('utf-32-le', 'surrogatepass'), dtype='<u4')
+        ids = self.table.take(codepoints).astype(dtype, copy=False)
+        return np.split(ids, np.cumsum(lengths)[:-1])
+
+
+@functools.lru_cache(maxsize=8)
+def _get_char_id_table(tokenizer, do_lower_case):
+    return CharIdTable(tokenizer, do_lower_case=do_lower_case)
+
+
+def get_char_id_table(tokenizer, do_lower_case: typing.Optional[bool] = None) -> CharIdTable:
+    '''
+        每个 tokenizer 只生成一次, on_data_process 中直接调用
+    '''
+    if do_lower_case is None:
+        do_lower_case = getattr(tokenizer, 'do_lower_case', False)
+    return _get_char_id_table(tokenizer, do_lower_case)
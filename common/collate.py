@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+# 不定长 (ragged) 样本的 collate
+# 缓存中每条样本只保存 seqlen 个 token , 不保存 attention_mask , 在 collate_fn 中补齐到 batch 内最大 seqlen
+# 兼容旧缓存: 已 padding 到 max_seq_length 的字段先按 seqlen 截断
+# 定长 (padding 到 max_seq_length) 样本的 collate: StackCollator , 先截断到 batch 内最大 seqlen 再一次 np.stack
+
+import typing
+
+import numpy as np
+import torch
+
+__all__ = [
+    'pad_collate',
+    'StackCollator',
+]
+
+# 默认按 seqlen{suffix} 截断第 1 维的字段
+_SEQ_PREFIXES = ('input_ids', 'attention_mask', 'token_type_ids')
+
+
+def pad_collate(batch: typing.List[typing.Dict],
+                seq_keys: typing.Iterable[str] = ('input_ids', 'attention_mask', 'token_type_ids'),
+                pad_values: typing.Optional[typing.Dict[str, int]] = None,
+                with_attention_mask: bool = True):
+    '''
+        seq_keys: 第 0 维为序列维的字段, 补齐到 batch 内最大 seqlen
+        pad_values: 各字段补齐值, 默认 0 , 如 {'input_ids': tokenizer.pad_token_id , 'labels': -100}
+        with_attention_mask: 样本中没有 attention_mask 时由 seqlen 生成
+        其他字段直接 stack , seqlen 不输出
+    '''
+    pad_values = pad_values or {}
+    seqlens = np.asarray([int(np.asarray(b['seqlen']).reshape(-1)[0]) for b in batch], dtype=np.int64)
+    bs, max_len = len(batch), int(seqlens.max())
+
+    o = {}
+    for k in batch[0]:
+        if k == 'seqlen':
+            continue
+        if k in seq_keys:
+            first = np.asarray(batch[0][k])
+            arr = np.full((bs, max_len) + first.shape[1:], pad_values.get(k, 0), dtype=first.dtype)
+            for i, b in enumerate(batch):
+                n = seqlens[i]
+                arr[i, :n] = np.asarray(b[k])[:n]
+            o[k] = torch.from_numpy(arr)
+        else:
+            o[k] = torch.from_numpy(np.stack([np.asarray(b[k]) for b in batch]))
+
+    if with_attention_mask and 'attention_mask' not in o:
+        o['attention_mask'] = torch.from_numpy((np.arange(max_len)[None, :] < seqlens[:, None]).astype(np.int64))
+    return o
+
+
+def _torch_dtype(dtype: np.dtype):
+    return torch.from_numpy(np.empty((0,), dtype=dtype)).dtype
+
+
+class StackCollator:
+    '''
+        trim_axes: 各字段 batch 维之后每一维对应的 seqlen 字段, None 表示不截断
+            例如 {'labels': ('seqlen',)} , pointer 标签 {'labels': (None, 'seqlen', 'seqlen')}
+            input_ids{suffix} / attention_mask{suffix} / token_type_ids{suffix} 默认按 seqlen{suffix} 截断第 1 维
+        drop_keys: 不输出的字段, seqlen* 字段总是不输出
+        pin_memory: 输出 tensor 分配在锁页内存, DataLoader 无需再拷贝一次
+        每个字段先按 batch 内最大长度切片 (numpy 视图, 不拷贝), 再用一次 np.stack 写入预分配的 tensor
+    '''
+
+    def __init__(self, trim_axes: typing.Optional[typing.Dict[str, typing.Sequence[typing.Optional[str]]]] = None,
+                 drop_keys: typing.Iterable[str] = ('id',),
+                 pin_memory: bool = False):
+        self.trim_axes = dict(trim_axes or {})
+        self.drop_keys = set(drop_keys)
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+
+    def get_trim_axes(self, key: str, seqlen_keys: typing.Iterable[str]):
+        if key in self.trim_axes:
+            return self.trim_axes[key]
+        for prefix in _SEQ_PREFIXES:
+            if key.startswith(prefix) and 'seqlen' + key[len(prefix):] in seqlen_keys:
+                return ('seqlen' + key[len(prefix):],)
+        return ()
+
+    def __call__(self, batch: typing.List[typing.Dict]):
+        seqlen_keys = [k for k in batch[0] if k.startswith('seqlen')]
+        max_lens = {k: int(max(np.asarray(b[k]).reshape(-1)[0] for b in batch)) for k in seqlen_keys}
+
+        o = {}
+        for k in batch[0]:
+            if k in self.drop_keys or k in max_lens:
+                continue
+            axes = self.get_trim_axes(k, max_lens)
+            index = (Ellipsis,) if not axes else \
+                tuple(slice(None) if a is None else slice(0, max_lens[a]) for a in axes)
+            arrays = [np.asarray(b[k])[index] for b in batch]
+            shape = (len(batch),) + arrays[0].shape
+            out = torch.empty(shape, dtype=_torch_dtype(arrays[0].dtype), pin_memory=self.pin_memory)
+            np.stack(arrays, out=out.numpy())
+            o[k] = out
+        return o
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+# 多进程制作缓存
+# DataHelper.make_dataset 的 num_process_worker 逐条经队列分发, 输出顺序不确定, 且子进程中 on_data_process 对
+# self.index / self.eval_labels 的修改不会回到主进程
+# 这里按连续区间把 on_get_corpus 的结果分给 fork 出的子进程:
+#   record 后端每个进程写一个分片文件, 按区间顺序拼接, 输出顺序与单进程一致
+#   其他后端子进程返回处理结果, 由主进程按顺序写入
+#   side_output_keys 中的列表 (如 eval_labels) 在子进程中重新收集, 按区间顺序追加到主进程的同名列表
+#   self.index 从区间起点开始计数, 调试打印 (self.index < 5) 只在第一个区间出现
+# on_get_corpus 返回生成器 (如 common.jsonl_reader.iter_jsonl) 时流式制作: 每 stream_block_size 条为一块,
+# 多进程按块处理, 主进程按块顺序写入, 同时在途的块不超过 2 * num_process_worker 个, 内存与语料大小无关
+
+import collections
+import itertools
+import multiprocessing
+import os
+import random
+import shutil
+import typing
+
+import numpy as np
+from deep_training.data_helper.data_writer import DataWriteHelper
+from fastdatasets.utils.numpyadapter import NumpyWriterAdapter
+
+__all__ = [
+    'make_dataset_parallel',
+    'make_dataset_stream',
+    'ParallelDataHelperMixin',
+]
+
+# fork 后子进程直接使用, 不需要 pickle tokenizer 和语料
+_worker_helper = None
+_worker_data = None
+
+
+def _get_shard_file(outfile: str, worker_id: int):
+    return '{}.part-{:05d}'.format(outfile, worker_id)
+
+
+def _concat_shards(shard_files: typing.List[str], outfile: str):
+    # TFRecord 与 GZIP 多成员流均可按字节拼接
+    with open(outfile, mode='wb') as f_out:
+        for shard_file in shard_files:
+            with open(shard_file, mode='rb') as f_in:
+                shutil.copyfileobj(f_in, f_out, length=16 * 1024 * 1024)
+            os.remove(shard_file)
+
+
+def _identity_fn(x, args):
+    return x
+
+
+def _process_examples(helper, data, mode: str):
+    results = []
+    for x in data:
+        res = helper.data_process_fn(x, mode)
+        if res is None:
+            continue
+        if isinstance(res, (list, tuple)):
+            results.extend(res)
+        else:
+            results.append(res)
+    return results
+
+
+def _build_shard(start: int, end: int, shard_file: typing.Optional[str], mode: str,
+                 side_output_keys: typing.Sequence[str]):
+    helper, data = _worker_helper, _worker_data[start:end]
+    for k in side_output_keys:
+        setattr(helper, k, [])
+    helper.on_data_ready()
+    if hasattr(helper, 'index'):
+        helper.index = start - 1
+
+    results = None
+    if shard_file is not None:
+        DataWriteHelper(helper.data_process_fn, mode, shard_file, helper.backend,
+                        num_process_worker=0, shuffle=False).save(data)
+    else:
+        results = _process_examples(helper, data, mode)
+    helper.on_data_finalize()
+    return results, {k: getattr(helper, k) for k in side_output_keys}
+
+
+def make_dataset_parallel(data_helper, outfile: typing.Union[str, list], data: typing.List, mode: str,
+                          num_process_worker: int, shuffle: bool = False,
+                          side_output_keys: typing.Sequence[str] = ('eval_labels',)):
+    '''
+        与 DataHelper.make_dataset 参数一致, 输出与 num_process_worker=0 时相同 (shuffle=False)
+        shuffle: 主进程先打乱语料顺序再分区间
+    '''
+    global _worker_helper, _worker_data
+    if shuffle:
+        data = list(data)
+        random.shuffle(data)
+    num_process_worker = max(1, min(num_process_worker, len(data)))
+    bounds = np.linspace(0, len(data), num_process_worker + 1, dtype=np.int64).tolist()
+    with_shards = isinstance(outfile, str) and data_helper.backend == 'record'
+    shard_files = [_get_shard_file(outfile, i) if with_shards else None for i in range(num_process_worker)]
+    side_output_keys = [k for k in side_output_keys if isinstance(getattr(data_helper, k, None), list)]
+    tasks = [(bounds[i], bounds[i + 1], shard_files[i], mode, side_output_keys) for i in range(num_process_worker)]
+
+    data_helper.on_data_ready()
+    _worker_helper, _worker_data = data_helper, data
+    try:
+        with multiprocessing.get_context('fork').Pool(num_process_worker) as pool:
+            outputs = pool.starmap(_build_shard, tasks)
+    finally:
+        _worker_helper, _worker_data = None, None
+
+    # 原地追加, 保持已传给模型的列表引用
+    for k in side_output_keys:
+        target = getattr(data_helper, k)
+        for _, side_outputs in outputs:
+            target.extend(side_outputs[k])
+
+    if with_shards:
+        _concat_shards(shard_files, outfile)
+    else:
+        results = [x for res, _ in outputs for x in res]
+        DataWriteHelper(_identity_fn, mode, outfile, data_helper.backend, num_process_worker=0,
+                        shuffle=False).save(results)
+    data_helper.on_data_finalize()
+
+
+class _StreamWriter:
+    # 与 ParallelNumpyWriter 的 flush / on_output_cleanup 一致, 数据逐批写入
+    def __init__(self, outfile, backend: str):
+        self.numpy_writer = NumpyWriterAdapter(outfile, backend)
+        self.write_batch_size = self.numpy_writer.advice_batch_buffer_size
+        self.batch_keys = []
+        self.batch_values = []
+        self.total_num = 0
+
+    def write(self, results: typing.List):
+        for x in results:
+            self.batch_keys.append('input{}'.format(self.total_num))
+            self.batch_values.append(x)
+            self.total_num += 1
+            if len(self.batch_values) >= self.write_batch_size:
+                self.flush()
+
+    def flush(self):
+        if self.numpy_writer.is_kv_writer:
+            self.numpy_writer.writer.put_batch(self.batch_keys, self.batch_values)
+        else:
+            self.numpy_writer.writer.write_batch(self.batch_values)
+        self.batch_keys.clear()
+        self.batch_values.clear()
+
+    def close(self):
+        if self.batch_values:
+            self.flush()
+        if self.numpy_writer.is_kv_writer:
+            self.numpy_writer.writer.file_writer.put('total_num', str(self.total_num))
+        self.numpy_writer.close()
+
+
+def _init_stream_worker(helper):
+    global _worker_helper
+    _worker_helper = helper
+
+
+def _build_block(start: int, data: typing.List, mode: str, side_output_keys: typing.Sequence[str]):
+    helper = _worker_helper
+    for k in side_output_keys:
+        setattr(helper, k, [])
+    if hasattr(helper, 'index'):
+        helper.index = start - 1
+    return _process_examples(helper, data, mode), {k: getattr(helper, k) for k in side_output_keys}
+
+
+def make_dataset_stream(data_helper, outfile: typing.Union[str, list], data: typing.Iterable, mode: str,
+                        num_process_worker: int = 0, shuffle: bool = False,
+                        side_output_keys: typing.Sequence[str] = ('eval_labels',),
+                        stream_block_size: int = 4096):
+    '''
+        data: 可迭代对象, 逐块读取, 不需要 len(data)
+        shuffle: 只在每块内打乱
+    '''
+    side_output_keys = [k for k in side_output_keys if isinstance(getattr(data_helper, k, None), list)]
+    targets = {k: getattr(data_helper, k) for k in side_output_keys}
+    it = iter(data)
+    blocks = iter(lambda: list(itertools.islice(it, stream_block_size)), [])
+
+    data_helper.on_data_ready()
+    writer = _StreamWriter(outfile, data_helper.backend)
+    try:
+        if num_process_worker <= 1 or 'fork' not in multiprocessing.get_all_start_methods():
+            for block in blocks:
+                if shuffle:
+                    random.shuffle(block)
+                writer.write(_process_examples(data_helper, block, mode))
+            return
+
+        def _write(outputs):
+            results, side_outputs = outputs
+            writer.write(results)
+            # 原地追加, 保持已传给模型的列表引用
+            for k in side_output_keys:
+                targets[k].extend(side_outputs[k])
+
+        pending = collections.deque()
+        start = 0
+        with multiprocessing.get_context('fork').Pool(num_process_worker, initializer=_init_stream_worker,
+                                                     initargs=(data_helper,)) as pool:
+            for block in blocks:
+                if shuffle:
+                    random.shuffle(block)
+                pending.append(pool.apply_async(_build_block, (start, block, mode, side_output_keys)))
+                start += len(block)
+                if len(pending) >= 2 * num_process_worker:
+                    _write(pending.popleft().get())
+            while pending:
+                _write(pending.popleft().get())
+    finally:
+        writer.close()
+        data_helper.on_data_finalize()
+
+
+class ParallelDataHelperMixin:
+    '''
+        DataHelper 混入类, make_dataset_with_args(..., num_process_worker=n) 时按区间多进程制作缓存
+        class NN_DataHelper(ParallelDataHelperMixin, DataHelper): ...
+        num_process_worker <= 1 或不支持 fork 时退回 DataHelper.make_dataset
+        on_get_corpus 返回生成器时调用 make_dataset_stream
+    '''
+    side_output_keys = ('eval_labels',)
+    stream_block_size = 4096
+
+    def make_dataset(self, outfile, data, input_fn_args, num_process_worker: int = 0, shuffle: bool = True):
+        if not isinstance(data, (list, tuple)):
+            return make_dataset_stream(self, outfile, data, input_fn_args, num_process_worker, shuffle=shuffle,
+                                       side_output_keys=self.side_output_keys,
+                                       stream_block_size=self.stream_block_size)
+        if num_process_worker <= 1 or len(data) < 2 or 'fork' not in multiprocessing.get_all_start_methods():
+            return super(ParallelDataHelperMixin, self).make_dataset(outfile, data, input_fn_args,
+                                                                     num_process_worker=0, shuffle=shuffle)
+        make_dataset_parallel(self, outfile, data, input_fn_args, num_process_worker, shuffle=shuffle,
+                              side_output_keys=self.side_output_keys)
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+# 带指纹的增量缓存
+# make_dataset_with_args 原来只判断缓存文件是否存在, tokenizer / max_seq_length / 标签 / 处理代码改变后仍复用旧缓存
+# 指纹 = 输入文件 sha1 + 词表 hash + 相关参数 + on_data_process 等方法源码 hash , 保存在 {缓存文件}.fingerprint.json
+#   指纹一致: 跳过制作
+#   append=True 且输入文件只在末尾追加了行 (或新增了文件): 只处理新增的行, 写入 {缓存文件}.append-00001 等分片
+#   其他变化: 全量重新制作, 删除旧分片
+# 输入文件 size 与 mtime 未变时沿用记录的 sha1 , 不重新读文件
+
+import glob
+import hashlib
+import inspect
+import json
+import logging
+import os
+import shutil
+import tempfile
+import typing
+
+__all__ = [
+    'hash_file',
+    'get_vocab_hash',
+    'get_source_hash',
+    'load_fingerprint',
+    'FingerprintCacheMixin',
+]
+
+_FINGERPRINT_SUFFIX = '.fingerprint.json'
+
+
+def hash_file(filename: str, prefix_size: typing.Optional[int] = None, block_size: int = 16 * 1024 * 1024):
+    '''
+        返回 (前 prefix_size 字节的 sha1 , 整个文件的 sha1) , 只读一遍文件
+    '''
+    h = hashlib.sha1()
+    prefix_sha1 = None
+    n = 0
+    with open(filename, mode='rb') as f:
+        while True:
+            size = block_size
+            if prefix_sha1 is None and prefix_size is not None:
+                size = min(block_size, prefix_size - n)
+                if size == 0:
+                    prefix_sha1 = h.hexdigest()
+                    continue
+            buf = f.read(size)
+            if not buf:
+                break
+            h.update(buf)
+            n += len(buf)
+    full_sha1 = h.hexdigest()
+    if prefix_size is not None and prefix_sha1 is None:
+        prefix_sha1 = full_sha1 if n == prefix_size else None
+    return prefix_sha1, full_sha1
+
+
+def get_vocab_hash(tokenizer):
+    vocab = sorted(tokenizer.get_vocab().items())
+    added = sorted(getattr(tokenizer, 'added_tokens_encoder', {}).items())
+    o = [vocab, added, getattr(tokenizer, 'do_lower_case', None), type(tokenizer).__name__]
+    return hashlib.sha1(json.dumps(o, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+def get_source_hash(obj):
+    try:
+        source = inspect.getsource(obj)
+    except (OSError, TypeError):
+        code = getattr(obj, '__code__', None)
+        source = repr((code.co_code, code.co_consts)) if code is not None else repr(obj)
+    return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+
+def _fingerprint_file(outfile: str):
+    return outfile + _FINGERPRINT_SUFFIX
+
+
+def load_fingerprint(outfile: str):
+    filename = _fingerprint_file(outfile)
+    if not os.path.exists(filename):
+        return None
+    with open(filename, mode='r', encoding='utf-8') as f:
+        return json.loads(f.read())
+
+
+def _save_fingerprint(outfile: str, meta: dict):
+    with open(_fingerprint_file(outfile), mode='w', encoding='utf-8', newline='\n') as f:
+        f.write(json.dumps(meta, ensure_ascii=False, indent=2))
+
+
+def _remove_output(path: str):
+    # 分片本身及其旁路文件 (schema.json , .INDEX 等)
+    dirname, basename = os.path.split(path)
+    for p in [path] + glob.glob(os.path.join(glob.escape(dirname), glob.escape(basename) + '.*')) + \
+             glob.glob(os.path.join(glob.escape(dirname), '.' + glob.escape(basename) + '*')):
+        if os.path.isdir(p):
+            shutil.rmtree(p, ignore_errors=True)
+        elif os.path.exists(p):
+            os.remove(p)
+
+
+def _get_file_states(files: typing.List[str], old_states: typing.Dict):
+    '''
+        返回 (新状态, 新增内容)
+        新增内容: path -> 起始字节 , 只在末尾追加时有效, 否则为 None
+    '''
+    states, appended = {}, {}
+    for path in files:
+        st = os.stat(path)
+        old = old_states.get(path)
+        if old is not None and old['size'] == st.st_size and old['mtime_ns'] == st.st_mtime_ns:
+            states[path] = old
+            continue
+        if old is not None and st.st_size > old['size'] > 0:
+            prefix_sha1, sha1 = hash_file(path, prefix_size=old['size'])
+            with open(path, mode='rb') as f:
+                f.seek(old['size'] - 1)
+                ends_with_newline = f.read(1) == b'\n'
+            if prefix_sha1 == old['sha1'] and ends_with_newline:
+                appended[path] = old['size']
+            elif sha1 != old['sha1']:
+                appended[path] = None
+        else:
+            _, sha1 = hash_file(path)
+            if old is None:
+                appended[path] = 0
+            elif sha1 != old['sha1']:
+                appended[path] = None
+        states[path] = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sha1': sha1}
+    return states, appended
+
+
+class FingerprintCacheMixin:
+    '''
+        DataHelper 混入类, make_dataset_with_args 按指纹复用或增量制作本地文件缓存
+        class NN_DataHelper(FingerprintCacheMixin, ParallelDataHelperMixin, DataHelper): ...
+        make_dataset_with_args(..., append=True) 只处理输入文件新增的行
+        memory 后端或 convert_file=False 时与 DataHelper.make_dataset_with_args 一致
+    '''
+    # 影响缓存内容的方法, 源码 hash 计入指纹
+    fingerprint_methods = ('on_data_process', 'on_data_process_compact', 'on_get_corpus')
+
+    def get_fingerprint_args(self, mode: str) -> typing.Dict:
+        '''
+            计入指纹的参数, 子类可追加 (如 data_conf)
+        '''
+        data_args = self.data_args
+        return {
+            'mode': mode,
+            'max_seq_length': self.max_seq_length_dict.get(mode),
+            'max_target_length': getattr(data_args, 'max_target_length', None),
+            'data_backend': data_args.data_backend,
+            'label2id': self.label2id,
+        }
+
+    def get_fingerprint_components(self, mode: str) -> typing.Dict:
+        sources = {}
+        for cls in type(self).__mro__:
+            for name in self.fingerprint_methods:
+                if name in cls.__dict__:
+                    sources['{}.{}'.format(cls.__qualname__, name)] = get_source_hash(cls.__dict__[name])
+        return {
+            'vocab': get_vocab_hash(self.tokenizer) if self.tokenizer is not None else None,
+            'args': json.loads(json.dumps(self.get_fingerprint_args(mode), ensure_ascii=False, default=str)),
+            'sources': sources,
+        }
+
+    def make_dataset_with_fingerprint(self, outfile: str, input_files: typing.List[str], mode: str,
+                                      shuffle=False, num_process_worker: int = 0, overwrite: bool = False,
+                                      append: bool = False) -> typing.List[str]:
+        '''
+            返回缓存文件及追加分片
+        '''
+        meta = None if overwrite else load_fingerprint(outfile)
+        components = self.get_fingerprint_components(mode)
+        if meta is not None and (meta['components'] != components or not os.path.exists(outfile)
+                                 or set(meta['files']) - set(input_files)):
+            logging.info('fingerprint changed {}'.format(outfile))
+            meta = None
+        states, appended = _get_file_states(input_files, meta['files'] if meta is not None else {})
+
+        if meta is not None and not appended:
+            logging.info('fingerprint matched, skip {}'.format(outfile))
+            if meta['files'] != states:
+                meta['files'] = states
+                _save_fingerprint(outfile, meta)
+            return [outfile] + meta['shards']
+
+        if meta is not None and append and all(v is not None for v in appended.values()):
+            shard = '{}.append-{:05d}'.format(outfile, len(meta['shards']) + 1)
+            logging.info('append {} new lines -> {}'.format(','.join(appended), shard))
+            tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(outfile)))
+            try:
+                files = []
+                for path, start in appended.items():
+                    if start == 0:
+                        files.append(path)
+                        continue
+                    tail_file = os.path.join(tmp_dir, '{}_{}'.format(len(files), os.path.basename(path)))
+                    with open(path, mode='rb') as f_in, open(tail_file, mode='wb') as f_out:
+                        f_in.seek(start)
+                        shutil.copyfileobj(f_in, f_out, length=16 * 1024 * 1024)
+                    files.append(tail_file)
+                data = self.on_get_corpus(files, mode)
+                self.make_dataset(shard, data, mode, num_process_worker=num_process_worker, shuffle=shuffle)
+            finally:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+            meta['shards'].append(shard)
+            meta['files'] = states
+            _save_fingerprint(outfile, meta)
+            return [outfile] + meta['shards']
+
+        old_meta = load_fingerprint(outfile)
+        for shard in (old_meta['shards'] if old_meta is not None else []):
+            _remove_output(shard)
+        data = self.on_get_corpus(input_files, mode)
+        self.make_dataset(outfile, data, mode, num_process_worker=num_process_worker, shuffle=shuffle)
+        _save_fingerprint(outfile, {'components': components, 'files': states, 'shards': []})
+        return [outfile]
+
+    def make_dataset_with_args(self, input_files, mode, shuffle=False, num_process_worker: int = 0,
+                               overwrite: bool = False, mixed_data=True, dupe_factor=1, append: bool = False):
+        '''
+            参数与 DataHelper.make_dataset_with_args 一致
+            append: 输入文件只在末尾追加时, 新增的行写入追加分片, 否则全量重新制作
+        '''
+        data_args = self.data_args
+        if not data_args.convert_file or data_args.data_backend.startswith('memory') or not input_files \
+                or not all(os.path.isfile(f) for f in input_files):
+            return super(FingerprintCacheMixin, self).make_dataset_with_args(input_files, mode, shuffle=shuffle,
+                                                                             num_process_worker=num_process_worker,
+                                                                             overwrite=overwrite,
+                                                                             mixed_data=mixed_data,
+                                                                             dupe_factor=dupe_factor)
+        logging.info('make_dataset {} {}...'.format(','.join(input_files), mode))
+        if mode == 'train':
+            contain_objs = self.train_files
+        elif mode == 'eval' or mode == 'val':
+            contain_objs = self.eval_files
+        elif mode == 'test' or mode == 'predict':
+            contain_objs = self.test_files
+        else:
+            raise ValueError('{} invalid ', mode)
+
+        for i in range(dupe_factor):
+            if mixed_data:
+                groups = [(data_args.intermediate_name + '_dupe_factor_{}'.format(i), input_files)]
+            else:
+                groups = [(data_args.intermediate_name + '_file_{}_dupe_factor_{}'.format(fid, i), [input_item])
+                          for fid, input_item in enumerate(input_files)]
+            for intermediate_name, files in groups:
+                intermediate_output = self.get_intermediate_file(intermediate_name, mode)
+                contain_objs.extend(self.make_dataset_with_fingerprint(intermediate_output, files, mode,
+                                                                       shuffle=shuffle,
+                                                                       num_process_worker=num_process_worker,
+                                                                       overwrite=overwrite, append=append))
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+# gplinker 稀疏目标编码
+# 缓存中每组标签只保存 (n, 3) int32 -> (label, start, end), 按 label 排序
+# collate_fn 中按批次真实 max_tarlen 还原为 (bs, num_labels, max_tarlen, 2)
+
+import typing
+
+import numpy as np
+import torch
+
+__all__ = [
+    'encode_sparse_labels',
+    'get_target_len',
+    'densify_sparse_labels',
+]
+
+
+def encode_sparse_labels(pts_list: typing.List[typing.Iterable]):
+    '''
+        pts_list: 每个 label 的 (start, end) 集合
+        return: (n, 3) int32
+    '''
+    rows = [(label, pos[0], pos[1]) for label, pts in enumerate(pts_list) for pos in pts]
+    return np.asarray(rows, dtype=np.int32).reshape((-1, 3))
+
+
+def _get_slots(labels):
+    # labels 已排序, 同一 label 内的序号
+    return np.arange(len(labels)) - np.searchsorted(labels, labels, side='left')
+
+
+def get_target_len(sparse_list: typing.List[np.ndarray]):
+    '''
+        批次内单个 label 的最大目标数, 最小为 1
+    '''
+    target_len = 1
+    for sparse in sparse_list:
+        sparse = np.asarray(sparse).reshape((-1, 3))
+        if len(sparse):
+            target_len = max(target_len, int(_get_slots(sparse[:, 0]).max()) + 1)
+    return target_len
+
+
+def densify_sparse_labels(sparse_list: typing.List[np.ndarray], num_labels: int, max_tarlen: int = None):
+    '''
+        sparse_list: 每个样本 (n, 3)
+        return: (bs, num_labels, max_tarlen, 2) int32
+    '''
+    sparse_list = [np.asarray(sparse, dtype=np.int32).reshape((-1, 3)) for sparse in sparse_list]
+    if max_tarlen is None:
+        max_tarlen = get_target_len(sparse_list)
+    dense = np.zeros((len(sparse_list), num_labels, max_tarlen, 2), dtype=np.int32)
+    b = np.repeat(np.arange(len(sparse_list)), [len(sparse) for sparse in sparse_list])
+    if len(b):
+        slots = np.concatenate([_get_slots(sparse[:, 0]) for sparse in sparse_list])
+        sparse = np.concatenate(sparse_list, axis=0)
+        dense[b, sparse[:, 0], slots] = sparse[:, 1:]
+    return torch.from_numpy(dense)
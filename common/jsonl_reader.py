@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+# 流式读取 jsonl 语料
+# 文件按换行对齐切成若干字节区间 (chunk_size), 每个区间单独读取解析, 不再 f.readlines() 后整体 json.loads
+# num_process_worker > 1 时多进程解析区间, 按文件及区间顺序产出, 同时在途的区间不超过 max_pending 个
+# 峰值内存约为 chunk_size * max_pending , 与语料大小无关
+# 安装 orjson 时用 orjson.loads 解析
+
+import collections
+import json
+import multiprocessing
+import os
+import typing
+
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+__all__ = [
+    'json_loads',
+    'split_byte_ranges',
+    'read_jsonl_range',
+    'iter_jsonl',
+]
+
+_worker_parse_fn = None
+
+
+def split_byte_ranges(filename: str, chunk_size: int = 8 * 1024 * 1024) -> typing.List[typing.Tuple[int, int]]:
+    '''
+        [start, end) 区间, 除最后一个外均以换行结尾
+    '''
+    file_size = os.path.getsize(filename)
+    ranges = []
+    start = 0
+    with open(filename, mode='rb') as f:
+        while start < file_size:
+            f.seek(min(start + chunk_size, file_size))
+            f.readline()
+            end = min(f.tell(), file_size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def read_jsonl_range(filename: str, start: int, end: int, parse_fn: typing.Optional[typing.Callable] = None):
+    '''
+        解析 [start, end) 内的每一行, 跳过空行及空对象
+        parse_fn: jd -> 样本, 返回 None 时跳过
+    '''
+    with open(filename, mode='rb') as f:
+        f.seek(start)
+        buf = f.read(end - start)
+    D = []
+    for line in buf.splitlines():
+        if not line.strip():
+            continue
+        jd = json_loads(line)
+        if not jd:
+            continue
+        if parse_fn is not None:
+            jd = parse_fn(jd)
+            if jd is None:
+                continue
+        D.append(jd)
+    return D
+
+
+def _init_worker(parse_fn):
+    global _worker_parse_fn
+    _worker_parse_fn = parse_fn
+
+
+def _read_range_worker(filename, start, end):
+    return read_jsonl_range(filename, start, end, _worker_parse_fn)
+
+
+def iter_jsonl(files: typing.Union[str, typing.List[str]],
+               parse_fn: typing.Optional[typing.Callable] = None,
+               chunk_size: int = 8 * 1024 * 1024,
+               num_process_worker: int = 0,
+               max_pending: typing.Optional[int] = None):
+    '''
+        逐条产出 parse_fn(jd) , 顺序与文件内容一致
+        parse_fn: fork 子进程直接继承, 可以是 lambda 或绑定方法
+        max_pending: 同时在途的区间数, 默认 2 * num_process_worker
+    '''
+    if isinstance(files, str):
+        files = [files]
+    tasks = ((filename, start, end) for filename in files for start, end in split_byte_ranges(filename, chunk_size))
+    if num_process_worker <= 1 or 'fork' not in multiprocessing.get_all_start_methods():
+        for task in tasks:
+            yield from read_jsonl_range(*task, parse_fn=parse_fn)
+        return
+
+    max_pending = max_pending or 2 * num_process_worker
+    pending = collections.deque()
+    with multiprocessing.get_context('fork').Pool(num_process_worker, initializer=_init_worker,
+                                                 initargs=(parse_fn,)) as pool:
+        for task in tasks:
+            pending.append(pool.apply_async(_read_range_worker, task))
+            if len(pending) >= max_pending:
+                yield from pending.popleft().get()
+        while pending:
+            yield from pending.popleft().get()
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+# 因果语言模型预训练的文档打包
+# 多篇已分词文档以分隔符拼接, 切分为 block_size 的满长度 block , 只有每组最后一个 block 需要 padding
+# 可选: position_ids 在每篇文档起始处重置 ; doc_ids 在 collate_fn 中展开为块对角因果 attention_mask
+
+import typing
+
+import numpy as np
+import torch
+
+__all__ = [
+    'pack_documents',
+    'build_block_diagonal_mask',
+]
+
+
+def pack_documents(docs: typing.List[typing.List[int]], block_size: int, sep_token_id: int, pad_token_id: int,
+                   docs_token_type_ids: typing.Optional[typing.List[typing.List[int]]] = None,
+                   reset_position_ids=True, with_doc_ids=False):
+    '''
+        docs: 每篇文档的 input_ids , 末尾不是 sep_token_id 时补一个
+        文档超出 block 时跨 block 继续, 不截断
+        return: 记录列表, 每条含 input_ids, attention_mask, labels (padding 为 -100), seqlen
+                以及可选的 token_type_ids, position_ids, doc_ids (block 内文档序号, padding 为 -1)
+    '''
+    docs = [np.asarray(d, dtype=np.int64) for d in docs]
+    docs = [d for d in docs if len(d)]
+    if not docs:
+        return []
+    need_sep = [d[-1] != sep_token_id for d in docs]
+    input_ids = np.concatenate([np.append(d, sep_token_id) if s else d for d, s in zip(docs, need_sep)])
+    doc_lens = np.asarray([len(d) + int(s) for d, s in zip(docs, need_sep)], dtype=np.int64)
+    doc_ids = np.repeat(np.arange(len(docs), dtype=np.int64), doc_lens)
+    if docs_token_type_ids is not None:
+        token_type_ids = np.concatenate([np.append(np.asarray(t, dtype=np.int64), t[-1]) if s
+                                         else np.asarray(t, dtype=np.int64)
+                                         for t, s in zip(docs_token_type_ids, need_sep)])
+    else:
+        token_type_ids = None
+
+    total = len(input_ids)
+    num_blocks = (total + block_size - 1) // block_size
+    pad_len = num_blocks * block_size - total
+    if pad_len:
+        input_ids = np.pad(input_ids, (0, pad_len), 'constant', constant_values=(pad_token_id, pad_token_id))
+        doc_ids = np.pad(doc_ids, (0, pad_len), 'constant', constant_values=(-1, -1))
+        if token_type_ids is not None:
+            token_type_ids = np.pad(token_type_ids, (0, pad_len), 'constant', constant_values=(0, 0))
+
+    input_ids = input_ids.reshape((num_blocks, block_size))
+    doc_ids = doc_ids.reshape((num_blocks, block_size))
+    valid = doc_ids >= 0
+    attention_mask = valid.astype(np.int64)
+    labels = np.where(valid, input_ids, -100)
+    seqlens = valid.sum(axis=1)
+
+    # 每个 block 内文档起始处 (含 block 首 token) 位置重置为 0
+    starts = np.ones_like(valid)
+    starts[:, 1:] = doc_ids[:, 1:] != doc_ids[:, :-1]
+    index = np.broadcast_to(np.arange(block_size, dtype=np.int64), (num_blocks, block_size))
+    position_ids = index - np.maximum.accumulate(np.where(starts, index, 0), axis=1)
+    # block 内文档重新编号
+    local_doc_ids = np.where(valid, np.cumsum(starts, axis=1) - 1, -1)
+
+    records = []
+    for i in range(num_blocks):
+        d = {
+            'input_ids': input_ids[i],
+            'attention_mask': attention_mask[i],
+        }
+        if token_type_ids is not None:
+            d['token_type_ids'] = token_type_ids[i * block_size: (i + 1) * block_size]
+        if reset_position_ids:
+            d['position_ids'] = position_ids[i]
+        if with_doc_ids:
+            d['doc_ids'] = local_doc_ids[i]
+        d['labels'] = labels[i]
+        d['seqlen'] = np.asarray(seqlens[i], dtype=np.int64)
+        records.append(d)
+    return records
+
+
+def build_block_diagonal_mask(doc_ids: torch.Tensor):
+    '''
+        doc_ids: (bs, seq_len) , padding 为 -1
+        return: (bs, 1, seq_len, seq_len) bool , 只注意同一文档内当前及之前的 token
+    '''
+    seq_len = doc_ids.size(1)
+    causal = torch.ones((seq_len, seq_len), dtype=torch.bool, device=doc_ids.device).tril()
+    mask = (doc_ids.unsqueeze(-1) == doc_ids.unsqueeze(-2)) & causal
+    return mask.unsqueeze(1)
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+# MLM 动态全词掩码
+# 缓存只保存未掩码的 input_ids, 掩码在 collate_fn (DataLoader worker) 中生成, 每个 epoch 掩码不同
+# 与 deep_training.utils.maskedlm.make_mlm_wwm_sample 语义一致:
+#   ## 开头的 token 与前一个 token 组成整词, [CLS] / [SEP] 不参与
+#   num_to_predict = min(max_predictions_per_seq, max(1, round(seqlen * masked_lm_prob)))
+#   整词超出剩余预测数时跳过, 80% [MASK] / 10% 原词 / 10% 随机词
+
+import typing
+
+import numpy as np
+import torch
+from torch.utils.data import get_worker_info
+
+__all__ = [
+    'DynamicWwmMasker',
+    'build_mlm_labels',
+    'make_mlm_sample',
+]
+
+
+class DynamicWwmMasker:
+    '''
+        每个 worker 使用独立的随机数生成器, 种子为 seed + torch worker seed
+        torch 每个 epoch 重新生成 worker seed, 因此各 epoch 掩码不同
+    '''
+
+    def __init__(self, tokenizer, do_whole_word_mask=True, max_predictions_per_seq=20, masked_lm_prob=0.15,
+                 seed=None):
+        vocab = tokenizer.get_vocab()
+        self.vocab_size = len(vocab)
+        self.mask_token_id = tokenizer.mask_token_id
+        self.special_ids = np.asarray([tokenizer.cls_token_id, tokenizer.sep_token_id], dtype=np.int64)
+        self.do_whole_word_mask = do_whole_word_mask
+        self.max_predictions_per_seq = max_predictions_per_seq
+        self.masked_lm_prob = masked_lm_prob
+        self.seed = seed
+        # 词表 id -> 是否为 ## 子词
+        self.is_subword = np.zeros(max(vocab.values()) + 1, dtype=np.bool_)
+        for token, i in vocab.items():
+            if token.startswith('##'):
+                self.is_subword[i] = True
+        self._rng = None
+        self._worker_seed = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_rng'] = None
+        state['_worker_seed'] = None
+        return state
+
+    def get_rng(self):
+        worker_info = get_worker_info()
+        worker_seed = worker_info.seed if worker_info is not None else None
+        if self._rng is None or worker_seed != self._worker_seed:
+            self._worker_seed = worker_seed
+            if worker_seed is None:
+                self._rng = np.random.default_rng(self.seed)
+            else:
+                self._rng = np.random.default_rng([self.seed or 0, worker_seed % (2 ** 32)])
+        return self._rng
+
+    def get_cand_groups(self, input_ids: np.ndarray):
+        '''
+            return: 每个整词的 token 位置列表
+        '''
+        valid = ~np.isin(input_ids, self.special_ids)
+        positions = np.nonzero(valid)[0]
+        if not len(positions):
+            return []
+        starts = np.ones(len(positions), dtype=np.bool_)
+        if self.do_whole_word_mask:
+            starts[1:] = ~self.is_subword[input_ids[positions[1:]]]
+        return np.split(positions, np.nonzero(starts)[0][1:])
+
+    def mask_example(self, input_ids: np.ndarray, seqlen: int):
+        '''
+            input_ids: 未掩码 token id
+            return: masked_input_ids, mask (被预测位置为 1)
+        '''
+        rng = self.get_rng()
+        input_ids = np.asarray(input_ids, dtype=np.int64)
+        masked_input_ids = input_ids.copy()
+        mask = np.zeros_like(input_ids)
+        cand_groups = self.get_cand_groups(input_ids[:seqlen])
+        num_to_predict = min(self.max_predictions_per_seq, max(1, int(round(seqlen * self.masked_lm_prob))))
+
+        num_masked = 0
+        for g in rng.permutation(len(cand_groups)):
+            if num_masked >= num_to_predict:
+                break
+            index_set = cand_groups[g]
+            if num_masked + len(index_set) > num_to_predict:
+                continue
+            for index in index_set:
+                r = rng.random()
+                if r < 0.8:
+                    masked_input_ids[index] = self.mask_token_id
+                elif r >= 0.9:
+                    masked_input_ids[index] = rng.integers(0, self.vocab_size)
+                mask[index] = 1
+            num_masked += len(index_set)
+        return masked_input_ids, mask
+
+    def __call__(self, input_ids: typing.Union[torch.Tensor, np.ndarray], seqlens: typing.Iterable[int]):
+        '''
+            整批向量化, 与逐条 mask_example 语义一致
+            input_ids: (bs, seq_len) 未掩码 token id
+            return: input_ids, labels, mask , labels 为原始 token id , 损失只计算 mask 位置
+        '''
+        rng = self.get_rng()
+        input_ids = np.asarray(input_ids, dtype=np.int64)
+        bs, seq_len = input_ids.shape
+        seqlens = np.asarray(seqlens, dtype=np.int64).reshape((bs, 1))
+
+        valid = (np.arange(seq_len)[None, :] < seqlens) & ~np.isin(input_ids, self.special_ids)
+        # 整词起始: 非 ## 子词, 或该行第一个有效 token
+        starts = valid & (np.cumsum(valid, axis=1) == 1)
+        if self.do_whole_word_mask:
+            starts |= valid & ~self.is_subword[input_ids]
+        else:
+            starts = valid
+        group_ids = np.cumsum(starts, axis=1) - 1
+        num_groups = starts.sum(axis=1)
+        rows = np.broadcast_to(np.arange(bs)[:, None], (bs, seq_len))
+        group_sizes = np.bincount((rows * seq_len + group_ids)[valid], minlength=bs * seq_len).reshape((bs, seq_len))
+
+        # 每行整词随机排列, 不存在的整词排在最后
+        keys = rng.random((bs, seq_len))
+        keys[np.arange(seq_len)[None, :] >= num_groups[:, None]] = np.inf
+        order = np.argsort(keys, axis=1)
+        sorted_sizes = np.take_along_axis(group_sizes, order, axis=1)
+
+        num_to_predict = np.minimum(self.max_predictions_per_seq,
+                                    np.maximum(1, np.round(seqlens[:, 0] * self.masked_lm_prob).astype(np.int64)))
+        num_masked = np.zeros(bs, dtype=np.int64)
+        taken = np.zeros((bs, seq_len), dtype=np.bool_)
+        for j in range(int(num_groups.max(initial=0))):
+            done = (num_masked >= num_to_predict) | (j >= num_groups)
+            if done.all():
+                break
+            ok = ~done & (num_masked + sorted_sizes[:, j] <= num_to_predict)
+            taken[:, j] = ok
+            num_masked += sorted_sizes[:, j] * ok
+
+        selected = np.zeros((bs, seq_len), dtype=np.bool_)
+        np.put_along_axis(selected, order, taken, axis=1)
+        mask = valid & np.take_along_axis(selected, np.maximum(group_ids, 0), axis=1)
+
+        r = rng.random((bs, seq_len))
+        masked_input_ids = np.where(mask & (r < 0.8), self.mask_token_id, input_ids)
+        random_ids = rng.integers(0, self.vocab_size, size=(bs, seq_len))
+        masked_input_ids = np.where(mask & (r >= 0.9), random_ids, masked_input_ids)
+        return (torch.from_numpy(masked_input_ids), torch.from_numpy(input_ids),
+                torch.from_numpy(mask.astype(np.int64)))
+
+
+def build_mlm_labels(input_ids: torch.Tensor, masked_lm_positions: torch.Tensor, masked_lm_ids: torch.Tensor,
+                     masked_lm_weights: torch.Tensor):
+    '''
+        静态掩码缓存 (make_mlm_wwm_sample) 的 labels / mask , 整批一次 scatter
+        return: labels, mask
+    '''
+    weights = masked_lm_weights > 0
+    rows = torch.arange(input_ids.size(0), device=input_ids.device).unsqueeze(-1).expand_as(masked_lm_positions)
+    rows, positions = rows[weights], masked_lm_positions[weights].long()
+    labels = torch.clone(input_ids)
+    labels[rows, positions] = masked_lm_ids[weights].to(labels.dtype)
+    mask = torch.zeros_like(input_ids)
+    mask[rows, positions] = 1
+    return labels, mask
+
+
+def make_mlm_sample(text: str, tokenizer, max_seq_length):
+    '''
+        缓存阶段只分词, 不做掩码
+    '''
+    o = tokenizer(text, add_special_tokens=True, truncation=True,
+                  max_length=max_seq_length,
+                  return_token_type_ids=False,
+                  return_attention_mask=False)
+    input_ids = np.asarray(o['input_ids'], dtype=np.int64)
+    attention_mask = np.ones_like(input_ids, dtype=np.int64)
+    seqlen = np.asarray(len(input_ids), dtype=np.int64)
+    pad_len = max_seq_length - len(input_ids)
+    if pad_len > 0:
+        pad_val = tokenizer.pad_token_id
+        input_ids = np.pad(input_ids, (0, pad_len), 'constant', constant_values=(pad_val, pad_val))
+        attention_mask = np.pad(attention_mask, (0, pad_len), 'constant', constant_values=(0, 0))
+    return {
+        'input_ids': input_ids,
+        'attention_mask': attention_mask,
+        'seqlen': seqlen
+    }
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+# encoder-decoder 批量生成 (T5 等 AutoModelForSeq2SeqLM)
+# 每个批次编码器只运行一次, 解码器使用 past_key_values 增量解码
+# 解码循环内全部在设备上计算, 仅每步同步一次结束标记用于提前停止
+
+import typing
+
+import torch
+
+__all__ = [
+    'greedy_generate',
+    'beam_generate',
+    'decode_tokens',
+    'batch_generate_ids',
+    'batch_generate_text',
+]
+
+
+def _reorder_past(past_key_values, beam_idx):
+    if hasattr(past_key_values, 'reorder_cache'):
+        past_key_values.reorder_cache(beam_idx)
+        return past_key_values
+    return tuple(tuple(p.index_select(0, beam_idx) for p in layer) for layer in past_key_values)
+
+
+def _encode(model, input_ids, attention_mask):
+    encoder_outputs = model.get_encoder()(input_ids=input_ids, attention_mask=attention_mask, return_dict=True)
+    return encoder_outputs
+
+
+def _decode_step(model, encoder_outputs, attention_mask, decoder_input_ids, past_key_values):
+    outputs = model(encoder_outputs=encoder_outputs,
+                    attention_mask=attention_mask,
+                    decoder_input_ids=decoder_input_ids,
+                    past_key_values=past_key_values,
+                    use_cache=True,
+                    return_dict=True)
+    return outputs.logits[:, -1], outputs.past_key_values
+
+
+@torch.no_grad()
+def greedy_generate(model, input_ids, attention_mask, max_target_length, decoder_start_token_id,
+                    eos_token_id, pad_token_id=0):
+    '''
+        return: (bs, <= max_target_length) 不含起始 token, 结束后以 pad_token_id 填充
+    '''
+    bs = input_ids.size(0)
+    device = input_ids.device
+    encoder_outputs = _encode(model, input_ids, attention_mask)
+
+    output_ids = torch.full((bs, max_target_length), pad_token_id, dtype=torch.long, device=device)
+    finished = torch.zeros(bs, dtype=torch.bool, device=device)
+    next_ids = torch.full((bs, 1), decoder_start_token_id, dtype=torch.long, device=device)
+    past_key_values = None
+    step = 0
+    for step in range(max_target_length):
+        logits, past_key_values = _decode_step(model, encoder_outputs, attention_mask, next_ids, past_key_values)
+        next_token = logits.argmax(-1)
+        next_token = next_token.masked_fill(finished, pad_token_id)
+        output_ids[:, step] = next_token
+        finished |= next_token == eos_token_id
+        if finished.all():
+            break
+        next_ids = next_token.unsqueeze(-1)
+    return output_ids[:, :step + 1]
+
+
+@torch.no_grad()
+def beam_generate(model, input_ids, attention_mask, max_target_length, decoder_start_token_id,
+                  eos_token_id, pad_token_id=0, num_beams=4, length_penalty=1.0):
+    '''
+        已结束的 beam 分数冻结, 后续只能扩展 pad, 全部 beam 结束时提前停止
+        最终按 score / length ** length_penalty 选出每个样本的最优序列
+        return: (bs, <= max_target_length) 不含起始 token
+    '''
+    bs = input_ids.size(0)
+    device = input_ids.device
+    encoder_outputs = _encode(model, input_ids, attention_mask)
+    encoder_outputs['last_hidden_state'] = encoder_outputs['last_hidden_state'].repeat_interleave(num_beams, dim=0)
+    attention_mask = attention_mask.repeat_interleave(num_beams, dim=0)
+
+    n = bs * num_beams
+    output_ids = torch.full((n, max_target_length), pad_token_id, dtype=torch.long, device=device)
+    lengths = torch.zeros(n, dtype=torch.long, device=device)
+    finished = torch.zeros(n, dtype=torch.bool, device=device)
+    # 初始只保留第一个 beam, 避免重复候选
+    scores = torch.zeros((bs, num_beams), dtype=torch.float, device=device)
+    scores[:, 1:] = -1e9
+    scores = scores.view(-1)
+    batch_offset = (torch.arange(bs, device=device) * num_beams).unsqueeze(-1)
+
+    next_ids = torch.full((n, 1), decoder_start_token_id, dtype=torch.long, device=device)
+    past_key_values = None
+    step = 0
+    for step in range(max_target_length):
+        logits, past_key_values = _decode_step(model, encoder_outputs, attention_mask, next_ids, past_key_values)
+        log_probs = torch.log_softmax(logits.float(), dim=-1)
+        log_probs[finished] = -float('inf')
+        log_probs[finished, pad_token_id] = 0.
+        vocab_size = log_probs.size(-1)
+
+        cand_scores = (scores.unsqueeze(-1) + log_probs).view(bs, num_beams * vocab_size)
+        top_scores, top_idx = cand_scores.topk(num_beams, dim=-1)
+        beam_idx = (torch.div(top_idx, vocab_size, rounding_mode='floor') + batch_offset).view(-1)
+        next_token = (top_idx % vocab_size).view(-1)
+
+        scores = top_scores.view(-1)
+        output_ids = output_ids[beam_idx]
+        output_ids[:, step] = next_token
+        finished = finished[beam_idx]
+        lengths = lengths[beam_idx] + (~finished).long()
+        finished |= next_token == eos_token_id
+        if finished.all():
+            break
+        past_key_values = _reorder_past(past_key_values, beam_idx)
+        next_ids = next_token.unsqueeze(-1)
+
+    norm_scores = scores / lengths.clamp(min=1).float().pow(length_penalty)
+    best = norm_scores.view(bs, num_beams).argmax(-1) + batch_offset.view(-1)
+    return output_ids[best, :step + 1]
+
+
+def decode_tokens(tokenizer, ids: typing.Iterable[int], eos_token_id=None):
+    gen_tokens = []
+    for i in ids:
+        if i == eos_token_id:
+            break
+        if i == tokenizer.pad_token_id:
+            continue
+        token = tokenizer._convert_id_to_token(i)
+        if token.startswith('##'):
+            token = token.replace('##', '')
+        gen_tokens.append(token)
+    return ''.join(gen_tokens)
+
+
+def batch_generate_ids(model, input_ids_list: typing.List[typing.List[int]], max_target_length=100,
+                       batch_size=32, num_beams=1, length_penalty=1.0, device=None,
+                       decoder_start_token_id=None, eos_token_id=None, pad_token_id=0):
+    '''
+        input_ids_list: 未填充的输入 id 序列
+        按长度排序分批减少 padding, 返回每条生成 id (不含起始 token, 截止到 eos 之前), 顺序与输入一致
+    '''
+    if device is None:
+        device = next(model.parameters()).device
+    if decoder_start_token_id is None:
+        decoder_start_token_id = model.config.decoder_start_token_id
+    if eos_token_id is None:
+        eos_token_id = model.config.eos_token_id
+
+    order = sorted(range(len(input_ids_list)), key=lambda i: len(input_ids_list[i]), reverse=True)
+    results = [None] * len(input_ids_list)
+
+    is_training = model.training
+    model.eval()
+    for start in range(0, len(order), batch_size):
+        idx = order[start: start + batch_size]
+        max_len = max(len(input_ids_list[i]) for i in idx)
+        input_ids = torch.full((len(idx), max_len), pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(idx), max_len), dtype=torch.long)
+        for j, i in enumerate(idx):
+            seqlen = len(input_ids_list[i])
+            input_ids[j, :seqlen] = torch.as_tensor(input_ids_list[i], dtype=torch.long)
+            attention_mask[j, :seqlen] = 1
+        input_ids = input_ids.to(device)
+        attention_mask = attention_mask.to(device)
+        if num_beams > 1:
+            output_ids = beam_generate(model, input_ids, attention_mask, max_target_length, decoder_start_token_id,
+                                       eos_token_id, pad_token_id, num_beams=num_beams,
+                                       length_penalty=length_penalty)
+        else:
+            output_ids = greedy_generate(model, input_ids, attention_mask, max_target_length,
+                                         decoder_start_token_id, eos_token_id, pad_token_id)
+        for i, ids in zip(idx, output_ids.cpu().tolist()):
+            if eos_token_id in ids:
+                ids = ids[:ids.index(eos_token_id)]
+            results[i] = ids
+    model.train(is_training)
+    return results
+
+
+def batch_generate_text(model, tokenizer, texts: typing.List[str], max_seq_length=512, max_target_length=100,
+                        batch_size=32, num_beams=1, length_penalty=1.0, device=None,
+                        decoder_start_token_id=None, eos_token_id=None):
+    '''
+        model: AutoModelForSeq2SeqLM , 如 pl_module.backbone.model
+        返回结果与 texts 顺序一致
+    '''
+    if eos_token_id is None:
+        eos_token_id = tokenizer.sep_token_id
+    encoded = [tokenizer.encode(text, truncation=True, max_length=max_seq_length) for text in texts]
+    outputs = batch_generate_ids(model, encoded,
+                                 max_target_length=max_target_length,
+                                 batch_size=batch_size,
+                                 num_beams=num_beams,
+                                 length_penalty=length_penalty,
+                                 device=device,
+                                 decoder_start_token_id=decoder_start_token_id,
+                                 eos_token_id=eos_token_id,
+                                 pad_token_id=tokenizer.pad_token_id)
+    return [decode_tokens(tokenizer, ids, eos_token_id) for ids in outputs]
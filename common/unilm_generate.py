@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+# UniLM 增量解码
+# 源文本段按双向注意力只编码一次, 缓存每层 key/value
+# 生成 token 以 token_type_ids=1 逐个追加, 注意全部源文本及已生成 token, 与 unilm_mask 的因果部分一致
+# 按层权重直接计算, 不依赖 transformers 各版本 past_key_values 接口 (bert 结构: embeddings + encoder.layer)
+
+import math
+import typing
+
+import torch
+
+__all__ = [
+    'UnilmIncrementalDecoder',
+    'greedy_generate',
+    'beam_generate',
+    'sample_generate',
+    'batch_generate_text',
+    'generate_titles',
+]
+
+
+class UnilmIncrementalDecoder:
+    '''
+        model: bert 类 backbone , lm_head: hidden -> vocab
+    '''
+
+    def __init__(self, model, lm_head):
+        self.model = model
+        self.lm_head = lm_head
+        self.config = model.config
+        self.layers = list(model.encoder.layer)
+        self.num_heads = self.config.num_attention_heads
+        self.head_size = self.config.hidden_size // self.num_heads
+        self.k_cache = None
+        self.v_cache = None
+        self.key_bias = None
+        self.src_lens = None
+        self.cur_len = 0
+
+    def _split_heads(self, x):
+        bs, seq_len, _ = x.size()
+        return x.view(bs, seq_len, self.num_heads, self.head_size).transpose(1, 2)
+
+    def _forward(self, input_ids, token_type_ids, position_ids, start, key_bias):
+        hidden_states = self.model.embeddings(input_ids=input_ids,
+                                              token_type_ids=token_type_ids,
+                                              position_ids=position_ids)
+        end = start + input_ids.size(1)
+        for i, layer in enumerate(self.layers):
+            attention = layer.attention
+            q = self._split_heads(attention.self.query(hidden_states))
+            self.k_cache[i][:, :, start:end] = self._split_heads(attention.self.key(hidden_states))
+            self.v_cache[i][:, :, start:end] = self._split_heads(attention.self.value(hidden_states))
+            k = self.k_cache[i][:, :, :end]
+            v = self.v_cache[i][:, :, :end]
+            scores = torch.matmul(q, k.transpose(-1, -2)) / math.sqrt(self.head_size) + key_bias
+            probs = torch.softmax(scores, dim=-1)
+            context = torch.matmul(probs, v).transpose(1, 2).reshape(hidden_states.size())
+            attention_output = attention.output(context, hidden_states)
+            hidden_states = layer.output(layer.intermediate(attention_output), attention_output)
+        return hidden_states
+
+    @torch.no_grad()
+    def encode(self, input_ids, attention_mask, max_target_length):
+        '''
+            input_ids: (bs, src_len) 右侧填充的源文本 [CLS] ... [SEP]
+            return: 源文本最后一个 token 的 logits, 用于预测第一个生成 token
+        '''
+        bs, src_len = input_ids.size()
+        device = input_ids.device
+        total_len = src_len + max_target_length
+        dtype = next(self.model.parameters()).dtype
+        self.k_cache = [torch.zeros((bs, self.num_heads, total_len, self.head_size), dtype=dtype, device=device)
+                        for _ in self.layers]
+        self.v_cache = [torch.zeros_like(k) for k in self.k_cache]
+        # 源文本填充位置对所有 query 不可见, 生成位置在写入后可见
+        self.key_bias = torch.zeros((bs, 1, 1, total_len), dtype=dtype, device=device)
+        self.key_bias[:, :, :, :src_len].masked_fill_(attention_mask[:, None, None, :] == 0,
+                                                      torch.finfo(dtype).min)
+        self.src_lens = attention_mask.sum(-1)
+        self.cur_len = src_len
+
+        position_ids = torch.arange(src_len, device=device).unsqueeze(0).expand(bs, -1)
+        token_type_ids = torch.zeros_like(input_ids)
+        hidden_states = self._forward(input_ids, token_type_ids, position_ids, 0, self.key_bias[:, :, :, :src_len])
+        last_hidden = hidden_states[torch.arange(bs, device=device), self.src_lens - 1]
+        return self.lm_head(last_hidden)
+
+    @torch.no_grad()
+    def step(self, next_ids, step):
+        '''
+            next_ids: (bs,) 第 step 个生成 token, 写入缓存并返回下一个 token 的 logits
+        '''
+        position_ids = (self.src_lens + step).unsqueeze(-1)
+        token_type_ids = torch.ones_like(next_ids).unsqueeze(-1)
+        start = self.cur_len
+        self.cur_len += 1
+        hidden_states = self._forward(next_ids.unsqueeze(-1), token_type_ids, position_ids, start,
+                                      self.key_bias[:, :, :, :self.cur_len])
+        return self.lm_head(hidden_states[:, -1])
+
+    def reorder(self, beam_idx):
+        self.k_cache = [k.index_select(0, beam_idx) for k in self.k_cache]
+        self.v_cache = [v.index_select(0, beam_idx) for v in self.v_cache]
+        self.key_bias = self.key_bias.index_select(0, beam_idx)
+        self.src_lens = self.src_lens.index_select(0, beam_idx)
+
+    def expand(self, num_beams):
+        self.reorder(torch.arange(self.src_lens.size(0), device=self.src_lens.device).repeat_interleave(num_beams))
+
+    def clear(self):
+        self.k_cache = self.v_cache = self.key_bias = self.src_lens = None
+        self.cur_len = 0
+
+
+def _top_k_top_p_filtering(logits, top_k=0, top_p=1.0):
+    if top_k > 0:
+        top_k = min(top_k, logits.size(-1))
+        kth = torch.topk(logits, top_k, dim=-1)[0][..., -1, None]
+        logits = logits.masked_fill(logits < kth, -float('inf'))
+    if top_p < 1.0:
+        sorted_logits, sorted_idx = torch.sort(logits, descending=True, dim=-1)
+        cum_probs = torch.softmax(sorted_logits, dim=-1).cumsum(dim=-1)
+        # 保留累计概率刚超过 top_p 的 token
+        sorted_remove = cum_probs - torch.softmax(sorted_logits, dim=-1) > top_p
+        remove = sorted_remove.scatter(-1, sorted_idx, sorted_remove)
+        logits = logits.masked_fill(remove, -float('inf'))
+    return logits
+
+
+def _decode(decoder: UnilmIncrementalDecoder, input_ids, attention_mask, max_target_length, eos_token_id,
+            pad_token_id, select_fn):
+    bs = input_ids.size(0)
+    device = input_ids.device
+    logits = decoder.encode(input_ids, attention_mask, max_target_length)
+    output_ids = torch.full((bs, max_target_length), pad_token_id, dtype=torch.long, device=device)
+    finished = torch.zeros(bs, dtype=torch.bool, device=device)
+    step = 0
+    for step in range(max_target_length):
+        next_token = select_fn(logits).masked_fill(finished, pad_token_id)
+        output_ids[:, step] = next_token
+        finished |= next_token == eos_token_id
+        if finished.all() or step == max_target_length - 1:
+            break
+        logits = decoder.step(next_token, step)
+    decoder.clear()
+    return output_ids[:, :step + 1]
+
+
+@torch.no_grad()
+def greedy_generate(decoder: UnilmIncrementalDecoder, input_ids, attention_mask, max_target_length,
+                    eos_token_id, pad_token_id=0):
+    '''
+        return: (bs, <= max_target_length) 结束后以 pad_token_id 填充
+    '''
+    return _decode(decoder, input_ids, attention_mask, max_target_length, eos_token_id, pad_token_id,
+                   lambda logits: logits.argmax(-1))
+
+
+@torch.no_grad()
+def sample_generate(decoder: UnilmIncrementalDecoder, input_ids, attention_mask, max_target_length,
+                    eos_token_id, pad_token_id=0, top_k=0, top_p=1.0, temperature=1.0, generator=None):
+    def select_fn(logits):
+        logits = _top_k_top_p_filtering(logits.float() / temperature, top_k=top_k, top_p=top_p)
+        return torch.multinomial(torch.softmax(logits, dim=-1), 1, generator=generator).squeeze(-1)
+
+    return _decode(decoder, input_ids, attention_mask, max_target_length, eos_token_id, pad_token_id, select_fn)
+
+
+@torch.no_grad()
+def beam_generate(decoder: UnilmIncrementalDecoder, input_ids, attention_mask, max_target_length,
+                  eos_token_id, pad_token_id=0, num_beams=4, length_penalty=1.0):
+    '''
+        已结束的 beam 分数冻结, 后续只能扩展 pad, 全部 beam 结束时提前停止
+        最终按 score / length ** length_penalty 选出每个样本的最优序列
+    '''
+    bs = input_ids.size(0)
+    device = input_ids.device
+    logits = decoder.encode(input_ids, attention_mask, max_target_length)
+    logits = logits.repeat_interleave(num_beams, dim=0)
+    decoder.expand(num_beams)
+
+    n = bs * num_beams
+    output_ids = torch.full((n, max_target_length), pad_token_id, dtype=torch.long, device=device)
+    lengths = torch.zeros(n, dtype=torch.long, device=device)
+    finished = torch.zeros(n, dtype=torch.bool, device=device)
+    # 初始只保留第一个 beam, 避免重复候选
+    scores = torch.zeros((bs, num_beams), dtype=torch.float, device=device)
+    scores[:, 1:] = -1e9
+    scores = scores.view(-1)
+    batch_offset = (torch.arange(bs, device=device) * num_beams).unsqueeze(-1)
+
+    step = 0
+    for step in range(max_target_length):
+        log_probs = torch.log_softmax(logits.float(), dim=-1)
+        log_probs[finished] = -float('inf')
+        log_probs[finished, pad_token_id] = 0.
+        vocab_size = log_probs.size(-1)
+
+        cand_scores = (scores.unsqueeze(-1) + log_probs).view(bs, num_beams * vocab_size)
+        top_scores, top_idx = cand_scores.topk(num_beams, dim=-1)
+        beam_idx = (torch.div(top_idx, vocab_size, rounding_mode='floor') + batch_offset).view(-1)
+        next_token = (top_idx % vocab_size).view(-1)
+
+        scores = top_scores.view(-1)
+        output_ids = output_ids[beam_idx]
+        output_ids[:, step] = next_token
+        finished = finished[beam_idx]
+        lengths = lengths[beam_idx] + (~finished).long()
+        finished |= next_token == eos_token_id
+        if finished.all() or step == max_target_length - 1:
+            break
+        decoder.reorder(beam_idx)
+        logits = decoder.step(next_token, step)
+    decoder.clear()
+
+    norm_scores = scores / lengths.clamp(min=1).float().pow(length_penalty)
+    best = norm_scores.view(bs, num_beams).argmax(-1) + batch_offset.view(-1)
+    return output_ids[best, :step + 1]
+
+
+def batch_generate_text(decoder: UnilmIncrementalDecoder, tokenizer, texts: typing.List[str], max_seq_length=512,
+                        max_target_length=50, batch_size=32, num_beams=1, length_penalty=1.0,
+                        do_sample=False, top_k=0, top_p=1.0, temperature=1.0, device=None):
+    '''
+        批量生成, 按长度排序分批减少 padding, 返回结果与 texts 顺序一致
+        num_beams > 1 为 beam search, do_sample 为 top-k / top-p 采样, 否则贪心
+    '''
+    model = decoder.model
+    if device is None:
+        device = next(model.parameters()).device
+    eos_token_id = tokenizer.sep_token_id
+    pad_token_id = tokenizer.pad_token_id
+    # 源文本与生成部分共享位置编码长度
+    max_src_length = max(2, min(max_seq_length, model.config.max_position_embeddings) - max_target_length)
+    encoded = [tokenizer.encode(text, truncation=True, max_length=max_src_length) for text in texts]
+    order = sorted(range(len(encoded)), key=lambda i: len(encoded[i]), reverse=True)
+    results = [None] * len(encoded)
+
+    is_training = model.training
+    model.eval()
+    for start in range(0, len(order), batch_size):
+        idx = order[start: start + batch_size]
+        max_len = max(len(encoded[i]) for i in idx)
+        input_ids = torch.full((len(idx), max_len), pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(idx), max_len), dtype=torch.long)
+        for j, i in enumerate(idx):
+            input_ids[j, :len(encoded[i])] = torch.tensor(encoded[i], dtype=torch.long)
+            attention_mask[j, :len(encoded[i])] = 1
+        input_ids = input_ids.to(device)
+        attention_mask = attention_mask.to(device)
+        if num_beams > 1:
+            output_ids = beam_generate(decoder, input_ids, attention_mask, max_target_length, eos_token_id,
+                                       pad_token_id, num_beams=num_beams, length_penalty=length_penalty)
+        elif do_sample:
+            output_ids = sample_generate(decoder, input_ids, attention_mask, max_target_length, eos_token_id,
+                                         pad_token_id, top_k=top_k, top_p=top_p, temperature=temperature)
+        else:
+            output_ids = greedy_generate(decoder, input_ids, attention_mask, max_target_length, eos_token_id,
+                                         pad_token_id)
+        for i, ids in zip(idx, output_ids.cpu().tolist()):
+            if eos_token_id in ids:
+                ids = ids[:ids.index(eos_token_id)]
+            results[i] = tokenizer.decode(ids, skip_special_tokens=True).replace(' ', '')
+    model.train(is_training)
+    return results
+
+
+def generate_titles(pl_module, tokenizer, prefixs: typing.List[str], data_args, device=None, batch_size=32,
+                    num_beams=1, **kwargs):
+    '''
+        TransformerModelForUnilm (及蒸馏学生) 的回调中批量生成标题
+        长度取 data_args.max_seq_length / max_target_length , 其余参数同 batch_generate_text
+    '''
+    model = pl_module.backbone
+    decoder = UnilmIncrementalDecoder(model.model, model.lm_head)
+    return batch_generate_text(decoder, tokenizer, prefixs,
+                               max_seq_length=data_args.max_seq_length,
+                               max_target_length=data_args.max_target_length,
+                               batch_size=batch_size,
+                               num_beams=num_beams,
+                               device=device,
+                               **kwargs)
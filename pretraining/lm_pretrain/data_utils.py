@@ -3,6 +3,8 @@
 # @Author:XIE392
 # @File：data_utils.py
 import json
+import os
+import sys
 
 import numpy as np
 import torch
@@ -11,6 +13,9 @@ import typing
 from deep_training.data_helper import DataHelper, ModelArguments, TrainingArguments, DataArguments
 from transformers import BertTokenizer, HfArgumentParser
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../..'))
+from common.lm_packing import pack_documents, build_block_diagonal_mask
+
 train_info_args = {
         'devices': 1,
         'data_backend': 'record',
@@ -37,7 +42,43 @@ train_info_args = {
         'test_max_seq_length': 512,
     }
 
+# 文档打包: 多篇文档以 [SEP] 拼接为 train_max_seq_length 满长度 block , 替代逐篇 padding
+# 修改后需删除已有缓存 (或 overwrite=True) 重新生成
+pack_info_args = {
+    'with_packing': True,
+    # 每组文档数, 组内打包, 组间可多进程
+    'count_per_group': 1000,
+    # position_ids 在每篇文档起始处重置
+    'reset_position_ids': True,
+    # 块对角因果 attention_mask , 文档之间互不可见 , 需要 transformers 支持 4d attention_mask
+    'with_block_diagonal_mask': False,
+}
+
 class NN_DataHelper(DataHelper):
+    @property
+    def pack_args(self):
+        return self.external_kwargs.get('pack_args', None) or {'with_packing': False}
+
+    # 一组文档打包为多条记录
+    def on_data_process_packed(self, data: typing.List, mode: str):
+        tokenizer: BertTokenizer
+        max_seq_length = self.max_seq_length_dict[mode]
+        tokenizer = self.tokenizer
+        pack_args = self.pack_args
+
+        docs, docs_token_type_ids = [], []
+        for x in data:
+            if isinstance(x, tuple):
+                o = tokenizer(text=x[0], text_pair=x[1], add_special_tokens=True)
+            else:
+                o = tokenizer(x, add_special_tokens=True)
+            docs.append(o['input_ids'])
+            docs_token_type_ids.append(o['token_type_ids'])
+        return pack_documents(docs, max_seq_length, tokenizer.sep_token_id, tokenizer.pad_token_id,
+                              docs_token_type_ids=docs_token_type_ids,
+                              reset_position_ids=pack_args.get('reset_position_ids', True),
+                              with_doc_ids=pack_args.get('with_block_diagonal_mask', False))
+
     # 切分词
     def on_data_process(self, data: typing.Any, mode: str):
         tokenizer: BertTokenizer
@@ -45,6 +86,8 @@ class NN_DataHelper(DataHelper):
         tokenizer = self.tokenizer
 
         x = data
+        if isinstance(x, list):
+            return self.on_data_process_packed(x, mode)
         if isinstance(x, tuple):
             o = tokenizer(text=x[0], text_pair=x[1], max_length=max_seq_length, truncation=True,
                           add_special_tokens=True)
@@ -82,6 +125,10 @@ class NN_DataHelper(DataHelper):
                     D.append((jd['content'], jd['title']))
                     if i > 1000:
                         break
+        pack_args = self.pack_args
+        if pack_args['with_packing']:
+            count_per_group = pack_args.get('count_per_group', 1000)
+            D = [D[i: i + count_per_group] for i in range(0, len(D), count_per_group)]
         return D
 
     def collate_fn(self,batch):
@@ -102,6 +149,10 @@ class NN_DataHelper(DataHelper):
         o['attention_mask'] = o['attention_mask'][:, :max_len]
         if 'token_type_ids' in o:
             o['token_type_ids'] = o['token_type_ids'][:, :max_len]
+        if 'position_ids' in o:
+            o['position_ids'] = o['position_ids'][:, :max_len]
+        if 'doc_ids' in o:
+            o['attention_mask'] = build_block_diagonal_mask(o.pop('doc_ids')[:, :max_len])
         o['labels'] = o['labels'][:, :max_len]
         return o
 
@@ -111,7 +162,7 @@ if __name__ == '__main__':
     parser = HfArgumentParser((ModelArguments, TrainingArguments, DataArguments))
     model_args, training_args, data_args = parser.parse_dict(train_info_args)
 
-    dataHelper = NN_DataHelper(model_args, training_args, data_args)
+    dataHelper = NN_DataHelper(model_args, training_args, data_args, pack_args=pack_info_args)
     tokenizer, config, label2id, id2label = dataHelper.load_tokenizer_and_config()
 
     # 缓存数据集
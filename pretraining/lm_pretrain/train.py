@@ -7,7 +7,7 @@ from lightning import Trainer
 from lightning.pytorch.callbacks import ModelCheckpoint
 from torch.utils.data import DataLoader, IterableDataset
 from transformers import HfArgumentParser
-from data_utils import NN_DataHelper,train_info_args
+from data_utils import NN_DataHelper,train_info_args,pack_info_args
 
 
 class MyTransformer(TransformerForCausalLM, with_pl=True):
@@ -35,7 +35,7 @@ if __name__ == '__main__':
         strategy='ddp' if torch.cuda.device_count() > 1 else 'auto',
     )
 
-    dataHelper = NN_DataHelper(model_args, training_args, data_args)
+    dataHelper = NN_DataHelper(model_args, training_args, data_args, pack_args=pack_info_args)
     tokenizer, config, label2id, id2label = dataHelper.load_tokenizer_and_config()
 
     # 缓存数据集
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+# mlm collate_fn labels / mask 构造: 逐行循环 vs 整批向量化, batch 64 / 长度 512
+import os
+import sys
+import timeit
+
+import numpy as np
+import torch
+from transformers import BertTokenizer
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../..'))
+from common.mlm_masking import DynamicWwmMasker, build_mlm_labels
+
+
+def build_mlm_labels_loop(input_ids, masked_lm_positions, masked_lm_ids, masked_lm_weights):
+    labels = torch.clone(input_ids)
+    mask = torch.zeros_like(input_ids)
+    for i, (index, value, weight) in enumerate(zip(masked_lm_positions, masked_lm_ids, masked_lm_weights.long())):
+        s = torch.sum(weight)
+        labels[i, index[:s]] = value[:s]
+        mask[i, index[:s]] = 1
+    return labels, mask
+
+
+def make_static_batch(rng, batch_size, max_seq_length, max_predictions_per_seq, vocab_size):
+    input_ids = torch.from_numpy(rng.randint(1000, vocab_size, size=(batch_size, max_seq_length)))
+    masked_lm_positions = torch.zeros((batch_size, max_predictions_per_seq), dtype=torch.long)
+    masked_lm_ids = torch.zeros((batch_size, max_predictions_per_seq), dtype=torch.long)
+    masked_lm_weights = torch.zeros((batch_size, max_predictions_per_seq), dtype=torch.float32)
+    for i in range(batch_size):
+        n = rng.randint(1, max_predictions_per_seq + 1)
+        masked_lm_positions[i, :n] = torch.from_numpy(np.sort(rng.choice(np.arange(1, max_seq_length - 1), n, replace=False)))
+        masked_lm_ids[i, :n] = torch.from_numpy(rng.randint(1000, vocab_size, size=n))
+        masked_lm_weights[i, :n] = 1
+    return input_ids, masked_lm_positions, masked_lm_ids, masked_lm_weights
+
+
+if __name__ == '__main__':
+    batch_size = 64
+    max_seq_length = 512
+    max_predictions_per_seq = 20
+    number = 50
+    rng = np.random.RandomState(123456)
+
+    tokenizer = BertTokenizer.from_pretrained(
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), '../t5encoder_mlm_pretrain/t5_base_config'))
+    vocab_size = len(tokenizer.get_vocab())
+
+    # 静态掩码缓存
+    batch = make_static_batch(rng, batch_size, max_seq_length, max_predictions_per_seq, vocab_size)
+    for a, b in zip(build_mlm_labels_loop(*batch), build_mlm_labels(*batch)):
+        assert torch.equal(a, b)
+    t_loop = timeit.timeit(lambda: build_mlm_labels_loop(*batch), number=number) / number
+    t_vec = timeit.timeit(lambda: build_mlm_labels(*batch), number=number) / number
+    print('static  batch={} L={} loop {:.2f}ms vec {:.2f}ms speedup {:.1f}x'.format(
+        batch_size, max_seq_length, t_loop * 1000, t_vec * 1000, t_loop / t_vec))
+
+    # 动态全词掩码
+    masker = DynamicWwmMasker(tokenizer, True, max_predictions_per_seq, 0.15, seed=123456)
+    seqlens = rng.randint(max_seq_length // 2, max_seq_length + 1, size=batch_size)
+    input_ids = rng.randint(1000, vocab_size, size=(batch_size, max_seq_length))
+    input_ids[:, 0] = tokenizer.cls_token_id
+    input_ids[np.arange(batch_size), seqlens - 1] = tokenizer.sep_token_id
+    input_ids[np.arange(max_seq_length)[None, :] >= seqlens[:, None]] = tokenizer.pad_token_id
+    input_ids = torch.from_numpy(input_ids)
+
+    def mask_loop():
+        ids = input_ids.numpy()
+        return [masker.mask_example(ids[i], int(seqlens[i])) for i in range(batch_size)]
+
+    t_loop = timeit.timeit(mask_loop, number=number) / number
+    t_vec = timeit.timeit(lambda: masker(input_ids, seqlens), number=number) / number
+    print('dynamic batch={} L={} loop {:.2f}ms vec {:.2f}ms speedup {:.1f}x'.format(
+        batch_size, max_seq_length, t_loop * 1000, t_vec * 1000, t_loop / t_vec))
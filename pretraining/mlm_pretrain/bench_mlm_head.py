@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+# mlm 损失: 全序列 lm head vs 只在 mask 位置计算 lm head , cpu 上小 bert 的单步耗时与峰值内存
+import multiprocessing
+import resource
+import time
+
+import torch
+from torch.nn import CrossEntropyLoss
+from transformers import BertConfig, BertForMaskedLM
+
+from train import masked_lm_head_forward
+
+
+def make_batch(batch_size, max_seq_length, vocab_size, masked_lm_prob=0.15):
+    g = torch.Generator().manual_seed(123456)
+    input_ids = torch.randint(1000, vocab_size, (batch_size, max_seq_length), generator=g)
+    attention_mask = torch.ones_like(input_ids)
+    mask = (torch.rand((batch_size, max_seq_length), generator=g) < masked_lm_prob).long()
+    return input_ids, attention_mask, input_ids.clone(), mask
+
+
+def full_step(model, loss_fct, input_ids, attention_mask, labels, mask):
+    logits = model(input_ids=input_ids, attention_mask=attention_mask)[0]
+    loss = loss_fct(torch.transpose(logits, 1, 2), labels)
+    return torch.sum(mask * loss) / (torch.sum(mask) + 1e-8)
+
+
+def masked_step(model, loss_fct, input_ids, attention_mask, labels, mask):
+    logits, index = masked_lm_head_forward(model, mask, input_ids=input_ids, attention_mask=attention_mask)
+    return loss_fct(logits, labels[index]).mean()
+
+
+def _run(mode, q, steps=5):
+    torch.manual_seed(0)
+    torch.set_num_threads(1)
+    config = BertConfig(vocab_size=21128, hidden_size=128, num_hidden_layers=2, num_attention_heads=2,
+                        intermediate_size=512, max_position_embeddings=512)
+    model = BertForMaskedLM(config)
+    optimizer = torch.optim.SGD(model.parameters(), lr=1e-3)
+    loss_fct = CrossEntropyLoss(reduction='none')
+    batch = make_batch(16, 512, config.vocab_size)
+    step_fn = full_step if mode == 'full' else masked_step
+    # 预热
+    step_fn(model, loss_fct, *batch).backward()
+    optimizer.zero_grad()
+    start = time.time()
+    for _ in range(steps):
+        loss = step_fn(model, loss_fct, *batch)
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad()
+    # linux 下 ru_maxrss 单位为 KB
+    q.put(((time.time() - start) / steps, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+if __name__ == '__main__':
+    results = {}
+    for mode in ['full', 'masked']:
+        q = multiprocessing.Queue()
+        p = multiprocessing.Process(target=_run, args=(mode, q))
+        p.start()
+        results[mode] = q.get()
+        p.join()
+        print('{:<7} batch=16 L=512 step {:.0f}ms peak_rss {:.0f}MB'.format(mode, results[mode][0] * 1000,
+                                                                          results[mode][1]))
+    print('step time -{:.0%}, peak memory -{:.0%}'.format(1 - results['masked'][0] / results['full'][0],
+                                                           1 - results['masked'][1] / results['full'][1]))
@@ -2,17 +2,22 @@
 # @Time:  3:09
 # @Author:XIE392
 # @File：data_utils.py
-import copy
-import json
+import os
 import random
+import sys
 
 import torch
 import typing
 from deep_training.data_helper import DataHelper, ModelArguments, TrainingArguments, MlmDataArguments, DataArguments
-from deep_training.utils.maskedlm import make_mlm_wwm_sample
 from transformers import BertTokenizer, HfArgumentParser
 from fastdatasets import gfile
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../..'))
+from common.dataset_builder import ParallelDataHelperMixin
+from common.dataset_cache import FingerprintCacheMixin, get_source_hash
+from common.jsonl_reader import iter_jsonl
+from common.mlm_masking import DynamicWwmMasker, build_mlm_labels, make_mlm_sample
+
 
 train_info_args = {
     'devices': 1,
@@ -41,7 +46,7 @@ train_info_args = {
     'do_lower_case': True,
     'do_whole_word_mask': True,
     'max_predictions_per_seq': 20,
-    'dupe_factor': 5,
+    # 掩码在 collate_fn 中动态生成, 每个 epoch 不同, 无需 dupe_factor 重复写入
     'masked_lm_prob': 0.15
 }
 
@@ -50,7 +55,16 @@ data_conf = {
     'count_per_group': 1,
 }
 
-class NN_DataHelper(DataHelper):
+# 制作缓存的进程数, 0 为单进程
+num_process_worker = 20
+
+
+def parse_documents(jd):
+    docs = jd['text'].split('\n\n')
+    return [doc for doc in docs if doc]
+
+
+class NN_DataHelper(FingerprintCacheMixin, ParallelDataHelperMixin, DataHelper):
     index = -1
     def on_data_ready(self):
         self.index = -1
@@ -64,8 +78,6 @@ class NN_DataHelper(DataHelper):
         tokenizer = self.tokenizer
 
 
-        rng, do_whole_word_mask, max_predictions_per_seq, masked_lm_prob = self.external_kwargs['mlm_args']
-
         group_documents = data
 
         document_text_string = ''
@@ -82,8 +94,7 @@ class NN_DataHelper(DataHelper):
         # 返回多个文档
         document_nodes = []
         for text in document_texts:
-            node = make_mlm_wwm_sample(text, tokenizer, max_seq_length, rng, do_whole_word_mask,
-                                       max_predictions_per_seq, masked_lm_prob)
+            node = make_mlm_sample(text, tokenizer, max_seq_length)
             document_nodes.append(node)
 
         if self.index < 3:
@@ -92,35 +103,36 @@ class NN_DataHelper(DataHelper):
 
     # 读取文件
     def on_get_corpus(self, files: typing.List, mode: str):
+        # 按字节区间流式解析, 不整体读入内存
         COUNT_PER_GROUP = data_conf['count_per_group']
-        D = []
         sub = []
         line_no = 0
-        for input_file in files:
-            with open(input_file, 'r', encoding='utf-8') as f:
-                lines = f.readlines()
-                for line in lines:
-                    jd = json.loads(line)
-                    if not jd:
-                        continue
-                    text = jd['text']
-                    docs = text.split('\n\n')
-
-                    d = [doc for doc in docs if doc]
-                    sub.append(d)
-                    if len(sub) >= COUNT_PER_GROUP:
-                        D.append(copy.deepcopy(sub))
-                        sub.clear()
-
-                    line_no += 1
-                    if line_no % 10000 == 0:
-                        print('read_line', line_no)
-                        print(d)
+        for d in iter_jsonl(files, parse_fn=parse_documents, num_process_worker=num_process_worker):
+            sub.append(d)
+            if len(sub) >= COUNT_PER_GROUP:
+                yield sub
+                sub = []
+
+            line_no += 1
+            if line_no % 10000 == 0:
+                print('read_line', line_no)
+                print(d)
         if len(sub):
-            D.append(copy.deepcopy(sub))
-            sub.clear()
+            yield sub
+
+    # 缓存指纹: 分组配置及解析函数
+    def get_fingerprint_args(self, mode: str):
+        o = super(NN_DataHelper, self).get_fingerprint_args(mode)
+        o.update(data_conf=data_conf, parse_documents=get_source_hash(parse_documents),
+                 make_mlm_sample=get_source_hash(make_mlm_sample))
+        return o
 
-        return D
+    def get_masker(self):
+        if getattr(self, 'masker', None) is None:
+            rng, do_whole_word_mask, max_predictions_per_seq, masked_lm_prob = self.external_kwargs['mlm_args']
+            self.masker = DynamicWwmMasker(self.tokenizer, do_whole_word_mask, max_predictions_per_seq,
+                                           masked_lm_prob, seed=rng.randint(0, 2 ** 31 - 1))
+        return self.masker
 
     def collate_fn(self, batch):
         o = {}
@@ -141,18 +153,13 @@ class NN_DataHelper(DataHelper):
         if 'token_type_ids' in o:
             o['token_type_ids'] = o['token_type_ids'][:, :max_len]
 
-        input_ids = o['input_ids']
-        masked_lm_positions = o.pop('masked_lm_positions')
-        masked_lm_ids = o.pop('masked_lm_ids')
-        masked_lm_weights = o.pop('masked_lm_weights')
-        labels = torch.clone(input_ids)
-        mask = torch.zeros_like(input_ids)
-        for i, (index, value, weight) in enumerate(zip(masked_lm_positions, masked_lm_ids, masked_lm_weights.long())):
-            s = torch.sum(weight)
-            labels[i, index[:s]] = value[:s]
-            mask[i, index[:s]] = 1
-        o['labels'] = labels
-        o['mask'] = mask
+        if 'masked_lm_positions' in o:
+            # 兼容 make_mlm_wwm_sample 生成的静态掩码缓存
+            o['labels'], o['mask'] = build_mlm_labels(o['input_ids'], o.pop('masked_lm_positions'),
+                                                      o.pop('masked_lm_ids'), o.pop('masked_lm_weights'))
+        else:
+            # 动态全词掩码, DataLoader 多进程时在 worker 中执行
+            o['input_ids'], o['labels'], o['mask'] = self.get_masker()(o['input_ids'], torch.sum(o['attention_mask'], dim=-1))
         return o
 
 if __name__ == '__main__':
@@ -167,8 +174,8 @@ if __name__ == '__main__':
 
     # 缓存数据集
     if data_args.do_train:
-        dataHelper.make_dataset_with_args(data_args.train_file,mixed_data=False,shuffle=True,mode='train',dupe_factor=mlm_data_args.dupe_factor,
-                                          num_process_worker=20)
+        dataHelper.make_dataset_with_args(data_args.train_file,mixed_data=False,shuffle=True,mode='train',
+                                          num_process_worker=num_process_worker, append=True)
     if data_args.do_eval:
         dataHelper.make_dataset_with_args(data_args.eval_file,shuffle=False,mode='eval')
     if data_args.do_test:
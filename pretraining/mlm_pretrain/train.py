@@ -17,8 +17,30 @@ from torch.nn.functional import one_hot
 mask_token_id = None
 
 
+def get_mlm_head(model):
+    # bert 系为 cls , roberta 等为 lm_head
+    head = getattr(model, 'cls', None)
+    if head is None:
+        head = getattr(model, 'lm_head')
+    return head
+
+
+def masked_lm_head_forward(model, mask, *args, **batch):
+    '''
+        先取 mask 位置的隐藏层, 只对这些行计算 lm head
+        return: logits (num_masked, vocab_size), mask 位置索引
+    '''
+    outputs = model.base_model(*args, **batch)
+    hidden_states = outputs[0]
+    index = torch.nonzero(mask, as_tuple=True)
+    logits = get_mlm_head(model)(hidden_states[index])
+    return logits, index
+
+
 class MyTransformer(TransformerForMaskLM, with_pl=True):
     def __init__(self, *args, **kwargs):
+        # 训练时只在 mask 位置计算 lm head, 不再输出全词表 acc
+        self.masked_lm_head_only = kwargs.pop('masked_lm_head_only', True)
         super(MyTransformer, self).__init__(*args, **kwargs)
         self.loss_fct = CrossEntropyLoss(reduction='none')
 
@@ -40,6 +62,18 @@ class MyTransformer(TransformerForMaskLM, with_pl=True):
             labels = batch.pop('labels')
             mask = batch.pop('mask')
 
+        if labels is not None and self.masked_lm_head_only:
+            logits, index = masked_lm_head_forward(self.model.model, mask, *args, **batch)
+            labels = labels[index]
+            mask = torch.ones_like(labels)
+            loss = self.compute_loss_mlm(labels.unsqueeze(0), logits.unsqueeze(0), mask.unsqueeze(0))
+            mlm_acc = self.compute_acc(labels, logits, mask)
+            loss = {
+                'loss': loss,
+                'mlm_acc': mlm_acc,
+            }
+            return (loss, logits, labels)
+
         outputs = self.model(*args, **batch)
         logits = outputs[0]
         if labels is not None:
@@ -89,7 +123,7 @@ if __name__ == '__main__':
     # 缓存数据集
     if data_args.do_train:
         dataHelper.make_dataset_with_args(data_args.train_file, mixed_data=False, shuffle=True, mode='train',
-                                          dupe_factor=mlm_data_args.dupe_factor, num_process_worker=10)
+                                          num_process_worker=10)
     if data_args.do_eval:
         dataHelper.make_dataset_with_args(data_args.eval_file, shuffle=False, mode='eval')
     if data_args.do_test:
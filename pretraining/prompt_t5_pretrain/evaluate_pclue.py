@@ -43,7 +43,7 @@ def evaluate_pclue_file_fn(predict_file,target_file):
     predict_lines = open(predict_file, 'r').readlines()
     target_lines = open(target_file, 'r').readlines()
 
-    return evaluate_pclue_fn(predict_file,target_file)
+    return evaluate_pclue_fn(predict_lines,target_lines)
 
 def evaluate_pclue_fn(predict_lines,target_lines):
     """
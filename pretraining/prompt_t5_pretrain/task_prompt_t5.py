@@ -1,6 +1,10 @@
 # -*- coding: utf-8 -*-
 #reference: https://github.com/clue-ai/PromptCLUE/blob/main/Fine_tuning_PyTorch.ipynb
 
+import json
+import os
+import sys
+
 import numpy as np
 import torch
 from deep_training.data_helper import ModelArguments, DataArguments, TrainingArguments
@@ -13,6 +17,9 @@ from transformers import HfArgumentParser, BertTokenizer
 from data_utils import NN_DataHelper,train_info_args
 from evaluate_pclue import evaluate_pclue_fn
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../..'))
+from common.seq2seq_generate import batch_generate_text
+
 
 class MyTransformer(TransformerForSeq2SeqLM, with_pl=True):
     def __init__(self, *args, **kwargs):
@@ -25,31 +32,37 @@ class MySimpleModelCheckpoint(SimpleModelCheckpoint):
         self.weight_file = './best.pt'
 
     @staticmethod
-    def generate_text(pl_module: MyTransformer, prefix, tokenizer, max_target_length, device=0):
-        device = torch.device('cuda:{}'.format(device))
+    def generate_text(pl_module: MyTransformer, prefix, tokenizer, max_target_length, device=0, num_beams=1):
         # 简易测试生成
-        o = tokenizer.encode_plus(prefix, truncation=True, max_length=512, return_attention_mask=False,
-                                  return_token_type_ids=False)
-        gen_ids, gen_tokens = [], []
-        batch = {}
-        for i in range(max_target_length):
-            batch.clear()
-            batch['input_ids'] = [o['input_ids']]
-            batch['decoder_input_ids'] = [[tokenizer.cls_token_id] + gen_ids]
-            for k in batch:
-                batch[k] = torch.tensor(batch[k], dtype=torch.int32)
-            for k in batch:
-                batch[k] = batch[k].to(device)
-            out = pl_module.test_step(batch, 0)
-            logits = out['outputs'][0]
-            logits = np.argmax(logits[:, -1], axis=-1)
-            logits = logits[0]
-            gen_ids.append(logits)
-            token = tokenizer._convert_id_to_token(logits)
-            if token.startswith('##'):
-                token = token.replace('##', '')
-            gen_tokens.append(token)
-        return ''.join(gen_tokens)
+        return MySimpleModelCheckpoint.generate_text_batch(pl_module, [prefix], tokenizer, max_target_length,
+                                                           device=device, num_beams=num_beams)[0]
+
+    @staticmethod
+    def generate_text_batch(pl_module: MyTransformer, prefixs, tokenizer, max_target_length, device=0,
+                            batch_size=32, num_beams=1):
+        # 编码器每批只运行一次, 解码器增量解码
+        device = torch.device('cuda:{}'.format(device))
+        return batch_generate_text(pl_module.backbone.model, tokenizer, prefixs,
+                                   max_seq_length=512,
+                                   max_target_length=max_target_length,
+                                   batch_size=batch_size,
+                                   num_beams=num_beams,
+                                   device=device,
+                                   decoder_start_token_id=tokenizer.cls_token_id,
+                                   eos_token_id=tokenizer.sep_token_id)
+
+    @staticmethod
+    def evaluate_pclue_file(pl_module: MyTransformer, eval_file, tokenizer, max_target_length, device=0,
+                            batch_size=32, num_beams=1):
+        # 整个评估文件批量生成, 结果交给 evaluate_pclue_fn 计算分数
+        with open(eval_file, mode='r', encoding='utf-8') as f:
+            target_lines = [line for line in f.readlines() if line.strip()]
+        prefixs = [json.loads(line)['input'] for line in target_lines]
+        outputs = MySimpleModelCheckpoint.generate_text_batch(pl_module, prefixs, tokenizer, max_target_length,
+                                                              device=device, batch_size=batch_size,
+                                                              num_beams=num_beams)
+        predict_lines = [json.dumps({'target': output}, ensure_ascii=False) for output in outputs]
+        return evaluate_pclue_fn(predict_lines, target_lines)
 
     def on_save_model(
             self, trainer: "pl.Trainer", pl_module: "pl.LightningModule"
@@ -70,15 +83,23 @@ class MySimpleModelCheckpoint(SimpleModelCheckpoint):
         self.tokenizer: BertTokenizer
         tokenizer = self.tokenizer
         data_args = self.data_args
-        for prefix in prefixs:
+        outputs = MySimpleModelCheckpoint.generate_text_batch(pl_module, [prefix[1] for prefix in prefixs], tokenizer,
+                                                              data_args.max_target_length, device=device)
+        for prefix, output in zip(prefixs, outputs):
             print(prefix[0], prefix[1])
-            prefix = prefix[1]
-            output = MySimpleModelCheckpoint.generate_text(pl_module, prefix, tokenizer,
-                                                           data_args.max_target_length, device=device)
-            print('input', prefix)
+            print('input', prefix[1])
             print('output', output)
             print()
 
+        eval_files = data_args.eval_file or []
+        if isinstance(eval_files, str):
+            eval_files = [eval_files]
+        for eval_file in eval_files:
+            result = MySimpleModelCheckpoint.evaluate_pclue_file(pl_module, eval_file, tokenizer,
+                                                                 data_args.max_target_length, device=device,
+                                                                 batch_size=self.training_args.eval_batch_size)
+            print(eval_file, result)
+
 
 
 
@@ -112,6 +133,7 @@ if __name__ == '__main__':
     # 额外参数
     checkpoint_callback.tokenizer = tokenizer
     checkpoint_callback.data_args = data_args
+    checkpoint_callback.training_args = training_args
 
     # 缓存数据集
     if data_args.do_train:
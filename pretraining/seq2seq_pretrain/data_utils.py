@@ -2,7 +2,8 @@
 # @Time:  3:12
 # @Author:XIE392
 # @File：data_utils.py
-import json
+import os
+import sys
 
 import numpy as np
 import torch
@@ -11,6 +12,11 @@ import typing
 from deep_training.data_helper import DataHelper, ModelArguments, TrainingArguments, DataArguments
 from transformers import BertTokenizer, HfArgumentParser
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../..'))
+from common.dataset_builder import ParallelDataHelperMixin
+from common.dataset_cache import FingerprintCacheMixin, get_source_hash
+from common.jsonl_reader import iter_jsonl
+
 
 train_info_args = {
     'devices': 1,
@@ -38,7 +44,15 @@ train_info_args = {
     'max_target_length': 64,
 }
 
-class NN_DataHelper(DataHelper):
+# 制作缓存的进程数, 0 为单进程
+num_process_worker = os.cpu_count() or 0
+
+
+def parse_example(jd):
+    return (jd['content'], jd['title'])
+
+
+class NN_DataHelper(FingerprintCacheMixin, ParallelDataHelperMixin, DataHelper):
     # 切分词
     def on_data_process(self, data: typing.Any, mode: str):
         tokenizer: BertTokenizer
@@ -80,14 +94,14 @@ class NN_DataHelper(DataHelper):
 
     # 读取文件
     def on_get_corpus(self, files: typing.List, mode: str):
-        D = []
-        for filename in files:
-            with open(filename, mode='r', encoding='utf-8') as f:
-                lines = f.readlines()
-                for i, line in enumerate(lines):
-                    jd = json.loads(line)
-                    D.append((jd['content'], jd['title']))
-        return D
+        # 按字节区间流式解析, 不整体读入内存
+        return iter_jsonl(files, parse_fn=parse_example, num_process_worker=num_process_worker)
+
+    # 缓存指纹: 解析函数
+    def get_fingerprint_args(self, mode: str):
+        o = super(NN_DataHelper, self).get_fingerprint_args(mode)
+        o.update(parse_example=get_source_hash(parse_example))
+        return o
 
     def collate_fn(self, batch):
         o = {}
@@ -125,8 +139,8 @@ if __name__ == '__main__':
 
     # 缓存数据集
     if data_args.do_train:
-        dataHelper.make_dataset_with_args(data_args.train_file,mixed_data=False, shuffle=True,mode='train')
+        dataHelper.make_dataset_with_args(data_args.train_file,mixed_data=False, shuffle=True,mode='train', num_process_worker=num_process_worker, append=True)
     if data_args.do_eval:
-        dataHelper.make_dataset_with_args(data_args.eval_file, mode='eval')
+        dataHelper.make_dataset_with_args(data_args.eval_file, mode='eval', num_process_worker=num_process_worker)
     if data_args.do_test:
-        dataHelper.make_dataset_with_args(data_args.test_file,mode='test')
\ No newline at end of file
+        dataHelper.make_dataset_with_args(data_args.test_file,mode='test', num_process_worker=num_process_worker)
\ No newline at end of file
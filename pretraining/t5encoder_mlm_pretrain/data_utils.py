@@ -2,14 +2,18 @@
 # @Time:  3:09
 # @File：data_utils.py
 import json
+import os
 import random
+import sys
 
 import torch
 import typing
 from deep_training.data_helper import DataHelper, ModelArguments, TrainingArguments, MlmDataArguments, DataArguments
-from deep_training.utils.maskedlm import make_mlm_wwm_sample
 from transformers import BertTokenizer, HfArgumentParser
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../..'))
+from common.mlm_masking import DynamicWwmMasker, build_mlm_labels, make_mlm_sample
+
 
 train_info_args = {
     'devices': 1,
@@ -39,7 +43,7 @@ train_info_args = {
     'do_lower_case': True,
     'do_whole_word_mask': True,
     'max_predictions_per_seq': 20,
-    'dupe_factor': 5,
+    # 掩码在 collate_fn 中动态生成, 每个 epoch 不同, 无需 dupe_factor 重复写入
     'masked_lm_prob': 0.15
 }
 
@@ -51,8 +55,6 @@ class NN_DataHelper(DataHelper):
         max_seq_length = self.max_seq_length_dict[mode]
         tokenizer = self.tokenizer
 
-        rng, do_whole_word_mask, max_predictions_per_seq, masked_lm_prob = self.external_kwargs['mlm_args']
-
         documents = data
         document_text_string = ''.join(documents)
         document_texts = []
@@ -64,8 +66,7 @@ class NN_DataHelper(DataHelper):
         # 返回多个文档
         document_nodes = []
         for text in document_texts:
-            node = make_mlm_wwm_sample(text, tokenizer, max_seq_length, rng, do_whole_word_mask,
-                                       max_predictions_per_seq, masked_lm_prob)
+            node = make_mlm_sample(text, tokenizer, max_seq_length)
             document_nodes.append(node)
         return document_nodes
 
@@ -93,6 +94,13 @@ class NN_DataHelper(DataHelper):
                         print(D[-1])
         return D
 
+    def get_masker(self):
+        if getattr(self, 'masker', None) is None:
+            rng, do_whole_word_mask, max_predictions_per_seq, masked_lm_prob = self.external_kwargs['mlm_args']
+            self.masker = DynamicWwmMasker(self.tokenizer, do_whole_word_mask, max_predictions_per_seq,
+                                           masked_lm_prob, seed=rng.randint(0, 2 ** 31 - 1))
+        return self.masker
+
     def collate_fn(self, batch):
         o = {}
         for i, b in enumerate(batch):
@@ -112,18 +120,13 @@ class NN_DataHelper(DataHelper):
         if 'token_type_ids' in o:
             o['token_type_ids'] = o['token_type_ids'][:, :max_len]
 
-        input_ids = o['input_ids']
-        masked_lm_positions = o.pop('masked_lm_positions')
-        masked_lm_ids = o.pop('masked_lm_ids')
-        masked_lm_weights = o.pop('masked_lm_weights')
-        labels = torch.clone(input_ids)
-        mask = torch.zeros_like(input_ids)
-        for i, (index, value, weight) in enumerate(zip(masked_lm_positions, masked_lm_ids, masked_lm_weights.long())):
-            s = torch.sum(weight)
-            labels[i, index[:s]] = value[:s]
-            mask[i, index[:s]] = 1
-        o['labels'] = labels
-        o['mask'] = mask
+        if 'masked_lm_positions' in o:
+            # 兼容 make_mlm_wwm_sample 生成的静态掩码缓存
+            o['labels'], o['mask'] = build_mlm_labels(o['input_ids'], o.pop('masked_lm_positions'),
+                                                      o.pop('masked_lm_ids'), o.pop('masked_lm_weights'))
+        else:
+            # 动态全词掩码, DataLoader 多进程时在 worker 中执行
+            o['input_ids'], o['labels'], o['mask'] = self.get_masker()(o['input_ids'], torch.sum(o['attention_mask'], dim=-1))
         return o
 
 if __name__ == '__main__':
@@ -138,7 +141,7 @@ if __name__ == '__main__':
 
     # 缓存数据集
     if data_args.do_train:
-        dataHelper.make_dataset_with_args(data_args.train_file,mixed_data=False,shuffle=True,mode='train',dupe_factor=mlm_data_args.dupe_factor)
+        dataHelper.make_dataset_with_args(data_args.train_file,mixed_data=False,shuffle=True,mode='train')
     if data_args.do_eval:
         dataHelper.make_dataset_with_args(data_args.eval_file,shuffle=False,mode='eval')
     if data_args.do_test:
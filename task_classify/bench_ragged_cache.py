@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+# tnews 缓存: padding 到 max_seq_length vs 只保存 seqlen 个 token (collate 时补齐)
+# 合成 tnews 长度的句子 (10~40 字) 2 万条, record 后端 (GZIP) 文件大小与读取耗时, memory_raw 内存占用
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+import torch
+from deep_training.data_helper import ModelArguments, TrainingArguments, DataArguments
+from deep_training.data_helper.data_writer import DataWriteHelper
+from fastdatasets.utils.numpyadapter import NumpyReaderAdapter
+from transformers import BertTokenizer, HfArgumentParser
+
+from task_tnews import NN_DataHelper, train_info_args
+
+
+def on_data_process_padded(data, args):
+    # 原 on_data_process : padding 到 max_seq_length 并保存 attention_mask
+    dataHelper, mode = args
+    d = dataHelper.on_data_process(data, mode)
+    max_seq_length = dataHelper.max_seq_length_dict[mode]
+    pad_len = max_seq_length - len(d['input_ids'])
+    d['attention_mask'] = np.pad(np.ones_like(d['input_ids']), (0, pad_len), 'constant', constant_values=(0, 0))
+    d['input_ids'] = np.pad(d['input_ids'], (0, pad_len), 'constant', constant_values=(0, 0))
+    return d
+
+
+def on_data_process_ragged(data, args):
+    dataHelper, mode = args
+    return dataHelper.on_data_process(data, mode)
+
+
+def collate_fn_padded(batch):
+    o = {}
+    for i, b in enumerate(batch):
+        if i == 0:
+            for k in b:
+                o[k] = [torch.tensor(b[k])]
+        else:
+            for k in b:
+                o[k].append(torch.tensor(b[k]))
+    for k in o:
+        o[k] = torch.stack(o[k])
+    max_len = torch.max(o.pop('seqlen'))
+    o['input_ids'] = o['input_ids'][:, :max_len]
+    o['attention_mask'] = o['attention_mask'][:, :max_len]
+    return o
+
+
+if __name__ == '__main__':
+    rng = np.random.RandomState(123456)
+    tmp_dir = tempfile.mkdtemp()
+    label_file = os.path.join(tmp_dir, 'labels.json')
+    with open(label_file, mode='w', encoding='utf-8') as f:
+        for i in range(15):
+            f.write(json.dumps({'label': str(100 + i)}) + '\n')
+    parser = HfArgumentParser((ModelArguments, TrainingArguments, DataArguments))
+    model_args, training_args, data_args = parser.parse_dict(dict(train_info_args, label_file=[label_file]))
+    dataHelper = NN_DataHelper(model_args, training_args, data_args)
+    dataHelper.tokenizer = BertTokenizer.from_pretrained(
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), '../pretraining/t5encoder_mlm_pretrain/t5_base_config'))
+
+    chars = [t for t in dataHelper.tokenizer.get_vocab() if len(t) == 1 and '一' <= t <= '鿿']
+    corpus = [(''.join(rng.choice(chars, rng.randint(10, 41))), str(100 + rng.randint(0, 15))) for _ in range(20000)]
+
+    results = {}
+    for name, fn, collate_fn in [('padded', on_data_process_padded, collate_fn_padded),
+                                 ('ragged', on_data_process_ragged, dataHelper.collate_fn)]:
+        records = [fn(x, (dataHelper, 'train')) for x in corpus]
+        mem = sum(v.nbytes for d in records for v in d.values())
+
+        outfile = os.path.join(tmp_dir, name + '.record')
+        DataWriteHelper(fn, (dataHelper, 'train'), outfile, 'record', shuffle=False).save(corpus)
+        size = os.path.getsize(outfile)
+        start = time.time()
+        loaded = [d for d in NumpyReaderAdapter.load(outfile, 'record')]
+        t_load = time.time() - start
+        assert len(loaded) == len(corpus)
+
+        batches = [loaded[i: i + 32] for i in range(0, len(loaded), 32)]
+        start = time.time()
+        outputs = [collate_fn(b) for b in batches]
+        t_collate = time.time() - start
+        results[name] = (mem, size, t_load, outputs)
+        print('{} memory {:.1f}MB record {:.2f}MB load {:.2f}s collate {:.1f}ms/batch'.format(
+            name, mem / 2 ** 20, size / 2 ** 20, t_load, t_collate / len(batches) * 1000))
+
+    # 两种缓存 collate 结果一致
+    for a, b in zip(results['padded'][3], results['ragged'][3]):
+        assert torch.equal(a['input_ids'], b['input_ids']) and torch.equal(a['attention_mask'], b['attention_mask'])
+    print('memory {:.1f}x smaller, record {:.1f}x smaller, load {:.1f}x faster'.format(
+        results['padded'][0] / results['ragged'][0], results['padded'][1] / results['ragged'][1],
+        results['padded'][2] / results['ragged'][2]))
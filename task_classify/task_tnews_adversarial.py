@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 import json
 import logging
+import os
+import sys
 import typing
 
 import numpy as np
@@ -16,6 +18,9 @@ from torch.utils.data import DataLoader, IterableDataset
 from tqdm import tqdm
 from transformers import HfArgumentParser, BertTokenizer
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.collate import pad_collate
+
 train_info_args = {
     'devices': 1,
     'data_backend': 'memory_raw',
@@ -67,19 +72,13 @@ class NN_DataHelper(DataHelper):
         sentence, label_str = data
 
         o = tokenizer(sentence, max_length=max_seq_length, truncation=True, add_special_tokens=True, )
+        # 只保存 seqlen 个 token , padding 及 attention_mask 在 collate_fn 中生成
         input_ids = np.asarray(o['input_ids'], dtype=np.int64)
-        attention_mask = np.asarray(o['attention_mask'], dtype=np.int64)
 
         labels = np.asarray(label2id[label_str] if label_str is not None else 0, dtype=np.int64)
         seqlen = np.asarray(len(input_ids), dtype=np.int64)
-        pad_len = max_seq_length - len(input_ids)
-        if pad_len > 0:
-            pad_val = tokenizer.pad_token_id
-            input_ids = np.pad(input_ids, (0, pad_len), 'constant', constant_values=(pad_val, pad_val))
-            attention_mask = np.pad(attention_mask, (0, pad_len), 'constant', constant_values=(0, 0))
         d = {
             'input_ids': input_ids,
-            'attention_mask': attention_mask,
             'labels': labels,
             'seqlen': seqlen
         }
@@ -119,24 +118,7 @@ class NN_DataHelper(DataHelper):
         return D[0:1000] if mode == 'train' else D[:100]
 
     def collate_fn(self,batch):
-        o = {}
-        for i, b in enumerate(batch):
-            if i == 0:
-                for k in b:
-                    o[k] = [torch.tensor(b[k])]
-            else:
-                for k in b:
-                    o[k].append(torch.tensor(b[k]))
-        for k in o:
-            o[k] = torch.stack(o[k])
-
-        max_len = torch.max(o.pop('seqlen'))
-
-        o['input_ids'] = o['input_ids'][:, :max_len]
-        o['attention_mask'] = o['attention_mask'][:, :max_len]
-        if 'token_type_ids' in o:
-            o['token_type_ids'] = o['token_type_ids'][:, :max_len]
-        return o
+        return pad_collate(batch, pad_values={'input_ids': self.tokenizer.pad_token_id})
 
 
 class MyTransformer(TransformerForSequenceClassification, with_pl=True):
@@ -1,7 +1,10 @@
 # -*- coding: utf-8 -*-
 # @Time    : 2022/12/23 15:45
+import copy
 import json
 import logging
+import os
+import sys
 import typing
 
 import numpy as np
@@ -15,6 +18,12 @@ from torch.utils.data import DataLoader, IterableDataset
 from tqdm import tqdm
 from transformers import HfArgumentParser, BertTokenizer
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.char_table import get_char_id_table
+from common.dataset_builder import ParallelDataHelperMixin
+from common.dataset_cache import FingerprintCacheMixin
+from common.gplinker_labels import encode_sparse_labels, get_target_len, densify_sparse_labels
+
 train_info_args = {
     'devices': 1,
     'data_backend': 'memory_raw',
@@ -45,8 +54,11 @@ train_info_args = {
     'test_max_seq_length': 512,
 }
 
+# 制作缓存的进程数, 0 为单进程
+num_process_worker = os.cpu_count() or 0
+
 
-class NN_DataHelper(DataHelper):
+class NN_DataHelper(FingerprintCacheMixin, ParallelDataHelperMixin, DataHelper):
     index = -1
     eval_labels = []
 
@@ -62,21 +74,13 @@ class NN_DataHelper(DataHelper):
         do_lower_case = tokenizer.do_lower_case
         label2id = self.label2id
         sentence, event_list = data
-        tokens = list(sentence) if not do_lower_case else list(sentence.lower())
-        if len(tokens) > max_seq_length - 2:
-            tokens = tokens[0:(max_seq_length - 2)]
-        input_ids = tokenizer.convert_tokens_to_ids(['[CLS]'] + tokens + ['[SEP]'])
+        input_ids = get_char_id_table(tokenizer, do_lower_case).encode(sentence)[:max_seq_length - 2].tolist()
+        input_ids = [tokenizer.cls_token_id] + input_ids + [tokenizer.sep_token_id]
         seqlen = len(input_ids)
         attention_mask = [1] * seqlen
         input_ids = np.asarray(input_ids, dtype=np.int32)
         attention_mask = np.asarray(attention_mask, dtype=np.int32)
 
-        max_target_len1 = 64
-        max_target_len2 = 512
-        entity_labels = np.zeros(shape=(len(label2id), max_target_len1, 2), dtype=np.int32)
-        head_labels = np.zeros(shape=(1, max_target_len2, 2), dtype=np.int32)
-        tail_labels = np.zeros(shape=(1, max_target_len2, 2), dtype=np.int32)
-
         entity_labels_tmp = [set() for _ in range(len(label2id))]
         head_labels_tmp = [set() for _ in range(1)]
         tail_labels_tmp = [set() for _ in range(1)]
@@ -110,21 +114,11 @@ class NN_DataHelper(DataHelper):
                         tail_labels_tmp[0].add((min(t1, t2), max(t1, t2)))
             real_label.append(true_event)
 
-        def feed_label(x, pts_list):
-            tlens = [1]
-            for p, pts in enumerate(pts_list):
-                tlens.append(len(pts))
-                for seq, pos in enumerate(pts):
-                    x[p][seq][0] = pos[0]
-                    x[p][seq][1] = pos[1]
-            return np.max(tlens)
-
-        targetlen1 = feed_label(entity_labels, list(map(lambda x: list(x), entity_labels_tmp)))
-        targetlen2 = feed_label(head_labels, list(map(lambda x: list(x), head_labels_tmp)))
-        targetlen3 = feed_label(tail_labels, list(map(lambda x: list(x), tail_labels_tmp)))
-
-        targetlen1 = np.asarray(targetlen1, dtype=np.int32)
-        targetlen2 = np.asarray(np.max([targetlen2, targetlen3]), dtype=np.int32)
+        # 稀疏存储 (label, start, end), collate_fn 中按批次还原
+        entity_labels = encode_sparse_labels(entity_labels_tmp)
+        head_labels = encode_sparse_labels(head_labels_tmp)
+        tail_labels = encode_sparse_labels(tail_labels_tmp)
+
         pad_len = max_seq_length - len(input_ids)
         if pad_len > 0:
             pad_val = tokenizer.pad_token_id
@@ -137,12 +131,10 @@ class NN_DataHelper(DataHelper):
             'head_labels': head_labels,
             'tail_labels': tail_labels,
             'seqlen': seqlen,
-            'targetlen1': targetlen1,
-            'targetlen2': targetlen2,
         }
 
         if self.index < 5:
-            print(tokens)
+            print(list(sentence.lower() if do_lower_case else sentence))
             print(input_ids[:seqlen])
 
         if mode == 'eval':
@@ -206,7 +198,12 @@ class NN_DataHelper(DataHelper):
 
     def collate_fn(self,batch):
         o = {}
+        sparse_keys = ['entity_labels', 'head_labels', 'tail_labels']
+        sparse_labels = {k: [] for k in sparse_keys}
         for i, b in enumerate(batch):
+            b = copy.copy(b)
+            for k in sparse_keys:
+                sparse_labels[k].append(b.pop(k))
             if i == 0:
                 for k in b:
                     o[k] = [torch.tensor(b[k])]
@@ -217,16 +214,16 @@ class NN_DataHelper(DataHelper):
             o[k] = torch.stack(o[k])
 
         max_len = torch.max(o.pop('seqlen'))
-        max_tarlen1 = torch.max(o.pop('targetlen1'))
-        max_tarlen2 = torch.max(o.pop('targetlen2'))
+        max_tarlen1 = get_target_len(sparse_labels['entity_labels'])
+        max_tarlen2 = max(get_target_len(sparse_labels['head_labels']), get_target_len(sparse_labels['tail_labels']))
 
         o['input_ids'] = o['input_ids'][:, :max_len]
         o['attention_mask'] = o['attention_mask'][:, :max_len]
         if 'token_type_ids' in o:
             o['token_type_ids'] = o['token_type_ids'][:, :max_len]
-        o['entity_labels'] = o['entity_labels'][:, :, :max_tarlen1]
-        o['head_labels'] = o['head_labels'][:, :, :max_tarlen2]
-        o['tail_labels'] = o['tail_labels'][:, :, :max_tarlen2]
+        o['entity_labels'] = densify_sparse_labels(sparse_labels['entity_labels'], len(self.label2id), max_tarlen1)
+        o['head_labels'] = densify_sparse_labels(sparse_labels['head_labels'], 1, max_tarlen2)
+        o['tail_labels'] = densify_sparse_labels(sparse_labels['tail_labels'], 1, max_tarlen2)
         return o
 
 
@@ -312,11 +309,11 @@ if __name__ == '__main__':
 
     # 缓存数据集
     if data_args.do_train:
-        dataHelper.make_dataset_with_args(data_args.train_file, shuffle=True,mode='train')
+        dataHelper.make_dataset_with_args(data_args.train_file, shuffle=True,mode='train', num_process_worker=num_process_worker)
     if data_args.do_eval:
-        dataHelper.make_dataset_with_args(data_args.eval_file, mode='eval')
+        dataHelper.make_dataset_with_args(data_args.eval_file, mode='eval', num_process_worker=num_process_worker)
     if data_args.do_test:
-        dataHelper.make_dataset_with_args(data_args.test_file,mode='test')
+        dataHelper.make_dataset_with_args(data_args.test_file,mode='test', num_process_worker=num_process_worker)
 
     model = MyTransformer(dataHelper.eval_labels, with_efficient=False, config=config, model_args=model_args,
                           training_args=training_args)
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+# 按字切分: tokenizer.convert_tokens_to_ids(list(sentence)) vs CharIdTable 查表
+# 一致性: 全部 unicode 码位逐个比较 (含大小写、全角、emoji), 代理码位 convert_tokens_to_ids 本身报错, 不比较
+# 速度: 合成 cluener 风格句子 (中文、英文大小写、数字、标点, 长度 20~50) 5 万条
+import os
+import sys
+import time
+
+import numpy as np
+from transformers import BertTokenizer
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.char_table import CharIdTable, get_char_id_table
+
+
+def convert_loop(tokenizer, sentences, do_lower_case):
+    # 原 on_data_process
+    return [tokenizer.convert_tokens_to_ids(list(s) if not do_lower_case else list(s.lower())) for s in sentences]
+
+
+if __name__ == '__main__':
+    tokenizer = BertTokenizer.from_pretrained(
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), '../pretraining/t5encoder_mlm_pretrain/t5_base_config'))
+
+    start = time.time()
+    table = CharIdTable(tokenizer)
+    print('build table {:.0f}ms do_lower_case {}'.format((time.time() - start) * 1000, table.do_lower_case))
+    assert get_char_id_table(tokenizer) is get_char_id_table(tokenizer)
+
+    all_chars = [chr(c) for c in range(0x110000) if not 0xD800 <= c < 0xE000]
+    for do_lower_case in (True, False):
+        t = CharIdTable(tokenizer, do_lower_case=do_lower_case)
+        expected = convert_loop(tokenizer, all_chars, do_lower_case)
+        got = t.encode_batch(all_chars)
+        assert all(list(a) == b for a, b in zip(got, expected))
+        sentence = ''.join(all_chars)
+        assert t.encode(sentence).tolist() == [i for ids in expected for i in ids]
+    print('all {} codepoints match convert_tokens_to_ids'.format(len(all_chars)))
+
+    rng = np.random.RandomState(123456)
+    vocab = tokenizer.get_vocab()
+    zh = [t for t in vocab if len(t) == 1 and '一' <= t <= '鿿']
+    others = list('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789，。、“”《》（）：！？·- ') + ['😀', 'Ⅳ']
+    pool = np.asarray(zh + others)
+    probs = np.asarray([0.85 / len(zh)] * len(zh) + [0.15 / len(others)] * len(others))
+    sentences = [''.join(rng.choice(pool, rng.randint(20, 51), p=probs)) for _ in range(50000)]
+
+    start = time.time()
+    expected = convert_loop(tokenizer, sentences, tokenizer.do_lower_case)
+    t_loop = time.time() - start
+    start = time.time()
+    got = [table.encode(s).tolist() for s in sentences]
+    t_encode = time.time() - start
+    start = time.time()
+    got_batch = table.encode_batch(sentences)
+    t_batch = time.time() - start
+    assert got == expected and all(list(a) == b for a, b in zip(got_batch, expected))
+    print('convert_tokens_to_ids {:.2f}s  encode {:.2f}s ({:.1f}x)  encode_batch {:.3f}s ({:.1f}x)'.format(
+        t_loop, t_encode, t_loop / t_encode, t_batch, t_loop / t_batch))
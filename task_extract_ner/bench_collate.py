@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+# collate_fn: 逐样本 torch.tensor + torch.stack 后截断 vs StackCollator 先截断再一次 np.stack
+# 字段形状与 cluener 缓存一致 (train_max_seq_length 380, 10 类), seqlen 为 cluener 句子长度 (20~50)
+import os
+import sys
+import timeit
+
+import numpy as np
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.collate import StackCollator
+
+
+def collate_fn_loop(batch, trim_fn):
+    # 原 collate_fn
+    o = {}
+    for i, b in enumerate(batch):
+        if i == 0:
+            for k in b:
+                o[k] = [torch.tensor(b[k])]
+        else:
+            for k in b:
+                o[k].append(torch.tensor(b[k]))
+    for k in o:
+        o[k] = torch.stack(o[k])
+    max_len = torch.max(o.pop('seqlen'))
+    o['input_ids'] = o['input_ids'][:, :max_len]
+    o['attention_mask'] = o['attention_mask'][:, :max_len]
+    if 'token_type_ids' in o:
+        o['token_type_ids'] = o['token_type_ids'][:, :max_len]
+    return trim_fn(o, max_len)
+
+
+def make_batch(rng, batch_size, max_seq_length, labels_shape_fn):
+    batch = []
+    for _ in range(batch_size):
+        seqlen = rng.randint(20, 51)
+        input_ids = np.zeros(max_seq_length, dtype=np.int64)
+        input_ids[:seqlen] = rng.randint(100, 21128, size=seqlen)
+        attention_mask = np.zeros(max_seq_length, dtype=np.int64)
+        attention_mask[:seqlen] = 1
+        labels = np.zeros(labels_shape_fn(max_seq_length), dtype=np.int32)
+        batch.append({
+            'input_ids': input_ids,
+            'attention_mask': attention_mask,
+            'token_type_ids': np.zeros(max_seq_length, dtype=np.int64),
+            'labels': labels,
+            'seqlen': np.asarray(seqlen, dtype=np.int64),
+        })
+    return batch
+
+
+if __name__ == '__main__':
+    rng = np.random.RandomState(123456)
+    batch_size, max_seq_length, num_labels = 32, 380, 10
+    cases = [
+        ('crf', lambda n: (n,), lambda o, n: dict(o, labels=o['labels'][:, :n]),
+         StackCollator(trim_axes={'labels': ('seqlen',)})),
+        ('pointer', lambda n: (num_labels, n, n), lambda o, n: dict(o, labels=o['labels'][:, :, :n, :n]),
+         StackCollator(trim_axes={'labels': (None, 'seqlen', 'seqlen')})),
+    ]
+    for name, labels_shape_fn, trim_fn, collator in cases:
+        batch = make_batch(rng, batch_size, max_seq_length, labels_shape_fn)
+        a, b = collate_fn_loop(batch, trim_fn), collator(batch)
+        assert a.keys() == b.keys()
+        for k in a:
+            assert a[k].dtype == b[k].dtype and torch.equal(a[k], b[k]), k
+        number = 20
+        t_loop = timeit.timeit(lambda: collate_fn_loop(batch, trim_fn), number=number) / number
+        t_stack = timeit.timeit(lambda: collator(batch), number=number) / number
+        print('{:<8} torch.stack {:.2f}ms  StackCollator {:.2f}ms  {:.1f}x'.format(
+            name, t_loop * 1000, t_stack * 1000, t_loop / t_stack))
+
+    # 锁页内存: 需要 cuda
+    if torch.cuda.is_available():
+        o = StackCollator(trim_axes={'labels': ('seqlen',)}, pin_memory=True)(
+            make_batch(rng, batch_size, max_seq_length, lambda n: (n,)))
+        assert all(v.is_pinned() for v in o.values())
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 import json
 import logging
+import os
+import sys
 import typing
 
 import numpy as np
@@ -17,6 +19,12 @@ from torch.utils.data import DataLoader, IterableDataset
 from tqdm import tqdm
 from transformers import HfArgumentParser, BertTokenizer
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.char_table import get_char_id_table
+from common.collate import StackCollator
+from common.dataset_builder import ParallelDataHelperMixin
+from common.dataset_cache import FingerprintCacheMixin
+
 train_info_args = {
     'devices': 1,
     'data_backend': 'memory_raw',
@@ -48,8 +56,11 @@ train_info_args = {
     'test_max_seq_length': 512,
 }
 
+# 制作缓存的进程数, 0 为单进程
+num_process_worker = os.cpu_count() or 0
+
 
-class NN_DataHelper(DataHelper):
+class NN_DataHelper(FingerprintCacheMixin, ParallelDataHelperMixin, DataHelper):
     index = 1
 
     def on_data_ready(self):
@@ -66,8 +77,7 @@ class NN_DataHelper(DataHelper):
         
         sentence, label_dict = data
 
-        tokens = list(sentence) if not do_lower_case else list(sentence.lower())
-        input_ids = tokenizer.convert_tokens_to_ids(tokens)
+        input_ids = get_char_id_table(tokenizer, do_lower_case).encode(sentence).tolist()
         if len(input_ids) > max_seq_length - 2:
             input_ids = input_ids[:max_seq_length - 2]
         input_ids = [tokenizer.cls_token_id] + input_ids + [tokenizer.sep_token_id]
@@ -108,7 +118,7 @@ class NN_DataHelper(DataHelper):
             'seqlen': seqlen,
         }
         if self.index < 5:
-            print(tokens)
+            print(list(sentence.lower() if do_lower_case else sentence))
             print(input_ids[:seqlen])
             print(attention_mask[:seqlen])
             print(labels[:seqlen])
@@ -140,24 +150,8 @@ class NN_DataHelper(DataHelper):
                     D.append((jd['text'], jd.get('label', None)))
         return D
 
-    def collate_fn(self,batch):
-        o = {}
-        for i, b in enumerate(batch):
-            if i == 0:
-                for k in b:
-                    o[k] = [torch.tensor(b[k])]
-            else:
-                for k in b:
-                    o[k].append(torch.tensor(b[k]))
-        for k in o:
-            o[k] = torch.stack(o[k])
-        max_len = torch.max(o.pop('seqlen'))
-        o['input_ids'] = o['input_ids'][:, :max_len]
-        o['attention_mask'] = o['attention_mask'][:, :max_len]
-        if 'token_type_ids' in o:
-            o['token_type_ids'] = o['token_type_ids'][:, :max_len]
-        o['labels'] = o['labels'][:, :max_len]
-        return o
+    def collate_fn(self, batch):
+        return StackCollator(trim_axes={'labels': ('seqlen',)})(batch)
 
 
 class MyTransformer(TransformerForCRF, with_pl=True):
@@ -266,11 +260,11 @@ if __name__ == '__main__':
 
     # 缓存数据集
     if data_args.do_train:
-        dataHelper.make_dataset_with_args(data_args.train_file, shuffle=True,mode='train')
+        dataHelper.make_dataset_with_args(data_args.train_file, shuffle=True,mode='train', num_process_worker=num_process_worker)
     if data_args.do_eval:
-        dataHelper.make_dataset_with_args(data_args.eval_file, mode='eval')
+        dataHelper.make_dataset_with_args(data_args.eval_file, mode='eval', num_process_worker=num_process_worker)
     if data_args.do_test:
-        dataHelper.make_dataset_with_args(data_args.test_file,mode='test')
+        dataHelper.make_dataset_with_args(data_args.test_file,mode='test', num_process_worker=num_process_worker)
 
 
     model = MyTransformer(config=config, model_args=model_args, training_args=training_args)
@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
 # 参考 https://github.com/princeton-nlp/PURE
 import copy
+import functools
 import json
 import logging
+import os
+import sys
 import typing
 
 import numpy as np
@@ -17,6 +20,11 @@ from torch.utils.data import DataLoader, IterableDataset
 from tqdm import tqdm
 from transformers import HfArgumentParser, BertTokenizer
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.char_table import get_char_id_table
+from common.dataset_builder import ParallelDataHelperMixin
+from common.dataset_cache import FingerprintCacheMixin
+
 train_info_args = {
     'devices': 1,
     'data_backend': 'memory_raw',
@@ -51,8 +59,29 @@ train_info_args = {
     'width_embedding_dim': 150,
 }
 
-
-class NN_DataHelper(DataHelper):
+# 制作缓存的进程数, 0 为单进程
+num_process_worker = os.cpu_count() or 0
+
+
+@functools.lru_cache(maxsize=128)
+def get_span_index(tokens_len, max_span_length):
+    '''
+        枚举 (i, j, j - i + 1), i <= j < i + max_span_length, 与逐个循环的顺序一致
+        return:
+            spans: (num_spans, 3)
+            span_ids: (tokens_len, tokens_len), (i, j) 在 spans 中的序号, 无效为 -1
+    '''
+    pos = np.arange(tokens_len)
+    i, j = np.meshgrid(pos, pos, indexing='ij')
+    valid = (j >= i) & (j < i + max_span_length)
+    i, j = i[valid], j[valid]
+    spans = np.stack([i, j, j - i + 1], axis=-1).astype(np.int32)
+    span_ids = np.full((tokens_len, tokens_len), -1, dtype=np.int64)
+    span_ids[i, j] = np.arange(len(spans))
+    return spans, span_ids
+
+
+class NN_DataHelper(FingerprintCacheMixin, ParallelDataHelperMixin, DataHelper):
     index = -1
     eval_labels = []
 
@@ -71,8 +100,7 @@ class NN_DataHelper(DataHelper):
         label2id = self.label2id
         sentence, entities = data
 
-        tokens = list(sentence) if not do_lower_case else list(sentence.lower())
-        input_ids = tokenizer.convert_tokens_to_ids(tokens)
+        input_ids = get_char_id_table(tokenizer, do_lower_case).encode(sentence).tolist()
         if len(input_ids) > max_seq_length - 2:
             input_ids = input_ids[:max_seq_length - 2]
         input_ids = [tokenizer.cls_token_id] + input_ids + [tokenizer.sep_token_id]
@@ -176,29 +204,32 @@ class NN_DataHelper(DataHelper):
         max_span_length = self.external_kwargs['max_span_length'] if self.external_kwargs['max_span_length'] > 0 else tokens_len
         max_span_length = min(max_span_length, tokens_len)
 
-        labels = []
-        spans = []
-        spans_mask = []
+        tokens_len = int(tokens_len)
+        max_span_length = int(max_span_length)
+        bs = len(batch)
         has_label = labels_fakes[0] is not None
-        #
-        for labels_fake, seqlen in zip(labels_fakes, seqlens):
-            if has_label:
-                labels_map = {tuple(ldata[1:]): ldata[0] for ldata in labels_fake}
-            label, span, span_mask = [], [], []
-            for i in range(tokens_len):
-                for j in range(i, min(i + max_span_length, tokens_len)):
-                    span.append((i, j, j - i + 1))
-                    span_mask.append(1 if i < seqlen and j < seqlen else 0)
-                    if has_label:
-                        label.append(labels_map.get((i, j), 0))
-            if has_label:
-                labels.append(label)
-            spans.append(span)
-            spans_mask.append(span_mask)
-
-        spans = torch.tensor(spans, dtype=torch.int32)
-        spans_mask = torch.tensor(spans_mask, dtype=torch.int32)
-        labels = torch.tensor(labels, dtype=torch.int32)
+        span_index, span_ids = get_span_index(tokens_len, max_span_length)
+        # 只缓存 numpy 索引, 每个批次 repeat 出独立的 tensor , 避免批次间共享内存
+        spans = torch.from_numpy(span_index).unsqueeze(0).repeat(bs, 1, 1)
+        # i <= j, 故 j < seqlen 即 i < seqlen and j < seqlen
+        spans_mask = torch.from_numpy(
+            (span_index[None, :, 1] < seqlens.numpy().reshape((-1, 1))).astype(np.int32))
+
+        if has_label:
+            labels = np.zeros((bs, len(span_index)), dtype=np.int32)
+            label_list = [np.asarray(label, dtype=np.int32).reshape((-1, 3)) for label in labels_fakes]
+            b = np.repeat(np.arange(bs), [len(label) for label in label_list])
+            l, s, e = np.concatenate(label_list, axis=0).T
+            keep = (s < tokens_len) & (e < tokens_len) & (s <= e)
+            b, l, s, e = b[keep], l[keep], s[keep], e[keep]
+            ids = span_ids[s, e]
+            keep = ids >= 0
+            # 重复标注以最后一个为准: numpy 不保证重复下标的赋值顺序, 先按展开下标去重, 保留最后一次出现
+            flat_index, l = (b * len(span_index) + ids)[keep], l[keep]
+            _, last = np.unique(flat_index[::-1], return_index=True)
+            last = len(flat_index) - 1 - last
+            np.put(labels, flat_index[last], l[last])
+            labels = torch.from_numpy(labels)
 
         o['input_ids'] = o['input_ids'][:, :max_len]
         o['attention_mask'] = o['attention_mask'][:, :max_len]
@@ -285,11 +316,11 @@ if __name__ == '__main__':
 
     # 缓存数据集
     if data_args.do_train:
-        dataHelper.make_dataset_with_args(data_args.train_file, shuffle=True,mode='train')
+        dataHelper.make_dataset_with_args(data_args.train_file, shuffle=True,mode='train', num_process_worker=num_process_worker)
     if data_args.do_eval:
-        dataHelper.make_dataset_with_args(data_args.eval_file, mode='eval')
+        dataHelper.make_dataset_with_args(data_args.eval_file, mode='eval', num_process_worker=num_process_worker)
     if data_args.do_test:
-        dataHelper.make_dataset_with_args(data_args.test_file,mode='test')
+        dataHelper.make_dataset_with_args(data_args.test_file,mode='test', num_process_worker=num_process_worker)
 
     model = MyTransformer(dataHelper.eval_labels, puremodel_args=puremodel_args, config=config, model_args=model_args,
                           training_args=training_args)
@@ -2,6 +2,8 @@
 import copy
 import json
 import logging
+import os
+import sys
 import typing
 
 import numpy as np
@@ -17,6 +19,11 @@ from torch.utils.data import DataLoader, IterableDataset
 from tqdm import tqdm
 from transformers import HfArgumentParser, BertTokenizer
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.char_table import get_char_id_table
+from common.dataset_builder import ParallelDataHelperMixin
+from common.dataset_cache import FingerprintCacheMixin
+
 train_info_args = {
     'devices': 1,
     'data_backend': 'memory_raw',
@@ -55,8 +62,11 @@ train_info_args = {
     'scheduler': {'T_mult': 1, 'rewarm_epoch_num': 2, 'verbose': False},
 }
 
+# 制作缓存的进程数, 0 为单进程
+num_process_worker = os.cpu_count() or 0
+
 
-class NN_DataHelper(DataHelper):
+class NN_DataHelper(FingerprintCacheMixin, ParallelDataHelperMixin, DataHelper):
     # 是否固定输入最大长度 ， 如果固定训练会慢 ，指标收敛快 ，如不固定训练快，指标收敛慢些
     is_fixed_input_length = True
     #
@@ -83,10 +93,8 @@ class NN_DataHelper(DataHelper):
         if mode == 'train':
             max_seq_length = min(max_seq_length, self.max_text_length + 2)
 
-        tokens = list(sentence) if not do_lower_case else list(sentence.lower())
-        if len(tokens) > max_seq_length - 2:
-            tokens = tokens[0:(max_seq_length - 2)]
-        input_ids = tokenizer.convert_tokens_to_ids(['[CLS]'] + tokens + ['[SEP]'])
+        input_ids = get_char_id_table(tokenizer, do_lower_case).encode(sentence)[:max_seq_length - 2].tolist()
+        input_ids = [tokenizer.cls_token_id] + input_ids + [tokenizer.sep_token_id]
         seqlen = len(input_ids)
         attention_mask = [1] * seqlen
         input_ids = np.asarray(input_ids, dtype=np.int32)
@@ -115,7 +123,7 @@ class NN_DataHelper(DataHelper):
         }
 
         if self.index < 5:
-            print(tokens)
+            print(list(sentence.lower() if do_lower_case else sentence))
             print(input_ids[:seqlen])
 
         if mode == 'eval':
@@ -299,11 +307,11 @@ if __name__ == '__main__':
 
     # 缓存数据集
     if data_args.do_train:
-        dataHelper.make_dataset_with_args(data_args.train_file, shuffle=True,mode='train')
+        dataHelper.make_dataset_with_args(data_args.train_file, shuffle=True,mode='train', num_process_worker=num_process_worker)
     if data_args.do_eval:
-        dataHelper.make_dataset_with_args(data_args.eval_file, mode='eval')
+        dataHelper.make_dataset_with_args(data_args.eval_file, mode='eval', num_process_worker=num_process_worker)
     if data_args.do_test:
-        dataHelper.make_dataset_with_args(data_args.test_file, shuffle=False,mode='test')
+        dataHelper.make_dataset_with_args(data_args.test_file, shuffle=False,mode='test', num_process_worker=num_process_worker)
 
 
     model = MyTransformer(dataHelper.eval_labels, tplinker_args=tplinker_args, config=config, model_args=model_args,
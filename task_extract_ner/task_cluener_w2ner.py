@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 import json
 import logging
+import os
+import sys
 import typing
 
 import numpy as np
@@ -16,6 +18,12 @@ from torch.utils.data import DataLoader, IterableDataset
 from tqdm import tqdm
 from transformers import HfArgumentParser, BertTokenizer
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.char_table import get_char_id_table
+from common.collate import StackCollator
+from common.dataset_builder import ParallelDataHelperMixin
+from common.dataset_cache import FingerprintCacheMixin
+
 train_info_args = {
     'devices': 1,
     'data_backend': 'memory_raw',
@@ -60,25 +68,52 @@ train_info_args = {
 
 }
 
-
-class NN_DataHelper(DataHelper):
+# 制作缓存的进程数, 0 为单进程
+num_process_worker = os.cpu_count() or 0
+
+
+def make_dis2idx():
+    dis2idx = np.zeros((1000), dtype='int64')
+    dis2idx[1] = 1
+    dis2idx[2:] = 2
+    dis2idx[4:] = 3
+    dis2idx[8:] = 4
+    dis2idx[16:] = 5
+    dis2idx[32:] = 6
+    dis2idx[64:] = 7
+    dis2idx[128:] = 8
+    dis2idx[256:] = 9
+    return dis2idx
+
+
+def build_w2ner_grid(seqlens, max_len, dis2idx):
+    '''
+        按批次真实长度生成 pieces2word, dist_inputs, grid_mask2d
+        seqlens: (bs,)
+        return: (bs, max_len, max_len) x 3
+    '''
+    seqlens = np.asarray(seqlens).reshape((-1, 1))
+    pos = np.arange(max_len)
+    # i - j 相对距离查表, 负距离偏移 9, 距离 0 为 19
+    dist = pos[:, None] - pos[None, :]
+    dist_idx = dis2idx[np.abs(dist)]
+    dist = np.where(dist < 0, dist_idx + 9, dist_idx).astype(np.int32)
+    dist[dist == 0] = 19
+
+    valid = pos[None, :] < seqlens
+    grid_mask2d = valid[:, :, None] & valid[:, None, :]
+    pieces2word = np.eye(max_len, k=1, dtype=bool)[None] & grid_mask2d
+    dist_inputs = dist[None] * grid_mask2d
+    return pieces2word, dist_inputs, grid_mask2d
+
+
+class NN_DataHelper(FingerprintCacheMixin, ParallelDataHelperMixin, DataHelper):
     index = -1
     eval_labels = []
 
     def __init__(self, *args, **kwargs):
         super(NN_DataHelper, self).__init__(*args, **kwargs)
-        dis2idx = np.zeros((1000), dtype='int64')
-        dis2idx[1] = 1
-        dis2idx[2:] = 2
-        dis2idx[4:] = 3
-        dis2idx[8:] = 4
-        dis2idx[16:] = 5
-        dis2idx[32:] = 6
-        dis2idx[64:] = 7
-        dis2idx[128:] = 8
-        dis2idx[256:] = 9
-
-        self.dis2idx = dis2idx
+        self.dis2idx = make_dis2idx()
 
     # 切分成开始
     def on_data_ready(self):
@@ -95,8 +130,7 @@ class NN_DataHelper(DataHelper):
         label2id = self.label2id
         sentence, entities = data
 
-        tokens = list(sentence) if not do_lower_case else list(sentence.lower())
-        input_ids = tokenizer.convert_tokens_to_ids(tokens)
+        input_ids = get_char_id_table(tokenizer, do_lower_case).encode(sentence).tolist()
         if len(input_ids) > max_seq_length - 2:
             input_ids = input_ids[:max_seq_length - 2]
         input_ids = [tokenizer.cls_token_id] + input_ids + [tokenizer.sep_token_id]
@@ -109,24 +143,6 @@ class NN_DataHelper(DataHelper):
         real_label = []
         length = len(input_ids)
         grid_labels = np.zeros((length, length), dtype=np.int32)
-        pieces2word = np.zeros((length, length), dtype=bool)
-        dist_inputs = np.zeros((length, length), dtype=np.int32)
-        grid_mask2d = np.ones((length, length), dtype=bool)
-
-        for i in range(seqlen - 1):
-            for j in range(i + 1, i + 2):
-                pieces2word[i][j] = 1
-        for k in range(seqlen):
-            dist_inputs[k, :] += k
-            dist_inputs[:, k] -= k
-
-        for i in range(length):
-            for j in range(length):
-                if dist_inputs[i, j] < 0:
-                    dist_inputs[i, j] = self.dis2idx[-dist_inputs[i, j]] + 9
-                else:
-                    dist_inputs[i, j] = self.dis2idx[dist_inputs[i, j]]
-        dist_inputs[dist_inputs == 0] = 19
 
         if entities is not None:
             for l, s, e in entities:
@@ -146,17 +162,12 @@ class NN_DataHelper(DataHelper):
             attention_mask = np.pad(attention_mask, (0, pad_len), 'constant', constant_values=(0, 0))
 
             grid_labels = np.pad(grid_labels, pad_width=((0, pad_len), (0, pad_len)))
-            pieces2word = np.pad(pieces2word, pad_width=((0, pad_len), (0, pad_len)))
-            dist_inputs = np.pad(dist_inputs, pad_width=((0, pad_len), (0, pad_len)))
-            grid_mask2d = np.pad(grid_mask2d, pad_width=((0, pad_len), (0, pad_len)))
 
+        # pieces2word, dist_inputs, grid_mask2d 只与长度有关, 在 collate_fn 中按批次生成
         d = {
             'input_ids': input_ids,
             'attention_mask': attention_mask,
             'labels': grid_labels,
-            'pieces2word': pieces2word,
-            'dist_inputs': dist_inputs,
-            'grid_mask2d': grid_mask2d,
             'seqlen': seqlen,
         }
 
@@ -207,28 +218,15 @@ class NN_DataHelper(DataHelper):
                     D.append((jd['text'], entities_label))
         return D
 
-    def collate_fn(self,batch):
-        o = {}
-        for i, b in enumerate(batch):
-            if i == 0:
-                for k in b:
-                    o[k] = [torch.tensor(b[k])]
-            else:
-                for k in b:
-                    o[k].append(torch.tensor(b[k]))
-        for k in o:
-            o[k] = torch.stack(o[k])
-
-        max_len = torch.max(o.pop('seqlen'))
-        o['input_ids'] = o['input_ids'][:, :max_len]
-        o['attention_mask'] = o['attention_mask'][:, :max_len]
-        if 'token_type_ids' in o:
-            o['token_type_ids'] = o['token_type_ids'][:, :max_len]
-        o['labels'] = o['labels'][:, :max_len, :max_len]
-        o['pieces2word'] = o['pieces2word'][:, :max_len, :max_len]
-        o['dist_inputs'] = o['dist_inputs'][:, :max_len, :max_len]
-        o['grid_mask2d'] = o['grid_mask2d'][:, :max_len, :max_len]
+    def collate_fn(self, batch):
+        seqlen = np.asarray([np.squeeze(b['seqlen']) for b in batch])
+        max_len = int(np.max(seqlen))
+        o = StackCollator(trim_axes={'labels': ('seqlen', 'seqlen')})(batch)
 
+        pieces2word, dist_inputs, grid_mask2d = build_w2ner_grid(seqlen, max_len, self.dis2idx)
+        o['pieces2word'] = torch.from_numpy(pieces2word)
+        o['dist_inputs'] = torch.from_numpy(dist_inputs)
+        o['grid_mask2d'] = torch.from_numpy(grid_mask2d)
         return o
 
 
@@ -325,11 +323,11 @@ if __name__ == '__main__':
 
     # 缓存数据集
     if data_args.do_train:
-        dataHelper.make_dataset_with_args(data_args.train_file, shuffle=True,mode='train')
+        dataHelper.make_dataset_with_args(data_args.train_file, shuffle=True,mode='train', num_process_worker=num_process_worker)
     if data_args.do_eval:
-        dataHelper.make_dataset_with_args(data_args.eval_file, mode='eval')
+        dataHelper.make_dataset_with_args(data_args.eval_file, mode='eval', num_process_worker=num_process_worker)
     if data_args.do_test:
-        dataHelper.make_dataset_with_args(data_args.test_file,mode='test')
+        dataHelper.make_dataset_with_args(data_args.test_file,mode='test', num_process_worker=num_process_worker)
 
     model = MyTransformer(dataHelper.eval_labels, w2nerArguments=w2nerArguments, config=config, model_args=model_args,
                           training_args=training_args)
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+# gplinker 标签缓存: 稠密 (num_labels, 60, 2) + targetlen vs common.gplinker_labels 稀疏 (n, 3)
+# 对比 record 缓存大小、读取缓存 examples/s 、collate_fn examples/s
+# 一致性: 两种格式 collate_fn 输出的张量一致
+# 语料: 合成 gplinker 关系抽取样本 (句子长度 20~120, 每句 1~4 个三元组, 48 个关系) 5000 条
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+from deep_training.data_helper import ModelArguments, TrainingArguments, DataArguments
+from transformers import HfArgumentParser
+
+from bench_parallel_builder import RecordDataHelper, make_corpus, load_records
+from task_relation_gplinker import train_info_args
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.gplinker_labels import get_target_len, densify_sparse_labels
+
+label_keys = ['entity_labels', 'head_labels', 'tail_labels']
+
+
+class DenseRecordDataHelper(RecordDataHelper):
+    # 原实现: 每组标签按 max_target_len = 60 稠密存储, 另存 targetlen
+    max_target_len = 60
+
+    def on_data_process(self, data, mode):
+        d = super(DenseRecordDataHelper, self).on_data_process(data, mode)
+        sparse_list = [d[k] for k in label_keys]
+        d['targetlen'] = np.asarray(max(get_target_len([x]) for x in sparse_list), dtype=np.int32)
+        for k, num_labels in zip(label_keys, [2, len(self.label2id), len(self.label2id)]):
+            d[k] = densify_sparse_labels([d[k]], num_labels, self.max_target_len)[0].numpy()
+        return d
+
+    def collate_fn(self, batch):
+        # 原 collate_fn
+        o = {}
+        for i, b in enumerate(batch):
+            if i == 0:
+                for k in b:
+                    o[k] = [torch.tensor(b[k])]
+            else:
+                for k in b:
+                    o[k].append(torch.tensor(b[k]))
+        for k in o:
+            o[k] = torch.stack(o[k])
+
+        max_len = torch.max(o.pop('seqlen'))
+        max_tarlen = torch.max(o.pop('targetlen'))
+
+        o['input_ids'] = o['input_ids'][:, :max_len]
+        o['attention_mask'] = o['attention_mask'][:, :max_len]
+        if 'token_type_ids' in o:
+            o['token_type_ids'] = o['token_type_ids'][:, :max_len]
+        for k in label_keys:
+            o[k] = o[k][:, :, :max_tarlen]
+        return o
+
+
+def bench_collate(data_helper, records, batch_size):
+    batches = [records[i: i + batch_size] for i in range(0, len(records), batch_size)]
+    start = time.time()
+    outputs = [data_helper.collate_fn(batch) for batch in batches]
+    return time.time() - start, outputs
+
+
+if __name__ == '__main__':
+    num, batch_size = 5000, 8
+    work_dir = tempfile.mkdtemp(prefix='bench_gplinker_labels_')
+    labels = ['人物+{}+人物'.format(i) for i in range(48)]
+    label_file = os.path.join(work_dir, 'labels.json')
+    with open(label_file, mode='w', encoding='utf-8') as f:
+        for label in labels:
+            s, p, o = label.split('+')
+            f.write(json.dumps({'subject': s, 'predicate': p, 'object': o}, ensure_ascii=False) + '\n')
+
+    tokenizer_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../pretraining/t5encoder_mlm_pretrain/t5_base_config')
+    args = dict(train_info_args, tokenizer_name=tokenizer_dir, model_name_or_path=tokenizer_dir,
+                config_name=os.path.join(tokenizer_dir, 'config.json'), label_file=[label_file], output_dir=work_dir,
+                data_backend='record')
+    parser = HfArgumentParser((ModelArguments, TrainingArguments, DataArguments))
+    model_args, training_args, data_args = parser.parse_dict(args)
+    data = make_corpus(num, labels)
+
+    outputs = {}
+    for name, cls in (('dense', DenseRecordDataHelper), ('sparse', RecordDataHelper)):
+        dataHelper = cls(model_args, training_args, data_args)
+        dataHelper.load_tokenizer_and_config(with_print_labels=False, with_print_config=False)
+        outfile = os.path.join(work_dir, 'train-{}.record'.format(name))
+        dataHelper.make_dataset(outfile, data, 'train', num_process_worker=0, shuffle=False)
+
+        start = time.time()
+        records = load_records(outfile)
+        t_load = time.time() - start
+        t_collate, outputs[name] = bench_collate(dataHelper, records, batch_size)
+        print('{:<6} cache {:.1f}MB  load {:.0f} examples/s  collate_fn {:.0f} examples/s (batch_size {})'.format(
+            name, os.path.getsize(outfile) / 1024 / 1024, num / t_load, num / t_collate, batch_size))
+
+    for a, b in zip(outputs['dense'], outputs['sparse']):
+        assert a.keys() == b.keys() and all(torch.equal(a[k], b[k]) for k in a)
+    print('sparse collate_fn equal to dense collate_fn')
+    shutil.rmtree(work_dir, ignore_errors=True)
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+# 制作缓存: 单进程 make_dataset vs ParallelDataHelperMixin 按区间多进程
+# 一致性: 输出顺序、eval_labels 与单进程一致, record 分片拼接后条数、内容一致
+# 语料: 合成 gplinker 关系抽取样本 (句子长度 20~120, 每句 1~4 个三元组) 2 万条
+import copy
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+from deep_training.data_helper import ModelArguments, TrainingArguments, DataArguments
+from fastdatasets.record import load_dataset as Loader, RECORD
+from transformers import HfArgumentParser
+
+from task_relation_gplinker import NN_DataHelper, train_info_args
+
+
+class RecordDataHelper(NN_DataHelper):
+    # record 后端要求字段均为 np.ndarray
+    def on_data_process(self, data, mode):
+        d = super(RecordDataHelper, self).on_data_process(data, mode)
+        return {k: np.asarray(v) for k, v in d.items()}
+
+
+def make_corpus(num, labels):
+    rng = np.random.RandomState(123456)
+    chars = [chr(c) for c in range(0x4e00, 0x4e00 + 3000)]
+    D = []
+    for _ in range(num):
+        text = ''.join(rng.choice(chars, rng.randint(20, 121)))
+        spoes = []
+        for _ in range(rng.randint(1, 5)):
+            s, o = sorted(rng.randint(0, len(text) - 4, size=2))
+            spoes.append(((s, s + 2), labels[rng.randint(len(labels))], (o, o + 2)))
+        D.append((text, None, spoes))
+    return D
+
+
+def build(data_helper, outfile, data, mode, num_process_worker):
+    data_helper.eval_labels.clear()
+    start = time.time()
+    data_helper.make_dataset(outfile, data, mode, num_process_worker=num_process_worker, shuffle=False)
+    return time.time() - start, copy.deepcopy(data_helper.eval_labels)
+
+
+def load_records(filename):
+    dataset = Loader.RandomDataset(filename, options=RECORD.TFRecordOptions(compression_type='GZIP'))
+    dataset = dataset.parse_from_numpy_writer()
+    return [dataset[i] for i in range(len(dataset))]
+
+
+def assert_equal(a, b):
+    assert len(a) == len(b)
+    for x, y in zip(a, b):
+        assert x.keys() == y.keys() and all(np.array_equal(x[k], y[k]) for k in x)
+
+
+if __name__ == '__main__':
+    num, num_process_worker = 20000, max(2, os.cpu_count() or 1)
+    work_dir = tempfile.mkdtemp(prefix='bench_parallel_builder_')
+    labels = ['人物+{}+人物'.format(i) for i in range(48)]
+    label_file = os.path.join(work_dir, 'labels.json')
+    with open(label_file, mode='w', encoding='utf-8') as f:
+        for label in labels:
+            s, p, o = label.split('+')
+            f.write(json.dumps({'subject': s, 'predicate': p, 'object': o}, ensure_ascii=False) + '\n')
+
+    tokenizer_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../pretraining/t5encoder_mlm_pretrain/t5_base_config')
+    args = dict(train_info_args, tokenizer_name=tokenizer_dir, model_name_or_path=tokenizer_dir,
+                config_name=os.path.join(tokenizer_dir, 'config.json'), label_file=[label_file], output_dir=work_dir)
+    parser = HfArgumentParser((ModelArguments, TrainingArguments, DataArguments))
+    model_args, training_args, data_args = parser.parse_dict(args)
+    data = make_corpus(num, labels)
+
+    for backend in ('memory_raw', 'record'):
+        data_args.data_backend = backend
+        dataHelper = (RecordDataHelper if backend == 'record' else NN_DataHelper)(model_args, training_args, data_args)
+        dataHelper.load_tokenizer_and_config()
+        if backend == 'record':
+            outfiles = [os.path.join(work_dir, 'eval-{}.record'.format(n)) for n in (0, num_process_worker)]
+        else:
+            outfiles = [[], []]
+        t_single, eval_labels_single = build(dataHelper, outfiles[0], data, 'eval', 0)
+        t_parallel, eval_labels_parallel = build(dataHelper, outfiles[1], data, 'eval', num_process_worker)
+        assert eval_labels_single == eval_labels_parallel and len(eval_labels_single) == num
+        if backend == 'record':
+            a, b = load_records(outfiles[0]), load_records(outfiles[1])
+            assert not [f for f in os.listdir(work_dir) if '.part-' in f]
+        else:
+            a, b = outfiles
+        assert len(a) == num
+        assert_equal(a, b)
+        print('{:<10} single {:.2f}s  {} workers {:.2f}s  {:.1f}x (cpu_count {})'.format(
+            backend, t_single, num_process_worker, t_parallel, t_single / t_parallel, os.cpu_count()))
+    shutil.rmtree(work_dir, ignore_errors=True)
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 import json
 import logging
+import os
+import sys
 import typing
 
 import numpy as np
@@ -16,6 +18,11 @@ from torch.utils.data import DataLoader, IterableDataset
 from tqdm import tqdm
 from transformers import HfArgumentParser, BertTokenizer
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.char_table import get_char_id_table
+from common.dataset_builder import ParallelDataHelperMixin
+from common.dataset_cache import FingerprintCacheMixin
+
 train_info_args = {
     'devices': 1,
     'data_backend': 'memory_raw',
@@ -51,8 +58,11 @@ train_info_args = {
     'test_max_seq_length': 512,
 }
 
+# 制作缓存的进程数, 0 为单进程
+num_process_worker = os.cpu_count() or 0
+
 
-class NN_DataHelper(DataHelper):
+class NN_DataHelper(FingerprintCacheMixin, ParallelDataHelperMixin, DataHelper):
     index = -1
     eval_labels = []
 
@@ -71,10 +81,8 @@ class NN_DataHelper(DataHelper):
 
         sentence, entities, re_list = data
         spo_list = re_list
-        tokens = list(sentence) if not do_lower_case else list(sentence.lower())
-        if len(tokens) > max_seq_length - 2:
-            tokens = tokens[0:(max_seq_length - 2)]
-        input_ids = tokenizer.convert_tokens_to_ids(['[CLS]'] + tokens + ['[SEP]'])
+        input_ids = get_char_id_table(tokenizer, do_lower_case).encode(sentence)[:max_seq_length - 2].tolist()
+        input_ids = [tokenizer.cls_token_id] + input_ids + [tokenizer.sep_token_id]
         seqlen = len(input_ids)
         input_ids = np.asarray(input_ids, dtype=np.int64)
         attention_mask = np.asarray([1] * seqlen, dtype=np.int64)
@@ -129,7 +137,7 @@ class NN_DataHelper(DataHelper):
             'seqlen': np.asarray(seqlen, dtype=np.int32)
         }
         if self.index < 5:
-            print(tokens)
+            print(list(sentence.lower() if do_lower_case else sentence))
             print(input_ids[:seqlen])
             # print(subject_labels[:seqlen])
             # print(subject_ids)
@@ -319,11 +327,11 @@ if __name__ == '__main__':
 
     # 缓存数据集
     if data_args.do_train:
-        dataHelper.make_dataset_with_args(data_args.train_file, shuffle=True,mode='train')
+        dataHelper.make_dataset_with_args(data_args.train_file, shuffle=True,mode='train', num_process_worker=num_process_worker)
     if data_args.do_eval:
-        dataHelper.make_dataset_with_args(data_args.eval_file, mode='eval')
+        dataHelper.make_dataset_with_args(data_args.eval_file, mode='eval', num_process_worker=num_process_worker)
     if data_args.do_test:
-        dataHelper.make_dataset_with_args(data_args.test_file,mode='test')
+        dataHelper.make_dataset_with_args(data_args.test_file,mode='test', num_process_worker=num_process_worker)
 
 
     model = MyTransformer(dataHelper.eval_labels, config=config, model_args=model_args, training_args=training_args)
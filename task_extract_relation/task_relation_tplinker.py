@@ -2,6 +2,8 @@
 import copy
 import json
 import logging
+import os
+import sys
 import typing
 
 import numpy as np
@@ -17,6 +19,13 @@ from torch.utils.data import DataLoader, IterableDataset
 from tqdm import tqdm
 from transformers import HfArgumentParser, BertTokenizer
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.char_table import get_char_id_table
+from common.collate import StackCollator
+from common.dataset_builder import ParallelDataHelperMixin
+from common.dataset_cache import FingerprintCacheMixin
+from tplinker_labels import build_tplinker_labels
+
 train_info_args = {
     'devices': 1,
     'data_backend': 'memory_raw',
@@ -63,8 +72,11 @@ train_info_args = {
     'scheduler': {'T_mult': 1, 'rewarm_epoch_num': 2, 'verbose': False},
 }
 
+# 制作缓存的进程数, 0 为单进程
+num_process_worker = os.cpu_count() or 0
+
 
-class NN_DataHelper(DataHelper):
+class NN_DataHelper(FingerprintCacheMixin, ParallelDataHelperMixin, DataHelper):
     # 是否固定输入最大长度 ， 如果固定训练会慢 ，指标高许多 ，如不固定训练快，指标收敛慢些
     is_fixed_input_length = True
 
@@ -93,10 +105,8 @@ class NN_DataHelper(DataHelper):
         if mode == 'train':
             max_seq_length = min(max_seq_length, self.max_text_length + 2)
 
-        tokens = list(sentence) if not do_lower_case else list(sentence.lower())
-        if len(tokens) > max_seq_length - 2:
-            tokens = tokens[0:(max_seq_length - 2)]
-        input_ids = tokenizer.convert_tokens_to_ids(['[CLS]'] + tokens + ['[SEP]'])
+        input_ids = get_char_id_table(tokenizer, do_lower_case).encode(sentence)[:max_seq_length - 2].tolist()
+        input_ids = [tokenizer.cls_token_id] + input_ids + [tokenizer.sep_token_id]
         seqlen = len(input_ids)
         attention_mask = [1] * seqlen
         input_ids = np.asarray(input_ids, dtype=np.int32)
@@ -130,7 +140,7 @@ class NN_DataHelper(DataHelper):
         }
 
         if self.index < 5:
-            print(tokens)
+            print(list(sentence.lower() if do_lower_case else sentence))
             print(input_ids[:seqlen])
 
         if mode == 'eval':
@@ -200,46 +210,12 @@ class NN_DataHelper(DataHelper):
         return D if mode == 'train' else D[:300]
 
 
-    def collate_fn(self,batch):
-        bs = len(batch)
-        o = {}
-        spo_labels = []
-        for i, b in enumerate(batch):
-            b = copy.copy(b)
-            spo_labels.append(b.pop('labels', []))
-            if i == 0:
-                for k in b:
-                    o[k] = [torch.tensor(b[k])]
-            else:
-                for k in b:
-                    o[k].append(torch.tensor(b[k]))
-        for k in o:
-            o[k] = torch.stack(o[k])
-        max_len = torch.max(o.pop('seqlen'))
-        shaking_len = int(max_len * (max_len + 1) / 2)
-        entity_labels = torch.zeros(size=(bs, shaking_len), dtype=torch.long)
-        head_labels = torch.zeros(size=(bs, len(self.label2id), shaking_len), dtype=torch.long)
-        tail_labels = torch.zeros(size=(bs, len(self.label2id), shaking_len), dtype=torch.long)
-        get_pos = lambda x0, x1: x0 * max_len + x1 - int(x0 * (x0 + 1) / 2)
-        for spos, e, h, t in zip(spo_labels, entity_labels, head_labels, tail_labels):
-            for spo in spos:
-                if spo[0] >= max_len - 1 or spo[1] >= max_len - 1 or spo[3] >= max_len - 1 or spo[4] >= max_len - 1:
-                    continue
-                e[get_pos(spo[0], spo[1])] = 1
-                e[get_pos(spo[3], spo[4])] = 1
-                if spo[0] <= spo[3]:
-                    h[spo[2]][get_pos(spo[0], spo[3])] = 1
-                else:
-                    h[spo[2]][get_pos(spo[3], spo[0])] = 2
-                if spo[1] <= spo[4]:
-                    t[spo[2]][get_pos(spo[1], spo[4])] = 1
-                else:
-                    t[spo[2]][get_pos(spo[4], spo[1])] = 2
-
-        o['input_ids'] = o['input_ids'][:, :max_len]
-        o['attention_mask'] = o['attention_mask'][:, :max_len]
-        if 'token_type_ids' in o:
-            o['token_type_ids'] = o['token_type_ids'][:, :max_len]
+    def collate_fn(self, batch):
+        batch = [copy.copy(b) for b in batch]
+        spo_labels = [b.pop('labels', []) for b in batch]
+        max_len = int(max(np.squeeze(b['seqlen']) for b in batch))
+        o = StackCollator()(batch)
+        entity_labels, head_labels, tail_labels = build_tplinker_labels(spo_labels, max_len, len(self.label2id))
         o['entity_labels'] = entity_labels
         o['head_labels'] = head_labels
         o['tail_labels'] = tail_labels
@@ -252,6 +228,13 @@ class MyTransformer(TransformerForTplinker, with_pl=True):
         self.index = 0
         self.eval_labels = eval_labels
 
+    def compute_loss(self, *args, **batch) -> tuple:
+        # collate_fn 中标签为 int8, 在设备上转为 long
+        for k in ['entity_labels', 'head_labels', 'tail_labels']:
+            if k in batch:
+                batch[k] = batch[k].long()
+        return super(MyTransformer, self).compute_loss(*args, **batch)
+
     # def validation_epoch_end(self, outputs: typing.Union[EPOCH_OUTPUT, typing.List[EPOCH_OUTPUT]]) -> None:
     #     self.index += 1
     #     if self.index < 2:
@@ -345,11 +328,11 @@ if __name__ == '__main__':
 
     # 缓存数据集
     if data_args.do_train:
-        dataHelper.make_dataset_with_args(data_args.train_file, shuffle=True,mode='train')
+        dataHelper.make_dataset_with_args(data_args.train_file, shuffle=True,mode='train', num_process_worker=num_process_worker)
     if data_args.do_eval:
-        dataHelper.make_dataset_with_args(data_args.eval_file, mode='eval')
+        dataHelper.make_dataset_with_args(data_args.eval_file, mode='eval', num_process_worker=num_process_worker)
     if data_args.do_test:
-        dataHelper.make_dataset_with_args(data_args.test_file, shuffle=False,mode='test')
+        dataHelper.make_dataset_with_args(data_args.test_file, shuffle=False,mode='test', num_process_worker=num_process_worker)
 
 
     model = MyTransformer(dataHelper.eval_labels, tplinker_args=tplinker_args, config=config, model_args=model_args,
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+# tplinker handshaking 标签构造
+# 上三角展开索引按 max_len 缓存, 整个批次的实体/头/尾标签各一次 scatter 写入
+
+import functools
+import typing
+
+import numpy as np
+import torch
+
+__all__ = [
+    'get_shaking_index',
+    'build_tplinker_labels',
+]
+
+
+@functools.lru_cache(maxsize=64)
+def get_shaking_index(max_len: int):
+    '''
+        (x0, x1) -> x0 * max_len + x1 - x0 * (x0 + 1) / 2, x0 <= x1, 其余为 -1
+        return: (max_len, max_len)
+    '''
+    x0, x1 = np.triu_indices(max_len)
+    shaking_index = np.full((max_len, max_len), -1, dtype=np.int64)
+    shaking_index[x0, x1] = np.arange(len(x0))
+    return shaking_index
+
+
+def _put_last(x: np.ndarray, index: typing.Tuple[np.ndarray, ...], values: np.ndarray):
+    '''
+        x[index] = values , 重复位置以最后一个为准
+        numpy 不保证重复下标的赋值顺序, 先按展开下标去重, 保留最后一次出现
+    '''
+    flat_index = np.ravel_multi_index(index, x.shape)
+    _, last = np.unique(flat_index[::-1], return_index=True)
+    last = len(flat_index) - 1 - last
+    np.put(x, flat_index[last], values[last])
+
+
+def build_tplinker_labels(spo_labels: typing.List[np.ndarray], max_len: int, num_labels: int,
+                          dtype=torch.int8):
+    '''
+        spo_labels: 每个样本 (n, 5) -> (s_start, s_end, p, o_start, o_end)
+        return: entity_labels (bs, shaking_len), head_labels, tail_labels (bs, num_labels, shaking_len)
+        标签取值 0/1/2, 默认 int8 , 计算损失前再转为 long
+    '''
+    bs = len(spo_labels)
+    shaking_len = max_len * (max_len + 1) // 2
+    entity_labels = np.zeros((bs, shaking_len), dtype=np.int8)
+    head_labels = np.zeros((bs, num_labels, shaking_len), dtype=np.int8)
+    tail_labels = np.zeros((bs, num_labels, shaking_len), dtype=np.int8)
+
+    spo_list = [np.asarray(spo, dtype=np.int64).reshape((-1, 5)) for spo in spo_labels]
+    b = np.repeat(np.arange(bs), [len(spo) for spo in spo_list])
+    if len(b):
+        s0, s1, p, o0, o1 = np.concatenate(spo_list, axis=0).T
+        keep = (s0 < max_len - 1) & (s1 < max_len - 1) & (o0 < max_len - 1) & (o1 < max_len - 1)
+        b, s0, s1, p, o0, o1 = b[keep], s0[keep], s1[keep], p[keep], o0[keep], o1[keep]
+
+        shaking_index = get_shaking_index(max_len)
+        entity_labels[np.concatenate([b, b]), shaking_index[np.concatenate([s0, o0]), np.concatenate([s1, o1])]] = 1
+        # 头尾顺序颠倒时为 2, 重复位置以最后一个为准
+        _put_last(head_labels, (b, p, shaking_index[np.minimum(s0, o0), np.maximum(s0, o0)]),
+                  np.where(s0 <= o0, 1, 2))
+        _put_last(tail_labels, (b, p, shaking_index[np.minimum(s1, o1), np.maximum(s1, o1)]),
+                  np.where(s1 <= o1, 1, 2))
+
+    return (torch.from_numpy(entity_labels).to(dtype),
+            torch.from_numpy(head_labels).to(dtype),
+            torch.from_numpy(tail_labels).to(dtype))
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 # @Time    : 2023/2/13 16:21
 import json
+import os
+import sys
 import typing
 
 import Levenshtein
@@ -9,6 +11,11 @@ import torch
 from deep_training.data_helper import DataHelper, TrainingArguments, DataArguments, ModelArguments
 from transformers import BertTokenizer, HfArgumentParser
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../..'))
+from common.char_table import get_char_id_table
+from common.dataset_builder import ParallelDataHelperMixin
+from common.dataset_cache import FingerprintCacheMixin
+
 train_info_args = {
     'devices': 1,
     'data_backend': 'memory_raw',
@@ -39,8 +46,11 @@ train_info_args = {
     'test_max_seq_length': 512,
 }
 
+# 制作缓存的进程数, 0 为单进程
+num_process_worker = os.cpu_count() or 0
+
 
-class NN_DataHelper(DataHelper):
+class NN_DataHelper(FingerprintCacheMixin, ParallelDataHelperMixin, DataHelper):
     # 切分词
     def on_data_process(self, data: typing.Any, mode: str):
         tokenizer: BertTokenizer
@@ -51,8 +61,7 @@ class NN_DataHelper(DataHelper):
 
         sentence, label_ops = data
 
-        tokens = list(sentence) if not do_lower_case else list(sentence.lower())
-        input_ids = tokenizer.convert_tokens_to_ids(tokens)
+        input_ids = get_char_id_table(tokenizer, do_lower_case).encode(sentence).tolist()
         tokens = ['[CLS]']  + tokenizer.convert_ids_to_tokens(input_ids) +  ['[SEP]']
         if len(input_ids) > max_seq_length - 2:
             input_ids = input_ids[:max_seq_length - 2]
@@ -185,8 +194,8 @@ if __name__ == '__main__':
 
     # 缓存数据集
     if data_args.do_train:
-        dataHelper.make_dataset_with_args(data_args.train_file, shuffle=True,mode='train')
+        dataHelper.make_dataset_with_args(data_args.train_file, shuffle=True,mode='train', num_process_worker=num_process_worker)
     if data_args.do_eval:
-        dataHelper.make_dataset_with_args(data_args.eval_file, mode='eval')
+        dataHelper.make_dataset_with_args(data_args.eval_file, mode='eval', num_process_worker=num_process_worker)
     if data_args.do_test:
-       dataHelper.make_dataset_with_args(data_args.test_file,mode='test')
\ No newline at end of file
+       dataHelper.make_dataset_with_args(data_args.test_file,mode='test', num_process_worker=num_process_worker)
\ No newline at end of file
@@ -12,7 +12,7 @@ from lightning import Trainer
 from torch.utils.data import DataLoader, IterableDataset
 from tqdm import tqdm
 from transformers import HfArgumentParser
-from data_utils import NN_DataHelper, train_info_args
+from data_utils import NN_DataHelper, train_info_args, num_process_worker
 
 
 class MyTransformer(TransformerForGec, with_pl=True):
@@ -103,11 +103,11 @@ if __name__ == '__main__':
 
     # 缓存数据集
     if data_args.do_train:
-        dataHelper.make_dataset_with_args(data_args.train_file, shuffle=True,mode='train')
+        dataHelper.make_dataset_with_args(data_args.train_file, shuffle=True,mode='train', num_process_worker=num_process_worker)
     if data_args.do_eval:
-        dataHelper.make_dataset_with_args(data_args.eval_file, mode='eval')
+        dataHelper.make_dataset_with_args(data_args.eval_file, mode='eval', num_process_worker=num_process_worker)
     if data_args.do_test:
-       dataHelper.make_dataset_with_args(data_args.test_file,mode='test')
+       dataHelper.make_dataset_with_args(data_args.test_file,mode='test', num_process_worker=num_process_worker)
 
 
     model = MyTransformer(config=config, model_args=model_args, training_args=training_args)
@@ -2,6 +2,8 @@
 # @Time:  3:12
 # @File：data_utils.py
 import json
+import os
+import sys
 import typing
 
 import numpy as np
@@ -9,6 +11,10 @@ import torch
 from deep_training.data_helper import DataHelper, ModelArguments, TrainingArguments, DataArguments
 from transformers import BertTokenizer, HfArgumentParser
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../..'))
+from common.dataset_builder import ParallelDataHelperMixin
+from common.dataset_cache import FingerprintCacheMixin
+
 train_info_args = {
     'devices': 1,
     'data_backend': 'record',
@@ -41,7 +47,10 @@ train_info_args = {
     'max_target_length': 64,
 }
 
-class NN_DataHelper(DataHelper):
+# 制作缓存的进程数, 0 为单进程
+num_process_worker = os.cpu_count() or 0
+
+class NN_DataHelper(FingerprintCacheMixin, ParallelDataHelperMixin, DataHelper):
     # 切分词
     def on_data_process(self, data: typing.Any, mode: str):
         tokenizer: BertTokenizer
@@ -136,8 +145,8 @@ if __name__ == '__main__':
 
     # 缓存数据集
     if data_args.do_train:
-        dataHelper.make_dataset_with_args(data_args.train_file, shuffle=True,mode='train')
+        dataHelper.make_dataset_with_args(data_args.train_file, shuffle=True,mode='train', num_process_worker=num_process_worker)
     if data_args.do_eval:
-        dataHelper.make_dataset_with_args(data_args.eval_file, mode='eval')
+        dataHelper.make_dataset_with_args(data_args.eval_file, mode='eval', num_process_worker=num_process_worker)
     if data_args.do_test:
-        dataHelper.make_dataset_with_args(data_args.test_file,mode='test')
\ No newline at end of file
+        dataHelper.make_dataset_with_args(data_args.test_file,mode='test', num_process_worker=num_process_worker)
\ No newline at end of file
@@ -2,6 +2,10 @@
 # @Time    : 2023/2/10 17:18
 
 import logging
+import multiprocessing
+import os
+import sys
+import time
 
 import Levenshtein
 import numpy as np
@@ -15,7 +19,62 @@ from torch.utils.data import DataLoader, IterableDataset
 from tqdm import tqdm
 from transformers import HfArgumentParser, T5ForConditionalGeneration
 
-from data_utils import train_info_args, NN_DataHelper
+from data_utils import train_info_args, NN_DataHelper, num_process_worker
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../..'))
+from common.seq2seq_generate import batch_generate_ids
+
+op_map = {
+    'insert': 0,
+    'delete': 1,
+    'replace': 2
+}
+
+
+#  三元组（action,position,vocab）
+def get_ops(source,target):
+    edits = Levenshtein.opcodes(source, target)
+    ops = []
+    for item in edits:
+        if item[0] == 'equal':
+            continue
+        action = op_map[item[0]]
+        s = item[1]
+        e = item[2]
+        ds = item[3]
+        de = item[4]
+        #insert,replace
+        if action == 0 or action == 2:
+            for idx in range(de-ds):
+                ops.append((action, s+idx, target[ds + idx]))
+        #delete
+        elif action == 1:
+            for idx in range(s, e):
+                ops.append((action, s+idx, 0))
+        else:
+            raise ValueError('invalid action ',action)
+
+    return ops
+
+
+def get_ops_pair(args):
+    source, pred, target = args
+    return get_ops(source, pred), get_ops(source, target)
+
+
+def batch_get_ops(sources, preds, targets, num_workers=None):
+    # 编辑操作计算为纯 cpu 任务, 多进程并行
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+    tasks = list(zip(sources, preds, targets))
+    if num_workers <= 1 or len(tasks) < 1000:
+        results = [get_ops_pair(task) for task in tasks]
+    else:
+        with multiprocessing.Pool(num_workers) as pool:
+            results = pool.map(get_ops_pair, tasks, chunksize=max(1, len(tasks) // (num_workers * 4)))
+    y_preds = [r[0] for r in results]
+    y_trues = [r[1] for r in results]
+    return y_preds, y_trues
 
 
 class MyTransformer(TransformerForSeq2SeqLM, with_pl=True):
@@ -62,68 +121,30 @@ class MySimpleModelCheckpoint(SimpleModelCheckpoint):
                                                            batch_size=training_args.eval_batch_size,
                                                            collate_fn=dataHelper.collate_fn)
 
-        config = pl_module.config
-
-        y_preds, y_trues = [], []
-
-        op_map = {
-            'insert': 0,
-            'delete': 1,
-            'replace': 2
-        }
-
+        # 去除填充, 按长度排序后整批生成
+        sources, targets = [], []
+        for batch in tqdm(eval_datasets, total=len(eval_datasets), desc='load evalute'):
+            seqlens = torch.sum(batch['attention_mask'], dim=-1).tolist()
+            for input_ids, seqlen, labels in zip(batch['input_ids'].tolist(), seqlens, batch['labels'].tolist()):
+                sources.append(input_ids[:seqlen])
+                # labels 不含起始 token, 末尾为 sep
+                tarlen = labels.index(-100) if -100 in labels else len(labels)
+                targets.append(labels[:tarlen - 1])
+
+        start_time = time.time()
+        preds = batch_generate_ids(pl_module.backbone.model, sources,
+                                   max_target_length=data_args.max_target_length,
+                                   batch_size=training_args.eval_batch_size,
+                                   device=device,
+                                   decoder_start_token_id=tokenizer.cls_token_id,
+                                   eos_token_id=tokenizer.sep_token_id,
+                                   pad_token_id=tokenizer.pad_token_id)
+        gen_time = time.time() - start_time
         #  三元组（action,position,vocab）
-        def get_ops(source,target):
-            edits = Levenshtein.opcodes(source, target)
-            ops = []
-            for item in edits:
-                if item[0] == 'equal':
-                    continue
-                action = op_map[item[0]]
-                s = item[1]
-                e = item[2]
-                ds = item[3]
-                de = item[4]
-                #insert,replace
-                if action == 0 or action == 2:
-                    for idx in range(de-ds):
-                        ops.append((action, s+idx, target[ds + idx]))
-                #delete
-                elif action == 1:
-                    for idx in range(s, e):
-                        ops.append((action, s+idx, 0))
-                else:
-                    raise ValueError('invalid action ',action)
-
-            return ops
-
-        for i, batch in tqdm(enumerate(eval_datasets), total=len(eval_datasets), desc='evalute'):
-            batch_labels = batch.pop('labels',None)
-            for k in batch:
-                batch[k] = batch[k].to(device)
-            for input_ids,attention_mask,labels in zip(batch['input_ids'],batch['attention_mask'],batch_labels):
-                seqlen = torch.sum(attention_mask,dim=-1)
-                output = MySimpleModelCheckpoint.generate_text_huggingface(pl_module,
-                                                                            input_ids,
-                                                                            tokenizer=tokenizer,
-                                                                            max_target_length=data_args.max_target_length,
-                                                                            device=trainer.global_rank)
-                source = input_ids[1:seqlen-1].cpu().numpy()
-                #  三元组（action,position,vocab）
-                pred_ops = get_ops(source, output[1])
-
-
-                _ = np.where(labels==-100)[0]
-                if len(_):
-                    seqlen = _[0] + 1
-                else:
-                    seqlen = len(labels)
-                labels = labels[1:seqlen - 1]
-                #  三元组（action,position,vocab）
-                true_ops = get_ops(source, labels)
-
-                y_preds.append(pred_ops)
-                y_trues.append(true_ops)
+        y_preds, y_trues = batch_get_ops([source[1:-1] for source in sources], preds, targets)
+        total_time = time.time() - start_time
+        print('evalute {} sentences, generate {:.1f} sentences/s, total {:.1f} sentences/s'.format(
+            len(sources), len(sources) / max(gen_time, 1e-6), len(sources) / max(total_time, 1e-6)))
 
         print(y_preds[:3])
         print(y_trues[:3])
@@ -171,11 +192,11 @@ if __name__ == '__main__':
 
     # 缓存数据集
     if data_args.do_train:
-        dataHelper.make_dataset_with_args(data_args.train_file, shuffle=True,mode='train')
+        dataHelper.make_dataset_with_args(data_args.train_file, shuffle=True,mode='train', num_process_worker=num_process_worker)
     if data_args.do_eval:
-        dataHelper.make_dataset_with_args(data_args.eval_file, mode='eval')
+        dataHelper.make_dataset_with_args(data_args.eval_file, mode='eval', num_process_worker=num_process_worker)
     if data_args.do_test:
-       dataHelper.make_dataset_with_args(data_args.test_file,mode='test')
+       dataHelper.make_dataset_with_args(data_args.test_file,mode='test', num_process_worker=num_process_worker)
 
 
     model = MyTransformer(config=config, model_args=model_args, training_args=training_args)
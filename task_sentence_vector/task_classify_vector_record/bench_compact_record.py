@@ -0,0 +1,116 @@
+# @Time    : 2023/2/22 11:20
+# @Author  : tk
+# @FileName: bench_compact_record.py
+# 原始 int64 padding record 与紧凑 record 的文件大小、加载至内存大小、memmap 大小、DataLoader 吞吐对比
+
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import torch
+from fastdatasets.record import load_dataset as Loader, RECORD, NumpyWriter
+from fastdatasets.torch_dataset import Dataset as torch_Dataset
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+
+from compact_record import build_compact_schema, encode_example, decode_example, save_compact_schema, \
+    load_compact_schema
+from memmap_record import convert_record_to_memmap, MemmapRandomDataset
+
+
+def make_examples(num, max_seq_length=512):
+    # 句子长度对数正态, 中位数 128
+    rng = np.random.RandomState(123456)
+    seqlens = np.clip(rng.lognormal(np.log(128), 0.6, size=num).astype(np.int64), 8, max_seq_length)
+    for seqlen in seqlens:
+        input_ids = np.zeros(max_seq_length, dtype=np.int64)
+        input_ids[:seqlen] = rng.randint(100, 21128, size=seqlen)
+        attention_mask = np.zeros(max_seq_length, dtype=np.int64)
+        attention_mask[:seqlen] = 1
+        yield {
+            'input_ids': input_ids,
+            'attention_mask': attention_mask,
+            'labels': np.asarray(rng.randint(0, 122), dtype=np.int64),
+            'seqlen': np.asarray(seqlen, dtype=np.int64),
+        }
+
+
+def write_records(filename, num, schema=None, compression_type='GZIP'):
+    writer = NumpyWriter(filename, options=RECORD.TFRecordOptions(compression_type=compression_type))
+    for d in tqdm(make_examples(num), total=num, desc='write {}'.format(os.path.basename(filename))):
+        writer.write(d if schema is None else encode_example(d, schema))
+    writer.close()
+    if schema is not None:
+        save_compact_schema(filename, schema)
+
+
+def collate_fn(batch):
+    # 与 task_my_*.py 的 collate_fn 一致
+    o = {}
+    for k in batch[0]:
+        o[k] = torch.stack([torch.tensor(b[k]) for b in batch])
+    max_len = torch.max(o.pop('seqlen'))
+    o['input_ids'] = o['input_ids'][:, :max_len]
+    o['attention_mask'] = o['attention_mask'][:, :max_len]
+    return o
+
+
+def load_dataset(filename, schema=None, with_load_memory=False):
+    dataset = Loader.RandomDataset(filename, options=RECORD.TFRecordOptions(compression_type='GZIP'))
+    dataset = dataset.parse_from_numpy_writer()
+    if with_load_memory:
+        dataset = [dataset[i] for i in range(len(dataset))]
+        return dataset, sum(v.nbytes for d in dataset for v in d.values())
+    return dataset, None
+
+
+def iter_batches(dataset, schema=None, batch_size=32, num_workers=0):
+    if schema is not None:
+        dataset = dataset.map(lambda x: decode_example(x, schema))
+    return DataLoader(torch_Dataset(dataset), batch_size=batch_size, collate_fn=collate_fn, num_workers=num_workers)
+
+
+def dir_size(path):
+    return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+
+
+if __name__ == '__main__':
+    num = 50000
+    work_dir = tempfile.mkdtemp(prefix='bench_compact_')
+    schema = build_compact_schema(next(make_examples(1)), vocab_size=21128, max_seq_length=512, num_labels=122)
+    print(schema)
+
+    results = {}
+    for name, s in [('plain', None), ('compact', schema)]:
+        filename = os.path.join(work_dir, name + '.record')
+        write_records(filename, num, schema=s)
+        assert load_compact_schema(filename) == s
+        memmap_dir = os.path.join(work_dir, name + '.memmap')
+        convert_record_to_memmap(filename, memmap_dir)
+
+        _, mem = load_dataset(filename, with_load_memory=True)
+        dataset, _ = load_dataset(filename)
+        start = time.time()
+        batches = list(iter_batches(dataset, schema=s))
+        t = time.time() - start
+        memmap_dataset = MemmapRandomDataset(memmap_dir)
+        start = time.time()
+        memmap_batches = list(iter_batches(memmap_dataset, schema=load_compact_schema(memmap_dir)))
+        t_memmap = time.time() - start
+        results[name] = batches
+        print('{:<8} record {:.1f}MB memory {:.1f}MB memmap {:.1f}MB | '
+              'record loader {:.0f} examples/s memmap loader {:.0f} examples/s'.format(
+            name, os.path.getsize(filename) / 2 ** 20, mem / 2 ** 20, dir_size(memmap_dir) / 2 ** 20,
+            num / t, num / t_memmap))
+        for a, b in zip(batches, memmap_batches):
+            assert all(torch.equal(a[k], b[k]) for k in a)
+
+    # 解码后 collate 结果与原始 record 一致, dtype 为 int64
+    for a, b in zip(results['plain'], results['compact']):
+        assert a.keys() == b.keys()
+        for k in a:
+            assert a[k].dtype == b[k].dtype == torch.int64 and torch.equal(a[k], b[k]), k
+    print('decoded batches equal')
+    shutil.rmtree(work_dir, ignore_errors=True)
@@ -0,0 +1,104 @@
+# @Time    : 2023/2/25 10:05
+# @Author  : tk
+# @FileName: bench_dataset_cache.py
+# make_dataset_with_args 带指纹缓存: 复用、追加 1% 语料、参数变化、内容变化时的行为与耗时
+# 一致性: 缓存 + 追加分片解码后与全量制作一致
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+from deep_training.data_helper import ModelArguments, TrainingArguments, DataArguments
+from transformers import HfArgumentParser
+
+from bench_jsonl_reader import make_synthetic_corpus, load_decoded
+from make_record_for_classify import NN_DataHelper, train_info_args
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../..'))
+from common.dataset_cache import load_fingerprint
+
+
+def build(data_args, corpus_file, **kwargs):
+    parser = HfArgumentParser((ModelArguments, TrainingArguments, DataArguments))
+    model_args, training_args, data_args = parser.parse_dict(data_args)
+    dataHelper = NN_DataHelper(model_args, training_args, data_args)
+    dataHelper.load_tokenizer_and_config(with_print_labels=False, with_print_config=False)
+    start = time.time()
+    dataHelper.make_dataset_with_args([corpus_file], mode='train', shuffle=False, num_process_worker=0, **kwargs)
+    return time.time() - start, list(dataHelper.train_files)
+
+
+def load_all(files):
+    return [d for f in files for d in load_decoded(f)]
+
+
+def assert_equal(a, b):
+    assert len(a) == len(b)
+    for x, y in zip(a, b):
+        assert x.keys() == y.keys() and all(np.array_equal(x[k], y[k]) for k in x)
+
+
+if __name__ == '__main__':
+    num = 20000
+    work_dir = tempfile.mkdtemp(prefix='bench_dataset_cache_')
+    tokenizer_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../pretraining/t5encoder_mlm_pretrain/t5_base_config')
+    full_file = os.path.join(work_dir, 'full.json')
+    make_synthetic_corpus(full_file, num + num // 100)
+    with open(full_file, mode='r', encoding='utf-8') as f:
+        lines = f.readlines()
+    corpus_file = os.path.join(work_dir, 'train.json')
+    head, tail = lines[:-(num // 100)], lines[-(num // 100):]
+    with open(corpus_file, mode='w', encoding='utf-8', newline='\n') as f:
+        f.writelines(head)
+    args = dict(train_info_args, tokenizer_name=tokenizer_dir, model_name_or_path=tokenizer_dir,
+                config_name=os.path.join(tokenizer_dir, 'config.json'), label_file=[full_file + '.labels.txt'],
+                output_dir=os.path.join(work_dir, 'output'), max_seq_length=128)
+    os.makedirs(args['output_dir'])
+
+    cost, files = build(args, corpus_file)
+    print('first build      {:.2f}s files {}'.format(cost, len(files)))
+    cost, files = build(args, corpus_file)
+    assert len(files) == 1
+    print('fingerprint hit  {:.2f}s files {}'.format(cost, len(files)))
+
+    # 只修改 mtime
+    os.utime(corpus_file)
+    cost, files = build(args, corpus_file)
+    assert len(files) == 1
+    print('touch            {:.2f}s files {}'.format(cost, len(files)))
+
+    # 追加 1%
+    with open(corpus_file, mode='a', encoding='utf-8', newline='\n') as f:
+        f.writelines(tail)
+    cost, files = build(args, corpus_file, append=True)
+    assert len(files) == 2 and load_fingerprint(files[0])['shards'] == files[1:]
+    print('append 1%        {:.2f}s files {}'.format(cost, len(files)))
+    appended = load_all(files)
+
+    # 与全量制作一致
+    full_args = dict(args, output_dir=os.path.join(work_dir, 'output_full'))
+    os.makedirs(full_args['output_dir'])
+    shutil.copy(corpus_file, full_file)
+    cost_full, full_files = build(full_args, full_file)
+    assert_equal(appended, load_all(full_files))
+    print('full rebuild     {:.2f}s files {} | append output equal to full rebuild'.format(cost_full, len(full_files)))
+
+    # 参数变化: 全量重新制作, 删除追加分片
+    cost, files = build(dict(args, max_seq_length=64), corpus_file, append=True)
+    assert len(files) == 1 and not os.path.exists(files[0] + '.append-00001')
+    print('max_seq_length   {:.2f}s files {}'.format(cost, len(files)))
+
+    # 中间行变化: append=True 也全量重新制作
+    lines = head + tail
+    lines[10] = json.dumps({'text': '改动', 'label': '0'}, ensure_ascii=False) + '\n'
+    with open(corpus_file, mode='w', encoding='utf-8', newline='\n') as f:
+        f.writelines(lines)
+    cost, files = build(dict(args, max_seq_length=64), corpus_file, append=True)
+    assert len(files) == 1 and len(load_all(files)) == len(lines) - len([l for l in lines if not l.strip()])
+    print('content changed  {:.2f}s files {}'.format(cost, len(files)))
+
+    shutil.rmtree(work_dir, ignore_errors=True)
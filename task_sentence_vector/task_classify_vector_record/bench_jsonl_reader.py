@@ -0,0 +1,137 @@
+# @Time    : 2023/2/24 9:40
+# @Author  : tk
+# @FileName: bench_jsonl_reader.py
+# on_get_corpus: f.readlines() + json.loads 整体读入 vs common.jsonl_reader.iter_jsonl 流式读取的峰值内存、耗时对比
+# 一致性: 产出样本与原实现一致; make_record_for_classify 流式制作的 record 与列表制作的 record 解码后一致
+
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+from deep_training.data_helper import ModelArguments, TrainingArguments, DataArguments
+from fastdatasets.record import load_dataset as Loader, RECORD
+from tqdm import tqdm
+from transformers import HfArgumentParser
+
+from compact_record import decode_example, load_compact_schema
+from make_record_for_classify import NN_DataHelper, train_info_args, parse_example
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../..'))
+from common.jsonl_reader import iter_jsonl, json_loads
+
+
+def make_synthetic_corpus(filename, num, num_labels=122):
+    # lawcup 风格: 长文本 + 标签
+    rng = np.random.RandomState(123456)
+    chars = np.asarray([chr(c) for c in range(0x4e00, 0x4e00 + 3000)] + list('，。：；0123456789'))
+    with open(filename, mode='w', encoding='utf-8', newline='\n') as f:
+        for i in tqdm(range(num), desc='make synthetic corpus'):
+            text = ''.join(rng.choice(chars, rng.randint(100, 1500)))
+            key = 'text' if i % 2 else 'sentence'
+            f.write(json.dumps({key: text, 'label': str(rng.randint(num_labels))}, ensure_ascii=False) + '\n')
+            if i % 1000 == 0:
+                f.write('\n')
+    with open(filename + '.labels.txt', mode='w', encoding='utf-8', newline='\n') as f:
+        f.write('\n'.join(str(i) for i in range(num_labels)))
+
+
+def read_corpus_readlines(filename):
+    # 原 on_get_corpus
+    D = []
+    with open(filename, mode='r', encoding='utf-8') as f:
+        lines = f.readlines()
+        for line in lines:
+            if not line.strip():
+                continue
+            jd = json.loads(line)
+            if not jd:
+                continue
+            D.append(parse_example(jd))
+    return D
+
+
+def consume(filename, mode):
+    n = 0
+    if mode == 'baseline':
+        # 只含 import 的进程内存
+        return -1
+    if mode == 'readlines':
+        for _ in read_corpus_readlines(filename):
+            n += 1
+    else:
+        for _ in iter_jsonl(filename, parse_fn=parse_example, chunk_size=8 * 1024 * 1024,
+                            num_process_worker=2 if mode == 'iter_jsonl_2_workers' else 0):
+            n += 1
+    return n
+
+
+def _run(filename, mode, q):
+    start = time.time()
+    n = consume(filename, mode)
+    # linux 下 ru_maxrss 单位为 KB
+    q.put((n, time.time() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+def benchmark(filename, mode):
+    q = multiprocessing.Queue()
+    p = multiprocessing.Process(target=_run, args=(filename, mode, q))
+    p.start()
+    result = q.get()
+    p.join()
+    return result
+
+
+def load_decoded(filename):
+    schema = load_compact_schema(filename)
+    dataset = Loader.RandomDataset(filename, options=RECORD.TFRecordOptions(compression_type='GZIP'))
+    dataset = dataset.parse_from_numpy_writer()
+    return [decode_example(dataset[i], schema) for i in range(len(dataset))]
+
+
+if __name__ == '__main__':
+    num = 200000
+    work_dir = tempfile.mkdtemp(prefix='bench_jsonl_reader_')
+    corpus_file = os.path.join(work_dir, 'train.json')
+    make_synthetic_corpus(corpus_file, num)
+    print('corpus size {:.1f}MB json_loads {}'.format(os.path.getsize(corpus_file) / 1024 / 1024,
+                                                     json_loads.__module__))
+
+    # 子进程由 fork 创建, 先于一致性检查运行, 避免继承主进程中的语料
+    for mode in ('baseline', 'readlines', 'iter_jsonl', 'iter_jsonl_2_workers'):
+        n, cost, peak_rss = benchmark(corpus_file, mode)
+        assert n == num or mode == 'baseline'
+        print('{:<22} time {:.1f}s peak_rss {:.1f}MB'.format(mode, cost, peak_rss))
+
+    expected = read_corpus_readlines(corpus_file)
+    assert list(iter_jsonl(corpus_file, parse_fn=parse_example, chunk_size=1024 * 1024)) == expected
+    assert list(iter_jsonl(corpus_file, parse_fn=parse_example, chunk_size=1024 * 1024, num_process_worker=2)) == expected
+    print('iter_jsonl equal to readlines')
+    del expected
+
+    # record: 列表 (原实现) vs 流式
+    tokenizer_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../pretraining/t5encoder_mlm_pretrain/t5_base_config')
+    small_file = os.path.join(work_dir, 'small.json')
+    make_synthetic_corpus(small_file, 5000)
+    args = dict(train_info_args, tokenizer_name=tokenizer_dir, model_name_or_path=tokenizer_dir,
+                config_name=os.path.join(tokenizer_dir, 'config.json'), train_file=[small_file],
+                label_file=[small_file + '.labels.txt'], output_dir=work_dir)
+    parser = HfArgumentParser((ModelArguments, TrainingArguments, DataArguments))
+    model_args, training_args, data_args = parser.parse_dict(args)
+    dataHelper = NN_DataHelper(model_args, training_args, data_args)
+    dataHelper.load_tokenizer_and_config()
+    list_file, stream_file = os.path.join(work_dir, 'list.record'), os.path.join(work_dir, 'stream.record')
+    dataHelper.make_dataset(list_file, read_corpus_readlines(small_file), 'train', shuffle=False)
+    dataHelper.make_dataset(stream_file, dataHelper.on_get_corpus([small_file], 'train'), 'train', shuffle=False)
+    a, b = load_decoded(list_file), load_decoded(stream_file)
+    assert len(a) == len(b) == 5000
+    for x, y in zip(a, b):
+        assert x.keys() == y.keys() and all(np.array_equal(x[k], y[k]) for k in x)
+    print('stream record equal to list record')
+
+    shutil.rmtree(work_dir, ignore_errors=True)
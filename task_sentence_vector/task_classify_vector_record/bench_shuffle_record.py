@@ -0,0 +1,71 @@
+# @Time    : 2023/2/20 10:12
+# @Author  : tk
+# @FileName: bench_shuffle_record.py
+# shuffle_records 与 shuffle_records_external 的峰值内存、耗时对比
+
+import multiprocessing
+import os
+import resource
+import shutil
+import tempfile
+import time
+
+import numpy as np
+from fastdatasets.record import RECORD, NumpyWriter
+from tqdm import tqdm
+
+from shuffle_record import shuffle_records, shuffle_records_external
+
+
+def make_synthetic_records(filename, num, max_seq_length=512, compression_type='GZIP'):
+    options = RECORD.TFRecordOptions(compression_type=compression_type)
+    writer = NumpyWriter(filename, options=options)
+    rng = np.random.RandomState(123456)
+    for _ in tqdm(range(num), desc='make synthetic records'):
+        seqlen = rng.randint(16, max_seq_length)
+        input_ids = np.zeros(max_seq_length, dtype=np.int64)
+        input_ids[:seqlen] = rng.randint(100, 21128, size=seqlen)
+        attention_mask = np.zeros(max_seq_length, dtype=np.int64)
+        attention_mask[:seqlen] = 1
+        writer.write({
+            'input_ids': input_ids,
+            'attention_mask': attention_mask,
+            'labels': np.asarray(rng.randint(0, 122), dtype=np.int64),
+            'seqlen': np.asarray(seqlen, dtype=np.int64),
+        })
+    writer.close()
+
+
+def _run(fn, kwargs, q):
+    start = time.time()
+    fn(**kwargs)
+    # linux 下 ru_maxrss 单位为 KB
+    q.put((time.time() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+def benchmark(fn, **kwargs):
+    q = multiprocessing.Queue()
+    p = multiprocessing.Process(target=_run, args=(fn, kwargs, q))
+    p.start()
+    result = q.get()
+    p.join()
+    return result
+
+
+if __name__ == '__main__':
+    num = 200000
+    work_dir = tempfile.mkdtemp(prefix='bench_shuffle_')
+    src_file = os.path.join(work_dir, 'train.record')
+    make_synthetic_records(src_file, num)
+    print('src size {:.1f}MB'.format(os.path.getsize(src_file) / 1024 / 1024))
+
+    for name, fn, kwargs in [
+        ('shuffle_records', shuffle_records, {}),
+        ('shuffle_records_external', shuffle_records_external, {'memory_budget': 64 * 1024 * 1024, 'seed': 123456}),
+    ]:
+        out_dir = os.path.join(work_dir, name)
+        os.makedirs(out_dir)
+        cost, peak_rss = benchmark(fn, record_filenames=[src_file], out_dir=out_dir, out_record_num=1, **kwargs)
+        print('{:<28} time {:.1f}s peak_rss {:.1f}MB'.format(name, cost, peak_rss))
+
+    shutil.rmtree(work_dir, ignore_errors=True)
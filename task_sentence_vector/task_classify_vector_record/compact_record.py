@@ -0,0 +1,237 @@
+# @Time    : 2023/2/22 10:05
+# @Author  : tk
+# @FileName: compact_record.py
+# 紧凑 record 编码, 写入时压缩已知字段, 读取时还原为原 dtype 与长度
+#   input_ids / token_type_ids: 按词表大小取最小整数类型 (bert-chinese 为 int16), 只保存 seqlen 个 token
+#   attention_mask: 与 seqlen 一致时不保存, 读取时由 seqlen 生成, 否则保存为 int8
+#   seqlen / labels: 标量取最小整数类型
+# serialize_numpy 不支持无符号整数, 整数以 varint 保存, 读取后保持写入时的 dtype (内存 / memmap 中同样紧凑)
+# schema 保存在旁路文件 {record 文件或 memmap 目录}.schema.json
+
+import functools
+import itertools
+import json
+import os
+import shutil
+import typing
+
+import numpy as np
+
+__all__ = [
+    'COMPACT_SCHEMA_SUFFIX',
+    'get_schema_file',
+    'build_compact_schema',
+    'encode_example',
+    'decode_example',
+    'load_compact_schema',
+    'save_compact_schema',
+    'copy_compact_schema',
+    'CompactRecordDataHelperMixin',
+]
+
+COMPACT_SCHEMA_SUFFIX = '.schema.json'
+
+_SEQ_PREFIXES = ('input_ids', 'token_type_ids', 'attention_mask')
+
+
+def get_schema_file(record_file: str):
+    return record_file + COMPACT_SCHEMA_SUFFIX
+
+
+def _smallest_int(max_value, min_value=0):
+    for dtype in ('<i1', '<i2', '<i4'):
+        if np.iinfo(dtype).min <= min_value and max_value <= np.iinfo(dtype).max:
+            return dtype
+    return '<i8'
+
+
+def _is_prefix_mask(mask, seqlen):
+    seqlen = int(np.asarray(seqlen).reshape(-1)[0])
+    return np.array_equal(mask, np.arange(len(mask)) < seqlen)
+
+
+def build_compact_schema(example: typing.Dict, vocab_size: int, max_seq_length: int,
+                         num_labels: typing.Optional[int] = None, pad_token_id: int = 0):
+    '''
+        example: on_data_process 输出的一条样本, 确定字段及 dtype
+        seqlen{suffix} 对应 input_ids{suffix} / token_type_ids{suffix} / attention_mask{suffix}
+    '''
+    schema = {}
+    for k, v in example.items():
+        v = np.asarray(v)
+        field = {'dtype': v.dtype.str}
+        prefix = next((p for p in _SEQ_PREFIXES if k.startswith(p)), None)
+        if v.dtype.kind not in 'iub':
+            field['codec'] = 'raw'
+        elif prefix is not None and v.ndim == 1:
+            suffix = k[len(prefix):]
+            seqlen_key = 'seqlen' + suffix
+            field['shape'] = [max_seq_length if len(v) == max_seq_length else None]
+            if prefix == 'attention_mask':
+                if seqlen_key in example and _is_prefix_mask(v, example[seqlen_key]):
+                    field['codec'] = 'seqlen'
+                    field['seqlen_key'] = seqlen_key
+                    field['ref_key'] = 'input_ids' + suffix
+                else:
+                    field['codec'] = 'cast'
+                    field['store'] = '<i1'
+            else:
+                field['codec'] = 'trim'
+                field['store'] = _smallest_int(vocab_size - 1) if prefix == 'input_ids' else '<i1'
+                field['pad'] = pad_token_id if prefix == 'input_ids' else 0
+                if seqlen_key in example:
+                    field['seqlen_key'] = seqlen_key
+        elif v.ndim == 0 and k.startswith('seqlen'):
+            field['codec'] = 'cast'
+            field['store'] = _smallest_int(max_seq_length)
+        elif v.ndim == 0 and k.startswith('labels'):
+            field['codec'] = 'cast'
+            field['store'] = _smallest_int(num_labels - 1) if num_labels else '<i4'
+        else:
+            field['codec'] = 'raw'
+        schema[k] = field
+    return schema
+
+
+def encode_example(example: typing.Dict, schema: typing.Dict):
+    d = {}
+    for k, v in example.items():
+        v = np.asarray(v)
+        field = schema.get(k, None)
+        codec = field['codec'] if field is not None else 'raw'
+        if codec == 'trim':
+            seqlen_key = field.get('seqlen_key', None)
+            if seqlen_key is not None:
+                v = v[:int(np.asarray(example[seqlen_key]).reshape(-1)[0])]
+            d[k] = v.astype(field['store'])
+        elif codec == 'seqlen':
+            # 读取时由 seqlen 生成, 各条样本字段一致
+            assert _is_prefix_mask(v, example[field['seqlen_key']]), ValueError('attention_mask not match seqlen', k)
+        elif codec == 'cast':
+            d[k] = v.astype(field['store'])
+        else:
+            d[k] = v
+    return d
+
+
+def decode_example(example: typing.Dict, schema: typing.Dict):
+    '''
+        还原为写入前的 dtype 与长度
+    '''
+    d = dict(example)
+    masks = []
+    for k, field in schema.items():
+        codec = field['codec']
+        if codec == 'trim':
+            if k not in d:
+                continue
+            v = np.asarray(d[k])
+            length = field['shape'][0]
+            if length is not None and len(v) < length:
+                # 比 np.pad 快
+                out = np.full(length, field['pad'], dtype=field['dtype'])
+                out[:len(v)] = v
+                d[k] = out
+            else:
+                d[k] = v.astype(field['dtype'])
+        elif codec == 'cast':
+            if k in d:
+                d[k] = np.asarray(d[k]).astype(field['dtype'])
+        elif codec == 'seqlen':
+            masks.append((k, field))
+
+    # mask 长度与还原后的 input_ids 一致
+    for k, field in masks:
+        length = field['shape'][0] or len(d[field['ref_key']])
+        seqlen = int(np.asarray(d[field['seqlen_key']]).reshape(-1)[0])
+        v = np.zeros(length, dtype=field['dtype'])
+        v[:seqlen] = 1
+        d[k] = v
+    return d
+
+
+def _decode_transform(example: typing.Dict, schema: typing.Dict, transform_fn=None):
+    example = decode_example(example, schema)
+    return transform_fn(example) if transform_fn is not None else example
+
+
+def load_compact_schema(record_files: typing.Union[typing.List, str]):
+    '''
+        多个文件须使用同一 schema , 无旁路文件返回 None
+    '''
+    if isinstance(record_files, str):
+        record_files = [record_files]
+    schema = None
+    for f in record_files:
+        if not isinstance(f, str) or not os.path.exists(get_schema_file(f)):
+            assert schema is None, ValueError('missing schema', f)
+            continue
+        with open(get_schema_file(f), mode='r', encoding='utf-8') as fp:
+            s = json.load(fp)
+        assert schema is None or s == schema, ValueError('inconsistent schema', f)
+        schema = s
+    return schema
+
+
+def save_compact_schema(record_file: str, schema: typing.Dict):
+    with open(get_schema_file(record_file), mode='w', encoding='utf-8') as f:
+        json.dump(schema, f, ensure_ascii=False, indent=2)
+
+
+def copy_compact_schema(input_record_files: typing.Union[typing.List, str],
+                        output_record_files: typing.Union[typing.List, str]):
+    '''
+        拆分 / 合并 / 打乱只搬运序列化数据, 输出文件沿用输入的 schema
+    '''
+    if isinstance(input_record_files, str):
+        input_record_files = [input_record_files]
+    if isinstance(output_record_files, str):
+        output_record_files = [output_record_files]
+    if not input_record_files or not os.path.exists(get_schema_file(input_record_files[0])):
+        return
+    load_compact_schema(input_record_files)
+    for f in output_record_files:
+        shutil.copyfile(get_schema_file(input_record_files[0]), get_schema_file(f))
+
+
+class CompactRecordDataHelperMixin:
+    '''
+        DataHelper 混入类, make_dataset 写紧凑编码及 schema 旁路文件, load_dataset 读取时解码
+        class NN_DataHelper(CompactRecordDataHelperMixin, MemmapDataHelperMixin, DataHelper): ...
+    '''
+    with_compact_record = True
+
+    def on_data_process_compact(self, data: typing.Any, mode: str):
+        return encode_example(self.on_data_process(data, mode), self._compact_schema)
+
+    def make_dataset(self, outfile, data, input_fn_args, *args, **kwargs):
+        if not isinstance(data, (list, tuple)):
+            # 流式语料, 取出第一条生成 schema 后放回
+            data = iter(data)
+            first = next(data, None)
+            data = itertools.chain([first], data) if first is not None else []
+        else:
+            first = data[0] if len(data) else None
+        if not self.with_compact_record or first is None or not isinstance(outfile, str):
+            return super(CompactRecordDataHelperMixin, self).make_dataset(outfile, data, input_fn_args, *args, **kwargs)
+        mode = input_fn_args
+        example = self.on_data_process(first, mode)
+        self._compact_schema = build_compact_schema(example,
+                                                    vocab_size=len(self.tokenizer),
+                                                    max_seq_length=self.max_seq_length_dict[mode],
+                                                    num_labels=len(self.label2id) if self.label2id else None,
+                                                    pad_token_id=self.tokenizer.pad_token_id)
+        self.data_process_fn = self.on_data_process_compact
+        try:
+            super(CompactRecordDataHelperMixin, self).make_dataset(outfile, data, input_fn_args, *args, **kwargs)
+        finally:
+            self.data_process_fn = self.on_data_process
+        save_compact_schema(outfile, self._compact_schema)
+
+    def load_dataset(self, files, *args, **kwargs):
+        schema = load_compact_schema(files) if isinstance(files, (str, list)) and files else None
+        if schema is not None:
+            # 在 DataLoader worker 中解码, collate_fn 得到原 dtype
+            kwargs['transform_fn'] = functools.partial(_decode_transform, schema=schema,
+                                                       transform_fn=kwargs.get('transform_fn', None))
+        return super(CompactRecordDataHelperMixin, self).load_dataset(files, *args, **kwargs)
@@ -9,6 +9,8 @@ import numpy as np
 from fastdatasets.record import load_dataset as Loader, RECORD, NumpyWriter
 from tqdm import tqdm
 
+from compact_record import load_compact_schema, decode_example
+
 
 # 从分类数据构造正负样本池
 def gen_pos_neg_records(all_example):
@@ -78,9 +80,13 @@ def make_pos_neg_records(input_record_filenames, output_file, compression_type='
                                           with_share_memory=True).parse_from_numpy_writer()
     data_size = len(dataset_reader)
     all_example = {}
+    # 紧凑 record 还原为 padding 后的 int64 字段
+    schema = load_compact_schema(input_record_filenames)
 
     for i in tqdm(range(data_size), desc='load records'):
         serialized = dataset_reader[i]
+        if schema is not None:
+            serialized = decode_example(serialized, schema)
         labels = serialized['labels']
         labels = np.squeeze(labels).tolist()
         if labels not in all_example:
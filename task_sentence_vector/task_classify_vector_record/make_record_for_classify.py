@@ -1,8 +1,8 @@
 # -*- coding: utf-8 -*-
 # @Time    : 2022/12/13 8:55
 
-import json
-import random
+import os
+import sys
 import typing
 
 import numpy as np
@@ -11,6 +11,13 @@ from deep_training.data_helper import ModelArguments, TrainingArguments, DataArg
 from fastdatasets import gfile
 from transformers import HfArgumentParser, BertTokenizer
 
+from compact_record import CompactRecordDataHelperMixin
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../..'))
+from common.dataset_builder import ParallelDataHelperMixin
+from common.dataset_cache import FingerprintCacheMixin, get_source_hash
+from common.jsonl_reader import iter_jsonl
+
 train_info_args = {
     'devices': 1,
     'data_backend': 'record',
@@ -43,7 +50,21 @@ train_info_args = {
 }
 
 
-class NN_DataHelper(DataHelper):
+# 制作缓存的进程数, 0 为单进程
+num_process_worker = os.cpu_count() or 0
+
+
+def parse_example(jd):
+    if 'text' in jd:
+        text = jd['text']
+    else:
+        text = jd['sentence']
+    return (text, jd.get('label', None))
+
+
+# 紧凑编码写入, schema 保存在 {record 文件}.schema.json , 由 compact_record.decode_example 还原
+# 缓存带指纹, 语料只在末尾追加时, 新增的行写入 {record 文件}.append-00001 等分片
+class NN_DataHelper(FingerprintCacheMixin, CompactRecordDataHelperMixin, ParallelDataHelperMixin, DataHelper):
     # 切分词
     def on_data_process(self, data: typing.Any, mode: str):
         tokenizer: BertTokenizer
@@ -90,25 +111,18 @@ class NN_DataHelper(DataHelper):
         id2label = {i: l for i, l in enumerate(labels)}
         return label2id, id2label
 
-    # 读取文件
+    # 读取文件, 按字节区间流式解析, 不整体读入内存
+    # 流式制作只在块内打乱, 需要全局打乱时制作完成后运行 shuffle_record.py
     def on_get_corpus(self, files: typing.List, mode: str):
         assert len(files) > 0
-        D = []
         filenames = gfile.glob(files[0])
-        for fname in filenames:
-            with open(fname, mode='r', encoding='utf-8') as f:
-                lines = f.readlines()
-                for line in lines:
-                    jd = json.loads(line)
-                    if not jd:
-                        continue
-                    if 'text' in jd:
-                        text = jd['text']
-                    else:
-                        text = jd['sentence']
-                    D.append((text, jd.get('label', None)))
-        random.shuffle(D)
-        return D
+        return iter_jsonl(filenames, parse_fn=parse_example, num_process_worker=num_process_worker)
+
+    # 缓存指纹: 解析函数
+    def get_fingerprint_args(self, mode: str):
+        o = super(NN_DataHelper, self).get_fingerprint_args(mode)
+        o.update(parse_example=get_source_hash(parse_example))
+        return o
 
 
 if __name__ == '__main__':
@@ -119,9 +133,9 @@ if __name__ == '__main__':
     tokenizer, config, label2id, id2label = dataHelper.load_tokenizer_and_config()
 
     if data_args.do_train:
-        dataHelper.make_dataset_with_args(data_args.train_file,shuffle=True, mode='train')
+        dataHelper.make_dataset_with_args(data_args.train_file,shuffle=True, mode='train', num_process_worker=num_process_worker, append=True)
     if data_args.do_eval:
-        dataHelper.make_dataset_with_args(data_args.eval_file, mode='eval')
+        dataHelper.make_dataset_with_args(data_args.eval_file, mode='eval', num_process_worker=num_process_worker)
     if data_args.do_test:
-        dataHelper.make_dataset_with_args(data_args.test_file, mode='test')
+        dataHelper.make_dataset_with_args(data_args.test_file, mode='test', num_process_worker=num_process_worker)
 
@@ -0,0 +1,188 @@
+# @Time    : 2023/2/21 9:40
+# @Author  : tk
+# @FileName: memmap_record.py
+# 内存映射 numpy 列存格式, 读取无需解压和反序列化
+# 目录结构:
+#   meta.json            样本数, 各字段 dtype / 单条 shape
+#   {key}.bin            字段数据, 按样本顺序拼接
+#   {key}.offsets.npy    变长字段第一维偏移索引, 定长字段无此文件
+
+import json
+import os
+import typing
+
+import numpy as np
+from fastdatasets.common.random_dataset import RandomDatasetBase
+from fastdatasets.record import load_dataset as Loader, RECORD
+from tqdm import tqdm
+
+from compact_record import copy_compact_schema
+
+__all__ = [
+    'MEMMAP_META_FILE',
+    'is_memmap_dataset',
+    'convert_record_to_memmap',
+    'MemmapRandomDataset',
+    'MemmapDataHelperMixin',
+]
+
+MEMMAP_META_FILE = 'meta.json'
+
+
+def is_memmap_dataset(path):
+    return isinstance(path, str) and os.path.isfile(os.path.join(path, MEMMAP_META_FILE))
+
+
+def convert_record_to_memmap(input_record_filenames, output_dir, compression_type='GZIP'):
+    '''
+        将 NumpyWriter 写入的 record 文件转换为 memmap 格式
+        流式读取, 内存占用与数据集大小无关
+    '''
+    print('convert_record_to_memmap record...')
+    os.makedirs(output_dir, exist_ok=True)
+    options = RECORD.TFRecordOptions(compression_type=compression_type)
+    if isinstance(input_record_filenames, str):
+        input_record_filenames = [input_record_filenames]
+
+    fields = {}
+    f_outs = {}
+    num = 0
+    for filename in input_record_filenames:
+        dataset_reader = Loader.IterableDataset(filename, options=options,
+                                                with_share_memory=True).parse_from_numpy_writer()
+        for example in tqdm(dataset_reader, desc='convert {}'.format(os.path.basename(filename))):
+            if num == 0:
+                for k, v in example.items():
+                    fields[k] = {'dtype': v.dtype.str, 'shape': list(v.shape), 'lengths': []}
+                    f_outs[k] = open(os.path.join(output_dir, k + '.bin'), mode='wb')
+            assert example.keys() == fields.keys(), ValueError('inconsistent keys', list(example.keys()))
+            for k, v in example.items():
+                field = fields[k]
+                v = np.ascontiguousarray(v, dtype=field['dtype'])
+                if list(v.shape) != field['shape']:
+                    # 仅支持第一维变长
+                    assert v.ndim > 0 and list(v.shape[1:]) == field['shape'][1:], ValueError(
+                        'not support shape', k, v.shape)
+                    field['shape'][0] = None
+                field['lengths'].append(v.shape[0] if v.ndim > 0 else 1)
+                f_outs[k].write(v.tobytes())
+            num += 1
+        dataset_reader.close()
+
+    for f in f_outs.values():
+        f.close()
+    for k, field in fields.items():
+        lengths = field.pop('lengths')
+        if field['shape'] and field['shape'][0] is None:
+            offsets = np.zeros(num + 1, dtype=np.int64)
+            np.cumsum(lengths, out=offsets[1:])
+            np.save(os.path.join(output_dir, k + '.offsets.npy'), offsets)
+
+    with open(os.path.join(output_dir, MEMMAP_META_FILE), mode='w', encoding='utf-8') as f:
+        json.dump({'num': num, 'fields': fields}, f, ensure_ascii=False, indent=2)
+    # 紧凑 record 按写入的 dtype 保存, 读取时同样解码
+    copy_compact_schema(input_record_filenames, output_dir)
+    print('num', num)
+
+
+class MemmapRandomDataset(RandomDatasetBase):
+    '''
+        __getitem__ 返回 np.memmap 视图, 支持 mutiprocess / shuffle / map 等 RandomDatasetBase 接口
+        DataLoader 多进程时各进程重新打开映射, 不会拷贝数据
+    '''
+
+    def __init__(self, path: typing.Union[typing.List, str], keys: typing.List[str] = None):
+        self.path = [path] if isinstance(path, str) else list(path)
+        self.keys = keys
+        self.metas = []
+        for p in self.path:
+            with open(os.path.join(p, MEMMAP_META_FILE), mode='r', encoding='utf-8') as f:
+                self.metas.append(json.load(f))
+        self.len_arr = np.cumsum([meta['num'] for meta in self.metas]).tolist()
+        self.length = self.len_arr[-1] if self.len_arr else 0
+        self._columns = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_columns'] = None
+        return state
+
+    def _open(self):
+        self._columns = []
+        for p, meta in zip(self.path, self.metas):
+            columns = {}
+            for k, field in meta['fields'].items():
+                if self.keys is not None and k not in self.keys:
+                    continue
+                shape = field['shape']
+                filename = os.path.join(p, k + '.bin')
+                if os.path.getsize(filename) == 0:
+                    data = np.zeros((0,), dtype=field['dtype'])
+                else:
+                    data = np.memmap(filename, dtype=field['dtype'], mode='r')
+                if shape and shape[0] is None:
+                    data = data.reshape((-1, *shape[1:]))
+                    offsets = np.load(os.path.join(p, k + '.offsets.npy'), mmap_mode='r')
+                else:
+                    data = data.reshape((meta['num'], *shape))
+                    offsets = None
+                columns[k] = (data, offsets)
+            self._columns.append(columns)
+
+    def reset(self):
+        self._columns = None
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return self.__getitem_slice__(item)
+        if item < 0:
+            item += self.length
+        if self._columns is None:
+            self._open()
+        file_id = int(np.searchsorted(self.len_arr, item, side='right'))
+        if file_id > 0:
+            item -= self.len_arr[file_id - 1]
+        d = {}
+        for k, (data, offsets) in self._columns[file_id].items():
+            d[k] = data[item] if offsets is None else data[offsets[item]:offsets[item + 1]]
+        return d
+
+
+class MemmapDataHelperMixin:
+    '''
+        DataHelper 混入类, 数据文件为 memmap 目录时直接加载, 其余走原有 backend
+        class NN_DataHelper(MemmapDataHelperMixin, DataHelper): ...
+    '''
+
+    def load_numpy_dataset(self, files, *args, **kwargs):
+        if isinstance(files, str):
+            files = [files]
+        if files and all(is_memmap_dataset(f) for f in files):
+            dataset = MemmapRandomDataset(files)
+            limit_start = kwargs.get('limit_start', None)
+            limit_count = kwargs.get('limit_count', None)
+            dataset_loader_filter_fn = kwargs.get('dataset_loader_filter_fn', None)
+            if limit_start is not None and limit_start > 0:
+                dataset = dataset.skip(limit_start)
+            if limit_count is not None and limit_count > 0:
+                dataset = dataset.limit(limit_count)
+            if dataset_loader_filter_fn is not None:
+                dataset = dataset_loader_filter_fn(dataset)
+            return dataset
+        return super(MemmapDataHelperMixin, self).load_numpy_dataset(files, *args, **kwargs)
+
+    def load_dataset(self, files, *args, **kwargs):
+        # memmap 已是零拷贝随机读取, 无需加载至内存
+        if isinstance(files, (str, list)) and files and all(
+                is_memmap_dataset(f) for f in ([files] if isinstance(files, str) else files)):
+            kwargs['with_load_memory'] = False
+        return super(MemmapDataHelperMixin, self).load_dataset(files, *args, **kwargs)
+
+
+if __name__ == '__main__':
+    convert_record_to_memmap('/data/record/cse_0110/train.record', '/data/record/cse_0110/train.memmap')
+    dataset = MemmapRandomDataset('/data/record/cse_0110/train.memmap')
+    print(len(dataset), dataset[0])
@@ -8,9 +8,16 @@ from fastdatasets.record import load_dataset as Loader, gfile, RECORD, WriterObj
 from tfrecords import TFRecordOptions
 from tqdm import tqdm
 
+from compact_record import copy_compact_schema
+from transform_record import transform_records
+
 
 # 合并数据集
-def merge_records(input_record_filenames, output_file, compression_type='GZIP'):
+def merge_records(input_record_filenames, output_file, compression_type='GZIP', num_workers=0):
+    # 多进程合并, 保持原始顺序
+    if num_workers > 0:
+        return transform_records(input_record_filenames, output_file, num_workers=num_workers,
+                                 compression_type=compression_type)
     print('split_records record...')
     options = RECORD.TFRecordOptions(compression_type=compression_type)
     dataset_reader = Loader.RandomDataset(input_record_filenames, options=options, with_share_memory=True)
@@ -31,6 +38,7 @@ def merge_records(input_record_filenames, output_file, compression_type='GZIP'):
         example = all_example[i]
         writer_output.write(example)
     writer_output.close()
+    copy_compact_schema(input_record_filenames, output_file)
 
     print('num', len(shuffle_idx))
 
@@ -2,12 +2,17 @@
 # @Author  : tk
 # @FileName: shuffle_record.py
 
+import math
 import os
 import random
+import shutil
+import tempfile
 
 from fastdatasets.record import load_dataset as Loader, RECORD, WriterObject
 from tqdm import tqdm
 
+from compact_record import copy_compact_schema
+
 
 def shuffle_records(record_filenames, out_dir, out_record_num, compression_type='GZIP'):
     print('shuffle_records record...')
@@ -22,16 +27,105 @@ def shuffle_records(record_filenames, out_dir, out_record_num, compression_type=
 
     shuffle_idx = list(range(data_size))
     random.shuffle(shuffle_idx)
-    writers = [WriterObject(os.path.join(out_dir, 'record_gzip_shuffle_{}.record'.format(i)), options=options) for i in
-               range(out_record_num)]
+    output_files = [os.path.join(out_dir, 'record_gzip_shuffle_{}.record'.format(i)) for i in range(out_record_num)]
+    writers = [WriterObject(f, options=options) for f in output_files]
     for i in tqdm(shuffle_idx, desc='shuffle record'):
         example = all_example[i]
         writers[i % out_record_num].write(example)
     for writer in writers:
         writer.close()
+    copy_compact_schema(record_filenames, output_files)
+
+
+# 桶文件不压缩, 文件大小近似等于加载到内存的大小
+_bucket_options = RECORD.TFRecordOptions(RECORD.TFRecordCompressionType.NONE)
+
+
+def _iter_records(record_filenames, options):
+    if isinstance(record_filenames, str):
+        record_filenames = [record_filenames]
+    for filename in record_filenames:
+        dataset_reader = Loader.IterableDataset(filename, options=options, with_share_memory=True)
+        for serialized in dataset_reader:
+            yield serialized
+        dataset_reader.close()
+
+
+def _scatter_to_buckets(examples, bucket_dir, num_buckets, rng, desc):
+    bucket_files = [os.path.join(bucket_dir, 'bucket_{}.record'.format(i)) for i in range(num_buckets)]
+    writers = [WriterObject(f, options=_bucket_options) for f in bucket_files]
+    for serialized in tqdm(examples, desc=desc):
+        writers[rng.randrange(num_buckets)].write(serialized)
+    for writer in writers:
+        writer.close()
+    return bucket_files
+
+
+def _shuffle_bucket(bucket_file, rng, memory_budget, num_buckets, max_depth=8):
+    '''
+        桶文件超出内存预算时继续拆分, 保证任意时刻只有一个不超过预算的桶在内存中
+        max_depth: 最大拆分层数, 防止单条样本超出预算时无限拆分
+    '''
+    if os.path.getsize(bucket_file) > memory_budget and max_depth > 0:
+        sub_dir = bucket_file + '.split'
+        os.makedirs(sub_dir, exist_ok=True)
+        sub_files = _scatter_to_buckets(_iter_records(bucket_file, _bucket_options), sub_dir, num_buckets, rng,
+                                        desc='split {}'.format(os.path.basename(bucket_file)))
+        os.remove(bucket_file)
+        for sub_file in sub_files:
+            yield from _shuffle_bucket(sub_file, rng, memory_budget, num_buckets, max_depth - 1)
+        shutil.rmtree(sub_dir, ignore_errors=True)
+        return
+
+    all_example = list(_iter_records(bucket_file, _bucket_options))
+    os.remove(bucket_file)
+    rng.shuffle(all_example)
+    yield from all_example
+
+
+def shuffle_records_external(record_filenames, out_dir, out_record_num, compression_type='GZIP',
+                             memory_budget=1024 * 1024 * 1024, num_buckets=None, seed=None, tmp_dir=None):
+    '''
+        外存打乱, 内存占用受 memory_budget(字节) 限制
+        第一遍流式读取, 将样本随机分配到 num_buckets 个临时桶文件
+        第二遍逐个桶加载到内存打乱并写出
+        相同 seed 输出结果一致
+        num_buckets: 默认按输入文件大小估算(GZIP 压缩比按 4 倍计)
+    '''
+    print('shuffle_records_external record...')
+    options = RECORD.TFRecordOptions(compression_type=compression_type)
+    if isinstance(record_filenames, str):
+        record_filenames = [record_filenames]
+    if num_buckets is None:
+        total_bytes = sum(os.path.getsize(f) for f in record_filenames)
+        if compression_type:
+            total_bytes *= 4
+        num_buckets = max(1, math.ceil(total_bytes / memory_budget))
+    rng = random.Random(seed)
+
+    bucket_dir = tempfile.mkdtemp(prefix='shuffle_buckets_', dir=tmp_dir)
+    try:
+        bucket_files = _scatter_to_buckets(_iter_records(record_filenames, options), bucket_dir, num_buckets, rng,
+                                           desc='scatter records')
+        output_files = [os.path.join(out_dir, 'record_gzip_shuffle_{}.record'.format(i)) for i in range(out_record_num)]
+        writers = [WriterObject(f, options=options) for f in output_files]
+        num = 0
+        for bucket_file in tqdm(bucket_files, desc='shuffle buckets'):
+            for example in _shuffle_bucket(bucket_file, rng, memory_budget, num_buckets=max(2, num_buckets)):
+                writers[num % out_record_num].write(example)
+                num += 1
+        for writer in writers:
+            writer.close()
+        copy_compact_schema(record_filenames, output_files)
+    finally:
+        shutil.rmtree(bucket_dir, ignore_errors=True)
+    print('num', num)
 
 
 if __name__ == '__main__':
     src_records = ['/tmp/train.record']
     dst_dir = '/tmp/'
     shuffle_records(record_filenames=src_records, out_dir=dst_dir, out_record_num=1)
+    # 超大数据集使用外存打乱, 内存不超过 2G
+    # shuffle_records_external(record_filenames=src_records, out_dir=dst_dir, out_record_num=1,
+    #                          memory_budget=2 * 1024 * 1024 * 1024, seed=123456)
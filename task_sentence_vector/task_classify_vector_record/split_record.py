@@ -9,9 +9,17 @@ from fastdatasets.record import load_dataset as Loader, gfile, RECORD, WriterObj
 from tfrecords import TFRecordOptions
 from tqdm import tqdm
 
+from compact_record import copy_compact_schema
+from transform_record import transform_records
+
 
 # 拆分数据集
-def split_records(input_record_filenames, output_train_file, output_eval_file, compression_type='GZIP'):
+def split_records(input_record_filenames, output_train_file, output_eval_file, compression_type='GZIP',
+                  num_workers=0):
+    # 多进程拆分, 各进程内打乱
+    if num_workers > 0:
+        return transform_records(input_record_filenames, output_train_file, output_eval_file, eval_every=15,
+                                 shuffle=True, num_workers=num_workers, compression_type=compression_type)
     print('split_records record...')
     options = RECORD.TFRecordOptions(compression_type=compression_type)
     dataset_reader = Loader.RandomDataset(input_record_filenames, options=options, with_share_memory=True)
@@ -47,6 +55,7 @@ def split_records(input_record_filenames, output_train_file, output_eval_file, c
 
     writer_train.close()
     writer_eval.close()
+    copy_compact_schema(input_record_filenames, [output_train_file, output_eval_file])
 
     print('num_train', num_train, 'num_eval', num_eval)
 
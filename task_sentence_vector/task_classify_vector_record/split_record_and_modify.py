@@ -8,9 +8,18 @@ import random
 from fastdatasets.record import load_dataset as Loader, RECORD, NumpyWriter
 from tqdm import tqdm
 
+from compact_record import copy_compact_schema
+from transform_record import transform_records
+
 
 # 拆分数据集
-def split_records(input_record_filenames, output_train_file, output_eval_file, compression_type='GZIP'):
+def split_records(input_record_filenames, output_train_file, output_eval_file, compression_type='GZIP',
+                  num_workers=0, transform_fn=None):
+    # 多进程拆分, transform_fn 修改键值, 例如 functools.partial(drop_keys_transform, drop_keys=['id'])
+    if num_workers > 0:
+        return transform_records(input_record_filenames, output_train_file, output_eval_file, eval_every=8,
+                                 transform_fn=transform_fn, with_parse_numpy=True, shuffle=True,
+                                 num_workers=num_workers, compression_type=compression_type)
     print('split_records record...')
     options = RECORD.TFRecordOptions(compression_type=compression_type)
     dataset_reader = Loader.RandomDataset(input_record_filenames, options=options,
@@ -52,6 +61,7 @@ def split_records(input_record_filenames, output_train_file, output_eval_file, c
 
     writer_train.close()
     writer_eval.close()
+    copy_compact_schema(input_record_filenames, [output_train_file, output_eval_file])
     print('num_train', num_train, 'num_eval', num_eval)
 
 
@@ -2,6 +2,7 @@
 import copy
 import logging
 import os.path
+import sys
 import typing
 
 import numpy as np
@@ -22,6 +23,11 @@ from torch.utils.data import DataLoader, IterableDataset
 from tqdm import tqdm
 from transformers import HfArgumentParser, BertTokenizer
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../..'))
+from common.collate import StackCollator
+from compact_record import CompactRecordDataHelperMixin
+from memmap_record import MemmapDataHelperMixin
+
 model_base_dir = '/data/torch/bert-base-chinese'
 # model_base_dir = '/data/nlp/pre_models/torch/bert/bert-base-chinese'
 
@@ -39,6 +45,8 @@ train_info_args = {
     'do_eval': True,
     'do_test': False,
     'train_file': [ '/data/record/cse_0110/train.record'],
+    # memmap 格式, 读取无需解压, 由 memmap_record.convert_record_to_memmap 转换
+    # 'train_file': [ '/data/record/cse_0110/train.memmap'],
     'eval_file': [ '/data/record/cse_0110/eval.record'],
     # 'test_file': [ '/home/tk/train/make_big_data/output/eval.record',
     'label_file': [ '/data/record/cse_0110/labels_122.txt'],
@@ -63,7 +71,7 @@ train_info_args = {
 pooling = 'cls'
 
 
-class NN_DataHelper(DataHelper):
+class NN_DataHelper(CompactRecordDataHelperMixin, MemmapDataHelperMixin, DataHelper):
     # 切分词
     def on_data_process(self, data: typing.Any, mode: str):
         tokenizer: BertTokenizer
@@ -109,32 +117,8 @@ class NN_DataHelper(DataHelper):
         id2label = {i: l for i, l in enumerate(labels)}
         return label2id, id2label
 
-    def collate_fn(self,batch):
-        o = {}
-        for i, b in enumerate(batch):
-            if i == 0:
-                for k in b:
-                    o[k] = [torch.tensor(b[k])]
-            else:
-                for k in b:
-                    o[k].append(torch.tensor(b[k]))
-        for k in o:
-            o[k] = torch.stack(o[k])
-
-        o.pop('id', None)
-        max_len = torch.max(o.pop('seqlen'))
-
-        o['input_ids'] = o['input_ids'][:, :max_len]
-        o['attention_mask'] = o['attention_mask'][:, :max_len]
-        if 'token_type_ids' in o:
-            o['token_type_ids'] = o['token_type_ids'][:, :max_len]
-        if 'seqlen2' in o:
-            max_len = torch.max(o.pop('seqlen2'))
-            o['input_ids2'] = o['input_ids2'][:, :max_len]
-            o['attention_mask2'] = o['attention_mask2'][:, :max_len]
-            if 'token_type_ids2' in o:
-                o['token_type_ids2'] = o['token_type_ids2'][:, :max_len]
-        return o
+    def collate_fn(self, batch):
+        return StackCollator()(batch)
 
 
 def generate_pair_example(all_example_dict: dict):
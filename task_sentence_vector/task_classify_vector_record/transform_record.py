@@ -0,0 +1,123 @@
+# @Time    : 2023/2/20 14:30
+# @Author  : tk
+# @FileName: transform_record.py
+# 多进程拆分/合并/修改数据集, 每个进程读取不相交的索引区间, 写各自的分片文件
+
+import multiprocessing
+import os
+import random
+import shutil
+
+import numpy as np
+from fastdatasets.record import load_dataset as Loader, RECORD, WriterObject
+from fastdatasets.common.writer import serialize_numpy, deserialize_numpy
+from tqdm import tqdm
+
+from compact_record import copy_compact_schema
+
+
+def drop_keys_transform(example, index, drop_keys=()):
+    for k in drop_keys:
+        example.pop(k, None)
+    return example
+
+
+def add_id_transform(example, index, key='id'):
+    example[key] = np.asarray(index, dtype=np.int32)
+    return example
+
+
+def _get_shard_file(output_file, worker_id):
+    return '{}.part-{:05d}'.format(output_file, worker_id)
+
+
+def _transform_worker(worker_id, input_record_filenames, start, end, output_files, compression_type,
+                      transform_fn, with_parse_numpy, eval_every, shuffle, seed):
+    options = RECORD.TFRecordOptions(compression_type=compression_type)
+    dataset_reader = Loader.RandomDataset(input_record_filenames, options=options, with_share_memory=True)
+
+    idx = list(range(start, end))
+    if shuffle:
+        random.Random(None if seed is None else seed + worker_id).shuffle(idx)
+
+    writers = [WriterObject(_get_shard_file(f, worker_id), options=options) for f in output_files]
+    counts = [0] * len(writers)
+    for i in tqdm(idx, desc='worker {}'.format(worker_id), position=worker_id, leave=False):
+        serialized = dataset_reader[i]
+        if transform_fn is not None:
+            example = deserialize_numpy(serialized) if with_parse_numpy else serialized
+            example = transform_fn(example, i)
+            if example is None:
+                continue
+            serialized = serialize_numpy(example) if with_parse_numpy else example
+        # 按原始索引拆分, 与进程数无关
+        n = 1 if len(writers) > 1 and (i + 1) % eval_every == 0 else 0
+        writers[n].write(serialized)
+        counts[n] += 1
+    for writer in writers:
+        writer.close()
+    dataset_reader.close()
+    return counts
+
+
+def concat_record_shards(shard_files, output_file, remove_shards=True):
+    # TFRecord 与 GZIP 多成员流均支持直接按字节拼接, 无需解压重新压缩
+    with open(output_file, mode='wb') as f_out:
+        for shard_file in shard_files:
+            with open(shard_file, mode='rb') as f_in:
+                shutil.copyfileobj(f_in, f_out, length=16 * 1024 * 1024)
+            if remove_shards:
+                os.remove(shard_file)
+
+
+def transform_records(input_record_filenames, output_file, output_eval_file=None, eval_every=15,
+                      transform_fn=None, with_parse_numpy=False, shuffle=False, seed=None,
+                      num_workers=None, concat=True, compression_type='GZIP'):
+    '''
+        input_record_filenames: 输入文件
+        output_file: 输出文件, output_eval_file 不为空时为训练集
+        output_eval_file: 验证集, 原始索引 (i + 1) % eval_every == 0 的样本写入验证集
+        transform_fn: (example, index) -> example, 返回 None 丢弃样本, 需可被 pickle
+        with_parse_numpy: transform_fn 输入输出为 NumpyWriter 字典, 否则为序列化数据
+        shuffle: 每个进程内打乱写入顺序
+        num_workers: 进程数, 默认 cpu 核数
+        concat: 合并各进程分片文件, 否则保留 output_file.part-xxxxx
+    '''
+    print('transform_records record...')
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+    options = RECORD.TFRecordOptions(compression_type=compression_type)
+    dataset_reader = Loader.RandomDataset(input_record_filenames, options=options, with_share_memory=True)
+    data_size = len(dataset_reader)
+    dataset_reader.close()
+
+    num_workers = max(1, min(num_workers, data_size))
+    output_files = [output_file] if output_eval_file is None else [output_file, output_eval_file]
+    bounds = np.linspace(0, data_size, num_workers + 1, dtype=np.int64).tolist()
+    tasks = [(worker_id, input_record_filenames, bounds[worker_id], bounds[worker_id + 1], output_files,
+              compression_type, transform_fn, with_parse_numpy, eval_every, shuffle, seed)
+             for worker_id in range(num_workers)]
+    with multiprocessing.Pool(num_workers) as pool:
+        counts = pool.starmap(_transform_worker, tasks)
+
+    shard_files = []
+    for n, f in enumerate(output_files):
+        files = [_get_shard_file(f, worker_id) for worker_id in range(num_workers)]
+        if concat:
+            concat_record_shards(files, f)
+            files = [f]
+        shard_files.append(files)
+        copy_compact_schema(input_record_filenames, files)
+        print(os.path.basename(f), sum(c[n] for c in counts))
+    return shard_files
+
+
+if __name__ == '__main__':
+    src_files = ['/data/record/cse/dataset_0-train.record']
+    dst_dir = '/data/record/cse_1226/'
+    os.makedirs(dst_dir, exist_ok=True)
+    transform_records(src_files,
+                      output_file=os.path.join(dst_dir, 'train.record'),
+                      output_eval_file=os.path.join(dst_dir, 'eval.record'),
+                      shuffle=True,
+                      num_workers=16)
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+# 随机 batch vs seqlen 分桶 vs token 预算, collate_fn 截断到 batch 内最大 seqlen 后的 padding 比例
+# seqlen 对数正态 (中位数 80 , 截断到 max_seq_length 200), 10 万条
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.bucket_sampler import BucketBatchSampler
+
+
+def padding_stats(seqlens, batches):
+    total = sum(int(seqlens[b].max()) * len(b) for b in batches)
+    valid = sum(int(seqlens[b].sum()) for b in batches)
+    return 1 - valid / total, total
+
+
+def random_batches(rng, n, batch_size):
+    indices = rng.permutation(n)
+    return [indices[i: i + batch_size] for i in range(0, n, batch_size)]
+
+
+if __name__ == '__main__':
+    rng = np.random.RandomState(123456)
+    n, batch_size, max_seq_length = 100000, 32, 200
+    seqlens = np.clip(rng.lognormal(np.log(80), 0.6, size=n).astype(np.int64), 8, max_seq_length)
+
+    batches = random_batches(rng, n, batch_size)
+    ratio, total = padding_stats(seqlens, batches)
+    print('random       batches {:>5} padding {:.1%} padded tokens {}'.format(len(batches), ratio, total))
+
+    for name, kwargs in [('bucket', dict(batch_size=batch_size)),
+                         ('token budget', dict(max_tokens=batch_size * int(np.mean(seqlens)), batch_size=256))]:
+        sampler = BucketBatchSampler(seqlens, bucket_size=batch_size * 100, seed=0, **kwargs)
+        start = time.time()
+        batches = [np.asarray(b) for b in sampler]
+        t = time.time() - start
+        assert np.array_equal(np.sort(np.concatenate(batches)), np.arange(n))
+        ratio, total = padding_stats(seqlens, batches)
+        print('{:<12} batches {:>5} padding {:.1%} padded tokens {} sampler {:.0f}ms/epoch'.format(
+            name, len(batches), ratio, total, t * 1000))
+
+    # ddp 分片: 各进程 batch 数相同, 互不重叠, 各 epoch 顺序不同
+    shards = [list(BucketBatchSampler(seqlens, max_tokens=4096, num_processes=4, process_index=i)) for i in range(4)]
+    assert len(set(len(s) for s in shards)) == 1
+    flat = np.concatenate([np.concatenate(s) for s in shards])
+    assert len(flat) == len(np.unique(flat))
+    sampler = BucketBatchSampler(seqlens, batch_size=batch_size)
+    assert list(sampler)[0] != list(sampler)[0]
+    print('ddp 4 shards x {} batches, disjoint'.format(len(shards[0])))
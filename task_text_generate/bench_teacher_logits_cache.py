@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+# unilm 蒸馏学生一个 epoch 耗时: 每步在线运行教师 vs 离线教师 top-k logits 缓存, cpu 单线程
+# 教师 12 层 / 学生 6 层 bert-base 尺寸随机权重; 注意力掩码用普通 padding mask, 计算量与 unilm_mask 相同
+import os
+import tempfile
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+from deep_training.nlp.losses.loss_kl import KLDivLoss
+from torch.utils.data import DataLoader
+from transformers import BertConfig, BertModel
+
+from task_autotitle_unilm_distillation import NN_DataHelper, TeacherLogitsDataset, build_teacher_logits_cache, \
+    build_student_config, get_target_index, get_target_labels
+
+
+def build_backbone(config):
+    model = BertModel(config, add_pooling_layer=False)
+    lm_head = torch.nn.Linear(config.hidden_size, config.vocab_size, bias=False)
+    return SimpleNamespace(model=model, lm_head=lm_head)
+
+
+def make_dataset(rng, num_examples, max_seq_length, max_target_length, vocab_size):
+    D = []
+    for _ in range(num_examples):
+        seqlen = rng.randint(max_seq_length // 2, max_seq_length + 1)
+        target_len = rng.randint(max_target_length // 2, max_target_length + 1)
+        input_ids = np.zeros(max_seq_length, dtype=np.int64)
+        input_ids[:seqlen] = rng.randint(1000, vocab_size, size=seqlen)
+        token_type_ids = np.zeros(max_seq_length, dtype=np.int64)
+        token_type_ids[seqlen - target_len:seqlen] = 1
+        D.append({'input_ids': input_ids, 'token_type_ids': token_type_ids, 'labels': input_ids,
+                  'seqlen': np.asarray(seqlen, dtype=np.int32)})
+    return D
+
+
+def collate_fn(batch):
+    return NN_DataHelper.collate_fn(None, batch)
+
+
+def run_epoch(student, dataloader, optimizer, teacher=None):
+    kl_loss = KLDivLoss('sum')
+    loss_fct = torch.nn.CrossEntropyLoss()
+    start = time.time()
+    for batch in dataloader:
+        labels = batch.pop('labels')
+        teacher_topk_values = batch.pop('teacher_topk_values', None)
+        teacher_topk_indices = batch.pop('teacher_topk_indices', None)
+        attention_mask = (batch['input_ids'] != 0).long()
+        index = get_target_index(batch['token_type_ids'])
+        hidden_states = student.model(input_ids=batch['input_ids'], attention_mask=attention_mask)[0]
+        lm_logits = student.lm_head(hidden_states[index])
+        loss_student = loss_fct(lm_logits, get_target_labels(labels, index))
+        if teacher_topk_values is not None:
+            student_logits = torch.gather(lm_logits, -1, teacher_topk_indices.long())
+            kl = kl_loss([teacher_topk_values.to(student_logits.dtype), student_logits])
+        else:
+            with torch.no_grad():
+                teacher_logits = teacher.compute_target_logits(index, **batch)
+            kl = kl_loss([teacher_logits, lm_logits])
+        loss = loss_student * 0.1 + kl
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad()
+    return time.time() - start
+
+
+if __name__ == '__main__':
+    torch.manual_seed(0)
+    torch.set_num_threads(1)
+    rng = np.random.RandomState(123456)
+    config = BertConfig(vocab_size=21128, hidden_size=768, num_hidden_layers=12, num_attention_heads=12,
+                        intermediate_size=3072, max_position_embeddings=512)
+    num_examples, batch_size, max_seq_length, max_target_length, topk = 64, 8, 200, 50, 64
+
+    teacher_backbone = build_backbone(config)
+    teacher_backbone.model.eval()
+
+    def compute_target_logits(index, **batch):
+        attention_mask = (batch['input_ids'] != 0).long()
+        hidden_states = teacher_backbone.model(input_ids=batch['input_ids'], attention_mask=attention_mask)[0]
+        return teacher_backbone.lm_head(hidden_states[index])
+
+    teacher = SimpleNamespace(compute_target_logits=compute_target_logits)
+    dataset = make_dataset(rng, num_examples, max_seq_length, max_target_length, config.vocab_size)
+
+    cache_dir = tempfile.mkdtemp()
+    start = time.time()
+    build_teacher_logits_cache(teacher, DataLoader(dataset, batch_size=batch_size, collate_fn=collate_fn),
+                               cache_dir, topk=topk)
+    t_build = time.time() - start
+    cache_size = sum(os.path.getsize(os.path.join(cache_dir, f)) for f in os.listdir(cache_dir))
+    cached_dataset = TeacherLogitsDataset(dataset, cache_dir)
+
+    # 缓存与在线教师 top-k 一致
+    batch = collate_fn([cached_dataset[i] for i in range(batch_size)])
+    index = get_target_index(batch['token_type_ids'])
+    with torch.no_grad():
+        values, indices = torch.topk(teacher.compute_target_logits(index, input_ids=batch['input_ids']), topk, -1)
+    assert torch.equal(indices, batch['teacher_topk_indices'].long())
+    assert torch.allclose(values.half(), batch['teacher_topk_values'])
+
+    results = {}
+    for mode in ['online', 'cache']:
+        torch.manual_seed(0)
+        student = build_backbone(build_student_config(config, 6))
+        optimizer = torch.optim.SGD(list(student.model.parameters()) + list(student.lm_head.parameters()), lr=1e-4)
+        g = torch.Generator().manual_seed(0)
+        dataloader = DataLoader(cached_dataset if mode == 'cache' else dataset, batch_size=batch_size, shuffle=True,
+                                generator=g, collate_fn=collate_fn)
+        results[mode] = run_epoch(student, dataloader, optimizer, teacher=teacher)
+        print('{:<6} {} examples batch={} L={} epoch {:.1f}s'.format(mode, num_examples, batch_size, max_seq_length,
+                                                                     results[mode]))
+    print('cache build {:.1f}s (once) size {:.0f}KB, top{} float16 + int32'.format(t_build, cache_size / 1024, topk))
+    print('student epoch time -{:.0%}'.format(1 - results['cache'] / results['online']))
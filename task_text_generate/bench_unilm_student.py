@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+# unilm 蒸馏: 教师 12 层 vs 截断学生 6 层 (layer map 初始化), cpu 上单条标题增量解码耗时
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+import torch
+from transformers import BertConfig, BertModel
+
+from task_autotitle_unilm_distillation import build_student_config, init_student_from_teacher
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.unilm_generate import UnilmIncrementalDecoder, greedy_generate
+
+
+def build_backbone(config):
+    model = BertModel(config, add_pooling_layer=False).eval()
+    lm_head = torch.nn.Linear(config.hidden_size, config.vocab_size, bias=False).eval()
+    return SimpleNamespace(model=model, lm_head=lm_head)
+
+
+def time_per_title(backbone, input_ids, attention_mask, max_target_length, number=10):
+    decoder = UnilmIncrementalDecoder(backbone.model, backbone.lm_head)
+    # eos 取不存在的 id , 固定生成 max_target_length 个 token
+    greedy_generate(decoder, input_ids, attention_mask, max_target_length, eos_token_id=-1)
+    start = time.time()
+    for _ in range(number):
+        greedy_generate(decoder, input_ids, attention_mask, max_target_length, eos_token_id=-1)
+    return (time.time() - start) / number
+
+
+if __name__ == '__main__':
+    torch.manual_seed(0)
+    torch.set_num_threads(1)
+    config = BertConfig(vocab_size=21128, hidden_size=768, num_hidden_layers=12, num_attention_heads=12,
+                        intermediate_size=3072, max_position_embeddings=512)
+    teacher = build_backbone(config)
+    student = build_backbone(build_student_config(config, 6))
+    layer_map = init_student_from_teacher(student, teacher)
+
+    input_ids = torch.randint(1000, config.vocab_size, (1, 128))
+    attention_mask = torch.ones_like(input_ids)
+    max_target_length = 32
+
+    # 学生各层与教师对应层一致
+    with torch.no_grad():
+        hidden = teacher.model.embeddings(input_ids=input_ids)
+        assert torch.equal(hidden, student.model.embeddings(input_ids=input_ids))
+        for i, j in enumerate(layer_map):
+            x = teacher.model.encoder.layer[j](hidden)[0]
+            assert torch.allclose(x, student.model.encoder.layer[i](hidden)[0])
+
+    t_teacher = time_per_title(teacher, input_ids, attention_mask, max_target_length)
+    t_student = time_per_title(student, input_ids, attention_mask, max_target_length)
+    n_teacher = sum(p.numel() for p in teacher.model.parameters()) + teacher.lm_head.weight.numel()
+    n_student = sum(p.numel() for p in student.model.parameters()) + student.lm_head.weight.numel()
+    print('layer map', layer_map)
+    print('teacher 12 layers {:.1f}M params {:.0f}ms/title'.format(n_teacher / 1e6, t_teacher * 1000))
+    print('student  6 layers {:.1f}M params {:.0f}ms/title'.format(n_student / 1e6, t_student * 1000))
+    print('src=128 tgt={} latency -{:.0%}'.format(max_target_length, 1 - t_student / t_teacher))
@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 import json
+import os
+import sys
 import typing
 
 import numpy as np
@@ -14,6 +16,10 @@ from torch.utils.data import DataLoader, IterableDataset
 from transformers import BertTokenizer
 from transformers import HfArgumentParser
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.bucket_sampler import load_bucket_sampler
+from common.unilm_generate import generate_titles
+
 train_info_args = {
     'devices': 1,
     'data_backend': 'memory_raw',
@@ -98,12 +104,37 @@ class MyTransformer(TransformerModelForUnilm, with_pl=True):
         super(MyTransformer, self).__init__(*args, **kwargs)
 
 
+class MySimpleModelCheckpoint(SimpleModelCheckpoint):
+    def __init__(self, *args, **kwargs):
+        super(MySimpleModelCheckpoint, self).__init__(*args, **kwargs)
+
+    def on_save_model(
+            self, trainer: "pl.Trainer", pl_module: "pl.LightningModule"
+    ) -> None:
+        # 保存权重
+        super(MySimpleModelCheckpoint, self).on_save_model(trainer, pl_module)
+        prefixs = [
+            '8月28日，网络爆料称，华住集团旗下连锁酒店用户数据疑似发生泄露。从卖家发布的内容看，数据包含华住旗下汉庭、禧玥、桔子、宜必思等10余个品牌酒店的住客信息。',
+            '中国足球协会今天发布公告，宣布了新一届国家队主教练的人选，新帅将在下月正式上任并带队参加世界杯预选赛。',
+        ]
+        print('*' * 30)
+        # 源文本只编码一次, 生成 token 增量解码, 支持 beam search 及 top-k / top-p 采样
+        outputs = generate_titles(pl_module, self.tokenizer, prefixs, self.data_args, device=pl_module.device)
+        for prefix, output in zip(prefixs, outputs):
+            print('input', prefix)
+            print('output', output)
+            print()
+
+
 if __name__ == '__main__':
     parser = HfArgumentParser((ModelArguments, TrainingArguments, DataArguments))
     model_args, training_args, data_args = parser.parse_dict(train_info_args)
+    # 按 seqlen 分桶组 batch , max_tokens 不为 None 时按 token 预算组 batch
+    with_bucket_sampler = True
+    max_tokens = None
 
-    checkpoint_callback = SimpleModelCheckpoint(monitor="loss",
-                                                every_n_train_steps=2000 // training_args.gradient_accumulation_steps)
+    checkpoint_callback = MySimpleModelCheckpoint(monitor="loss",
+                                                  every_n_train_steps=2000 // training_args.gradient_accumulation_steps)
     trainer = Trainer(
         callbacks=[checkpoint_callback],
         max_epochs=training_args.max_epochs,
@@ -116,10 +147,15 @@ if __name__ == '__main__':
         accumulate_grad_batches=training_args.gradient_accumulation_steps,
         num_sanity_val_steps=0,
         strategy='ddp' if torch.cuda.device_count() > 1 else 'auto',
+        # 分桶 sampler 已按 num_processes / process_index 分片
+        use_distributed_sampler=not with_bucket_sampler,
     )
 
     dataHelper = NN_DataHelper(model_args, training_args, data_args)
     tokenizer, config, label2id, id2label = dataHelper.load_tokenizer_and_config()
+    # 额外参数
+    checkpoint_callback.tokenizer = tokenizer
+    checkpoint_callback.data_args = data_args
 
     # 缓存数据集
     if data_args.do_train:
@@ -132,12 +168,22 @@ if __name__ == '__main__':
     model = MyTransformer(config=config, model_args=model_args, training_args=training_args)
 
     if not data_args.convert_onnx:
-        train_datasets = dataHelper.load_distributed_random_sampler(
-            dataHelper.train_files,
-            with_load_memory=True,
-            collate_fn=dataHelper.collate_fn,
-            batch_size=training_args.train_batch_size,
-            num_processes = trainer.world_size, process_index=trainer.global_rank)
+        if with_bucket_sampler:
+            train_datasets = load_bucket_sampler(
+                dataHelper, dataHelper.train_files,
+                with_load_memory=True,
+                collate_fn=dataHelper.collate_fn,
+                batch_size=training_args.train_batch_size,
+                max_tokens=max_tokens,
+                seed=training_args.seed,
+                num_processes=trainer.world_size, process_index=trainer.global_rank)
+        else:
+            train_datasets = dataHelper.load_distributed_random_sampler(
+                dataHelper.train_files,
+                with_load_memory=True,
+                collate_fn=dataHelper.collate_fn,
+                batch_size=training_args.train_batch_size,
+                num_processes = trainer.world_size, process_index=trainer.global_rank)
         if train_datasets is not None:
             trainer.fit(model, train_dataloaders=train_datasets)
         else:
@@ -1,5 +1,8 @@
 # -*- coding: utf-8 -*-
+import copy
 import json
+import os
+import sys
 import typing
 
 import numpy as np
@@ -12,10 +15,14 @@ from deep_training.nlp.models.transformer import TransformerModelForUnilm
 from deep_training.utils.func import seq_padding
 from deep_training.utils.trainer import SimpleModelCheckpoint
 from lightning import Trainer
-from torch.utils.data import DataLoader, IterableDataset
+from torch.utils.data import DataLoader, Dataset, IterableDataset
+from torch.utils.data.distributed import DistributedSampler
 from transformers import BertTokenizer
 from transformers import HfArgumentParser
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.unilm_generate import generate_titles
+
 train_info_args = {
     'devices': 1,
     'data_backend': 'memory_raw',
@@ -77,6 +84,12 @@ class NN_DataHelper(DataHelper):
         return D
 
     def collate_fn(self,batch):
+        # 教师 top-k logits 每条样本行数不同, 按样本顺序拼接, 与 get_target_index 的行顺序一致
+        teacher_keys = [k for k in TeacherLogitsDataset.keys if k in batch[0]]
+        teacher = {k: torch.cat([torch.from_numpy(np.asarray(b[k])) for b in batch]) for k in teacher_keys}
+        if teacher_keys:
+            batch = [{k: v for k, v in b.items() if k not in teacher} for b in batch]
+
         o = {}
         for i, b in enumerate(batch):
             if i == 0:
@@ -92,38 +105,212 @@ class NN_DataHelper(DataHelper):
         o['input_ids'] = o['input_ids'][:, :max_len]
         o['token_type_ids'] = o['token_type_ids'][:, :max_len]
         o['labels'] = o['labels'][:, :max_len]
+        o.update(teacher)
         return o
 
+    def load_distributed_random_sampler_with_teacher_logits(self, files, teacher_cache_dir, batch_size,
+                                                            num_processes=1, process_index=0, collate_fn=None,
+                                                            cache_key=None):
+        # 与 load_distributed_random_sampler 相同, 样本附带离线教师 top-k logits
+        dataset = self.load_dataset(files, shuffle=False, with_load_memory=True)
+        if dataset is None:
+            return None
+        dataset = TeacherLogitsDataset(dataset, teacher_cache_dir, cache_key=cache_key)
+        sampler = DistributedSampler(dataset, num_replicas=num_processes,
+                                     rank=process_index) if num_processes > 1 else None
+        return DataLoader(dataset, batch_size=batch_size,
+                          shuffle=sampler is None,
+                          sampler=sampler,
+                          collate_fn=collate_fn)
+
+
+def get_target_index(token_type_ids):
+    '''
+        第 i 个位置预测第 i + 1 个 token , 只保留预测标题段 (token_type_ids == 1) 的位置
+        return: (batch_index, seq_index)
+    '''
+    target = torch.zeros_like(token_type_ids, dtype=torch.bool)
+    target[:, :-1] = token_type_ids[:, 1:] == 1
+    return torch.nonzero(target, as_tuple=True)
+
+
+def get_target_labels(labels, index):
+    # 已按 index 移位, 无需再 shift
+    return labels[index[0], index[1] + 1].long()
+
+
+def _get_file_state(path):
+    st = os.stat(path)
+    return {'path': os.path.abspath(path), 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+
+def get_teacher_cache_key(files, topk, teacher_weight):
+    '''
+        缓存按下标与训练记录对齐, 训练记录 (shuffle=True 制作) 或教师权重变化后必须重新生成
+        files: dataHelper.train_files , memory 后端每次运行重新制作, 无法校验, 返回 None
+    '''
+    if not files or not all(isinstance(f, str) and os.path.isfile(f) for f in files):
+        return None
+    return {
+        'files': [_get_file_state(f) for f in files],
+        'topk': topk,
+        'teacher_weight': _get_file_state(teacher_weight),
+    }
+
+
+def is_teacher_logits_cache_valid(cache_dir, cache_key):
+    meta_file = os.path.join(cache_dir, 'meta.json')
+    if cache_key is None or not os.path.exists(meta_file):
+        return False
+    with open(meta_file, mode='r', encoding='utf-8') as f:
+        return json.load(f).get('cache_key') == cache_key
+
+
+@torch.no_grad()
+def build_teacher_logits_cache(teacher_model, dataloader, output_dir, topk=64, device=None, cache_key=None):
+    '''
+        教师只对训练集跑一次前向, 每个标题段位置保存 top-k logits
+        dataloader: 顺序读取训练记录 (shuffle=False) , 第 i 条样本对应缓存第 i 条
+        cache_key: get_teacher_cache_key 的结果, 写入 meta.json , 用于判断缓存是否过期
+        输出: values.npy (num_target, topk) float16 , indices.npy (num_target, topk) int32 ,
+              offsets.npy (num_examples + 1,) int64 , 第 i 条样本的行为 offsets[i]:offsets[i + 1]
+    '''
+    values, indices, counts = [], [], []
+    for batch in dataloader:
+        batch.pop('labels', None)
+        if device is not None:
+            batch = {k: v.to(device) for k, v in batch.items()}
+        index = get_target_index(batch['token_type_ids'])
+        logits = teacher_model.compute_target_logits(index, **batch)
+        topk_values, topk_indices = torch.topk(logits.float(), topk, dim=-1)
+        values.append(topk_values.half().cpu().numpy())
+        indices.append(topk_indices.int().cpu().numpy())
+        counts.append(torch.bincount(index[0], minlength=batch['input_ids'].size(0)).cpu().numpy())
+
+    os.makedirs(output_dir, exist_ok=True)
+    # 先删除旧 meta.json , 写入中断时不会把旧缓存当作完整缓存
+    if os.path.exists(os.path.join(output_dir, 'meta.json')):
+        os.remove(os.path.join(output_dir, 'meta.json'))
+    counts = np.concatenate(counts)
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    np.save(os.path.join(output_dir, 'values.npy'), np.concatenate(values))
+    np.save(os.path.join(output_dir, 'indices.npy'), np.concatenate(indices))
+    np.save(os.path.join(output_dir, 'offsets.npy'), offsets)
+    # meta.json 最后写入, 存在即表示缓存完整
+    with open(os.path.join(output_dir, 'meta.json'), mode='w', encoding='utf-8') as f:
+        json.dump({'num_examples': len(counts), 'num_targets': int(offsets[-1]), 'topk': topk,
+                   'cache_key': cache_key}, f)
+
+
+class TeacherLogitsDataset(Dataset):
+    '''
+        训练记录 + 离线教师 top-k logits , 按样本下标对齐, 缓存以 mmap 方式读取
+    '''
+    keys = ('teacher_topk_values', 'teacher_topk_indices')
+
+    def __init__(self, dataset, cache_dir, cache_key=None):
+        with open(os.path.join(cache_dir, 'meta.json'), mode='r', encoding='utf-8') as f:
+            meta = json.load(f)
+        assert meta['num_examples'] == len(dataset), 'teacher logits cache does not match dataset'
+        assert cache_key is None or meta.get('cache_key') == cache_key, 'teacher logits cache is stale'
+        self.dataset = dataset
+        self.values = np.load(os.path.join(cache_dir, 'values.npy'), mmap_mode='r')
+        self.indices = np.load(os.path.join(cache_dir, 'indices.npy'), mmap_mode='r')
+        self.offsets = np.load(os.path.join(cache_dir, 'offsets.npy'))
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, item):
+        d = dict(self.dataset[item])
+        start, end = self.offsets[item], self.offsets[item + 1]
+        d['teacher_topk_values'] = np.array(self.values[start:end])
+        d['teacher_topk_indices'] = np.array(self.indices[start:end])
+        return d
+
+
+def get_layer_map(teacher_num_layers, student_num_layers):
+    '''
+        学生第 i 层取教师第 (i + 1) * k - 1 层, 学生最后一层对应教师最后一层
+        如 12 -> 6 : [1, 3, 5, 7, 9, 11]
+    '''
+    return [(i + 1) * teacher_num_layers // student_num_layers - 1 for i in range(student_num_layers)]
+
+
+def build_student_config(config, student_num_layers):
+    student_config = copy.deepcopy(config)
+    student_config.num_hidden_layers = student_num_layers
+    return student_config
+
+
+def init_student_from_teacher(student, teacher, layer_map=None):
+    '''
+        student, teacher: TransformerModelForUnilm (pl_module.backbone)
+        embeddings / lm_head 直接复制, 编码层按 layer_map 复制
+    '''
+    student_model, teacher_model = student.model, teacher.model
+    if layer_map is None:
+        layer_map = get_layer_map(len(teacher_model.encoder.layer), len(student_model.encoder.layer))
+    assert len(layer_map) == len(student_model.encoder.layer)
+    student_model.embeddings.load_state_dict(teacher_model.embeddings.state_dict())
+    for i, j in enumerate(layer_map):
+        student_model.encoder.layer[i].load_state_dict(teacher_model.encoder.layer[j].state_dict())
+    if getattr(student_model, 'pooler', None) is not None and getattr(teacher_model, 'pooler', None) is not None:
+        student_model.pooler.load_state_dict(teacher_model.pooler.state_dict())
+    student.lm_head.load_state_dict(teacher.lm_head.state_dict())
+    return layer_map
+
+
+def export_student(student, tokenizer, output_dir):
+    '''
+        导出独立的小模型: save_pretrained 的编码器 + lm_head.bin , 不含教师权重
+        加载: AutoModel.from_pretrained(output_dir) , lm_head 为 nn.Linear(hidden_size, vocab_size, bias=False)
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    student.model.save_pretrained(output_dir)
+    torch.save(student.lm_head.state_dict(), os.path.join(output_dir, 'lm_head.bin'))
+    tokenizer.save_pretrained(output_dir)
+
 
 # 教师12层
 class TeacherTransformer(TransformerModelForUnilm, with_pl=True):
     def __init__(self, *args, **kwargs):
         super(TeacherTransformer, self).__init__(*args, **kwargs)
 
-    def compute_loss(self, *args, **batch) -> tuple:
+    def compute_target_logits(self, index, *args, **batch):
+        '''
+            先取标题段位置的隐藏层, 只对这些行计算 lm_head
+            return: (num_target, vocab_size)
+        '''
         batch['attention_mask'] = unilm_mask(batch['token_type_ids'])
         if getattr(self.config, 'type_vocab_size', 0) != 2:
             batch.pop('token_type_ids')
-
-        labels = batch.pop('labels', None)
         outputs = self.model(*args, **batch)
         hidden_states = outputs[0]
-        lm_logits = self.model.lm_head(hidden_states)
+        return self.model.lm_head(hidden_states[index])
 
+    def compute_loss(self, *args, **batch) -> tuple:
+        labels = batch.pop('labels', None)
         if labels is not None:
-            labels = labels.long()
-            shift_logits = lm_logits[..., :-1, :].contiguous()
-            shift_labels = labels[..., 1:].contiguous()
-            loss = self.model.loss_fct(shift_logits.view(-1, shift_logits.size(-1)), shift_labels.view(-1))
+            index = get_target_index(batch['token_type_ids'])
+            lm_logits = self.compute_target_logits(index, *args, **batch)
+            labels = get_target_labels(labels, index)
+            loss = self.model.loss_fct(lm_logits, labels, with_shift=False)
+            return (loss, lm_logits, labels)
 
-            outputs = (loss, lm_logits, labels)
-        else:
-            outputs = (lm_logits,)
-        return outputs
+        batch['attention_mask'] = unilm_mask(batch['token_type_ids'])
+        if getattr(self.config, 'type_vocab_size', 0) != 2:
+            batch.pop('token_type_ids')
+        outputs = self.model(*args, **batch)
+        hidden_states = outputs[0]
+        lm_logits = self.model.lm_head(hidden_states)
+        return (lm_logits,)
 
 
-# 学生6层
+# 学生6层, 截断的编码器, 由 build_student_config 构建, init_student_from_teacher 初始化
 class StudentTransformer(TransformerModelForUnilm, with_pl=True):
+    # teacher_model 为 None 时, kl 使用 batch 中的离线教师 top-k logits
     def __init__(self, teacher_model, *args, **kwargs):
         super(StudentTransformer, self).__init__(*args, **kwargs)
         self.teacher_model = teacher_model
@@ -131,25 +318,32 @@ class StudentTransformer(TransformerModelForUnilm, with_pl=True):
 
     def compute_loss(self, *args, **batch) -> tuple:
         labels = batch.pop('labels', None)
+        teacher_topk_values = batch.pop('teacher_topk_values', None)
+        teacher_topk_indices = batch.pop('teacher_topk_indices', None)
 
         inputs = {k: v for k, v in batch.items()}
         inputs['attention_mask'] = unilm_mask(inputs['token_type_ids'])
         if getattr(self.config, 'type_vocab_size', 0) != 2:
             inputs.pop('token_type_ids')
 
-        outputs = self.model(*args, **inputs, output_hidden_states=True)
-        # hidden_states = outputs[0]
-        # 第六层
-        hidden_states = outputs[2][-6]
-        lm_logits = self.model.lm_head(hidden_states)
+        outputs = self.model(*args, **inputs)
+        hidden_states = outputs[0]
         if labels is not None:
-            labels = labels.long()
-            shift_logits = lm_logits[..., :-1, :].contiguous()
-            shift_labels = labels[..., 1:].contiguous()
-            loss_student = self.model.loss_fct(shift_logits.view(-1, shift_logits.size(-1)), shift_labels.view(-1))
+            # 交叉熵与 kl 只在标题段计算
+            index = get_target_index(batch['token_type_ids'])
+            lm_logits = self.model.lm_head(hidden_states[index])
+            labels = get_target_labels(labels, index)
+            loss_student = self.model.loss_fct(lm_logits, labels, with_shift=False)
 
-            teacher_logits = self.teacher_model.compute_loss(*args, **batch)[0]
-            kl_Loss = self.kl_loss([teacher_logits, lm_logits])
+            if teacher_topk_values is not None:
+                # 离线缓存: kl 在教师 top-k 词上计算, 行数不一致说明缓存与训练记录未对齐
+                assert teacher_topk_values.size(0) == lm_logits.size(0), 'teacher logits cache does not match batch'
+                student_logits = torch.gather(lm_logits, -1, teacher_topk_indices.long())
+                kl_Loss = self.kl_loss([teacher_topk_values.to(student_logits.dtype), student_logits])
+            else:
+                with torch.no_grad():
+                    teacher_logits = self.teacher_model.compute_target_logits(index, *args, **batch)
+                kl_Loss = self.kl_loss([teacher_logits, lm_logits])
             loss_dict = {
                 'loss_student': loss_student,
                 'kl_Loss': kl_Loss,
@@ -158,16 +352,39 @@ class StudentTransformer(TransformerModelForUnilm, with_pl=True):
 
             outputs = (loss_dict, lm_logits, labels)
         else:
+            lm_logits = self.model.lm_head(hidden_states)
             outputs = (lm_logits,)
         return outputs
 
 
+class MySimpleModelCheckpoint(SimpleModelCheckpoint):
+    def __init__(self, *args, **kwargs):
+        super(MySimpleModelCheckpoint, self).__init__(*args, **kwargs)
+
+    def on_save_model(
+            self, trainer: "pl.Trainer", pl_module: "pl.LightningModule"
+    ) -> None:
+        # 保存权重
+        super(MySimpleModelCheckpoint, self).on_save_model(trainer, pl_module)
+        prefixs = [
+            '8月28日，网络爆料称，华住集团旗下连锁酒店用户数据疑似发生泄露。从卖家发布的内容看，数据包含华住旗下汉庭、禧玥、桔子、宜必思等10余个品牌酒店的住客信息。',
+            '中国足球协会今天发布公告，宣布了新一届国家队主教练的人选，新帅将在下月正式上任并带队参加世界杯预选赛。',
+        ]
+        print('*' * 30)
+        # 源文本只编码一次, 生成 token 增量解码, 支持 beam search 及 top-k / top-p 采样
+        outputs = generate_titles(pl_module, self.tokenizer, prefixs, self.data_args, device=pl_module.device)
+        for prefix, output in zip(prefixs, outputs):
+            print('input', prefix)
+            print('output', output)
+            print()
+
+
 if __name__ == '__main__':
     parser = HfArgumentParser((ModelArguments, TrainingArguments, DataArguments))
     model_args, training_args, data_args = parser.parse_dict(train_info_args)
 
-    checkpoint_callback = SimpleModelCheckpoint(monitor="loss",
-                                                every_n_train_steps=2000 // training_args.gradient_accumulation_steps)
+    checkpoint_callback = MySimpleModelCheckpoint(monitor="loss",
+                                                  every_n_train_steps=2000 // training_args.gradient_accumulation_steps)
     trainer = Trainer(
         callbacks=[checkpoint_callback],
         max_epochs=training_args.max_epochs,
@@ -184,6 +401,9 @@ if __name__ == '__main__':
 
     dataHelper = NN_DataHelper(model_args, training_args, data_args)
     tokenizer, config, label2id, id2label = dataHelper.load_tokenizer_and_config()
+    # 额外参数
+    checkpoint_callback.tokenizer = tokenizer
+    checkpoint_callback.data_args = data_args
 
     # 缓存数据集
     if data_args.do_train:
@@ -196,6 +416,11 @@ if __name__ == '__main__':
 
     # 是否首先训练模型
     is_training_teacher = True
+    # 蒸馏时教师只对训练集跑一次, 离线缓存 top-k logits , 学生训练不再运行教师前向
+    use_teacher_logits_cache = True
+    teacher_logits_topk = 64
+    teacher_cache_dir = None
+    teacher_cache_key = None
 
     if is_training_teacher:  # 训练teacher 模型
         model = TeacherTransformer(config=config, model_args=model_args, training_args=training_args)
@@ -206,17 +431,47 @@ if __name__ == '__main__':
                                                                 training_args=training_args)
         for k, p in teacher_model.named_parameters():
             p.requires_grad = False
-        model = StudentTransformer(teacher_model, config=config, model_args=model_args, training_args=training_args)
+        student_num_layers = 6
+        student_config = build_student_config(config, student_num_layers)
+        if use_teacher_logits_cache:
+            teacher_cache_dir = os.path.join(data_args.output_dir, 'teacher_logits_top{}'.format(teacher_logits_topk))
+            # 训练记录、top-k 或教师权重变化后重新生成, memory 后端每次运行重新生成
+            teacher_cache_key = get_teacher_cache_key(dataHelper.train_files, teacher_logits_topk, teacher_weight)
+            if not is_teacher_logits_cache_valid(teacher_cache_dir, teacher_cache_key):
+                device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+                teacher_model.to(device).eval()
+                build_teacher_logits_cache(teacher_model,
+                                           dataHelper.load_sequential_sampler(dataHelper.train_files,
+                                                                              batch_size=training_args.eval_batch_size,
+                                                                              collate_fn=dataHelper.collate_fn,
+                                                                              with_load_memory=True),
+                                           teacher_cache_dir, topk=teacher_logits_topk, device=device,
+                                           cache_key=teacher_cache_key)
+                teacher_model.cpu()
+        model = StudentTransformer(None if use_teacher_logits_cache else teacher_model, config=student_config,
+                                   model_args=model_args, training_args=training_args)
+        layer_map = init_student_from_teacher(model.backbone, teacher_model.backbone)
+        print('student layer map', layer_map)
 
     if not data_args.convert_onnx:
-        train_datasets = dataHelper.load_distributed_random_sampler(
-            dataHelper.train_files,
-            with_load_memory=True,
-            collate_fn=dataHelper.collate_fn,
-            batch_size=training_args.train_batch_size,
-            num_processes = trainer.world_size, process_index=trainer.global_rank)
+        if teacher_cache_dir is not None:
+            train_datasets = dataHelper.load_distributed_random_sampler_with_teacher_logits(
+                dataHelper.train_files, teacher_cache_dir,
+                collate_fn=dataHelper.collate_fn,
+                batch_size=training_args.train_batch_size,
+                num_processes=trainer.world_size, process_index=trainer.global_rank,
+                cache_key=teacher_cache_key)
+        else:
+            train_datasets = dataHelper.load_distributed_random_sampler(
+                dataHelper.train_files,
+                with_load_memory=True,
+                collate_fn=dataHelper.collate_fn,
+                batch_size=training_args.train_batch_size,
+                num_processes = trainer.world_size, process_index=trainer.global_rank)
         if train_datasets is not None:
             trainer.fit(model, train_dataloaders=train_datasets)
+            if not is_training_teacher:
+                export_student(model.backbone, tokenizer, os.path.join(data_args.output_dir, 'student'))
         else:
             eval_datasets = dataHelper.load_sequential_sampler(dataHelper.eval_files,batch_size=training_args.eval_batch_size,collate_fn=dataHelper.collate_fn)
             test_datasets = dataHelper.load_sequential_sampler(dataHelper.test_files,batch_size=training_args.test_batch_size,collate_fn=dataHelper.collate_fn)